@@ -1,4 +1,6 @@
-import re, itertools
+import re, itertools, hashlib, json, mmap, os
+from collections import OrderedDict
+from functools import lru_cache
 
 # Part 1 : Classes and functions you must implement - refer to the jupyter notebook
 # You may need to write more classes, which can be done here or in separate files, you choose.
@@ -6,6 +8,17 @@ import re, itertools
 # Define global constants
 ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
 
+# Letter -> index in the alphabet, e.g. 'C' -> 2. Avoids ALPHABET.index(...) scans on the hot path
+ALPHABET_INDEX = {letter: index for index, letter in enumerate(ALPHABET)}
+
+# The same for raw bytes: ALPHABET_BYTES[2] -> ord('C') and BYTE_INDEX[ord('C')] -> 2, with -1 for bytes outside the alphabet
+ALPHABET_BYTES = ALPHABET.encode("ascii")
+BYTE_INDEX = [ALPHABET_INDEX.get(chr(byte), -1) for byte in range(256)]
+
+# What encoding raw bytes does with a byte outside the alphabet: copy it to the output without stepping the
+# rotors, leave it out, or raise ValueError
+NON_ALPHABET_POLICIES = ("keep", "drop", "error")
+
 # Rotor name : (mapping order corresponding to alphabet, rotor notch position)
 # reflectors don't rotate -> A, B & C have no notches
 ROTOR_BOX = {
@@ -87,6 +100,22 @@ class Plugboard:
         return character
 
 
+@lru_cache(maxsize=1024)
+def wiring_tables(rotor_mapping: str) -> tuple:
+    """
+    Forward and inverse permutation tables of a wiring, as tuples of alphabet indices.
+    """
+    # forward[pin] -> contact, e.g. rotor I: forward[0] = 4 (A -> E)
+    forward = tuple(ALPHABET_INDEX[contact] for contact in rotor_mapping)
+
+    # inverse[contact] -> pin, so the return path needs no mapping.index(...) scan
+    inverse = [0] * len(rotor_mapping)
+    for pin, contact in enumerate(forward):
+        inverse[contact] = pin
+
+    return forward, tuple(inverse)
+
+
 class Rotor:
     def __init__(self, rotor_name, rotor_mapping, rotor_notch_position):
 
@@ -95,66 +124,82 @@ class Rotor:
         self.mapping = rotor_mapping
         self.notch_position = rotor_notch_position
 
-        # Declare custom attributes
-        self.position = "A"
+        # Declare custom attributes: position and ring setting are kept as alphabet indices
+        self.position_index = 0
         self.ring_setting = 0
 
-    def encode_right_to_left(self, character):
+    @property
+    def mapping(self) -> str:
+        return self._mapping
+
+    @mapping.setter
+    def mapping(self, rotor_mapping: str) -> None:
         """
-        Alphabet |-> Mapping
+        Stores the wiring with its forward and inverse integer permutation tables, shared by every rotor so wired.
         """
-        # 1. Find the position of the character in the alphabet
-        alphabet_index = ALPHABET.index(character)
+        self._mapping = rotor_mapping
+        self.forward, self.inverse = wiring_tables(rotor_mapping)
 
-        # 2. Find the no. places the rotor has been shifted
-        offset = ALPHABET.index(self.position) - self.ring_setting       
+    @property
+    def notch_position(self):
+        return self._notch_position
 
-        # 3. Get the index of the current pin
-        pin_index = (alphabet_index + offset) % 26
+    @notch_position.setter
+    def notch_position(self, rotor_notch_position) -> None:
+        self._notch_position = rotor_notch_position
 
-        # 4. Find the contact of the current rotor 
-        current_contact = self.mapping[pin_index]
+        # Rotors without a notch (Beta, Gamma, reflectors) never cause a turnover
+        self.notch_index = -1 if rotor_notch_position is None else ALPHABET_INDEX[rotor_notch_position]
 
-        # 5. Translate the contact back to the correct pin for the next rotor
-        next_contact_index = (ALPHABET.index(current_contact) - offset) % 26
+    @property
+    def position(self) -> str:
+        return ALPHABET[self.position_index]
 
-        # 6. Return the contact for the next rotor
-        return ALPHABET[next_contact_index]
+    @position.setter
+    def position(self, position: str) -> None:
+        self.position_index = ALPHABET_INDEX[position]
 
-    def encode_left_to_right(self, character):
+    def encode_index_right_to_left(self, alphabet_index: int) -> int:
         """
-        Mapping |-> Alphabet
+        Alphabet |-> Mapping, on alphabet indices.
         """
-        # 1. Find the position of the current character in the alphabet
-        alphabet_index = ALPHABET.index(character)
+        # Find the no. places the rotor has been shifted
+        offset = self.position_index - self.ring_setting
 
-        #2. Find the no. places the rotor has been shifted
-        offset = ALPHABET.index(self.position) - self.ring_setting
+        # Look up the contact of the current pin and translate it back for the next rotor
+        return (self.forward[(alphabet_index + offset) % 26] - offset) % 26
 
-        # 3. Get the index of the current contact
-        contact_index = (alphabet_index + offset) % 26
+    def encode_index_left_to_right(self, alphabet_index: int) -> int:
+        """
+        Mapping |-> Alphabet, on alphabet indices.
+        """
+        # Find the no. places the rotor has been shifted
+        offset = self.position_index - self.ring_setting
 
-        # 4. Find the pin for the current rotor's contact
-        current_pin = ALPHABET[contact_index]
+        # Look up the pin of the current contact and translate it back for the next rotor
+        return (self.inverse[(alphabet_index + offset) % 26] - offset) % 26
 
-        # 5. Translate the pin back to the correct pin for the next rotor
-        next_pin_index = (self.mapping.index(current_pin) - offset) % 26
+    def encode_right_to_left(self, character):
+        """
+        Alphabet |-> Mapping
+        """
+        return ALPHABET[self.encode_index_right_to_left(ALPHABET_INDEX[character])]
 
-        # 6. Return the pin for the next rotor
-        return ALPHABET[next_pin_index]
+    def encode_left_to_right(self, character):
+        """
+        Mapping |-> Alphabet
+        """
+        return ALPHABET[self.encode_index_left_to_right(ALPHABET_INDEX[character])]
 
     def rotate(self) -> bool:
         """
         Updates the position of a rotor after rotation. If the last position  a notch, function returns True.
         """
         # Create a variable to remember whether the last position was a notch
-        notch_was_rotated = self.position == self.notch_position
+        notch_was_rotated = self.position_index == self.notch_index
 
         # move the rotor one position up | if this is the last position-> loop back to 0
-        alphabet_index = (ALPHABET.index(self.position) + 1) % 26
-        
-        # Update the new position after rotation
-        self.position = ALPHABET[alphabet_index]
+        self.position_index = (self.position_index + 1) % 26
 
         # Indicate whether the notch has been rotated
         return notch_was_rotated
@@ -171,53 +216,615 @@ def rotor_from_name(rotor_name: str) -> object:
     return Rotor(rotor_name, rotor_mapping, rotor_notch_position)
 
 
+class CompositeTableCache:
+    """
+    Bounded LRU cache of composite substitution tables, keyed by machine state.
+    """
+    def __init__(self, maxsize: int = 1 << 16) -> None:
+        self.maxsize = maxsize
+        self.tables = OrderedDict()
+
+        # Counters to judge whether the cache is earning its keep
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+
+        # Return None on a miss so the caller can build the table
+        table = self.tables.get(key)
+        if table is None:
+            self.misses += 1
+            return None
+
+        # Mark the state as most recently used
+        self.tables.move_to_end(key)
+        self.hits += 1
+        return table
+
+    def put(self, key: tuple, table: list) -> None:
+        self.tables[key] = table
+
+        # Evict the least recently used state once the bound is exceeded
+        if len(self.tables) > self.maxsize:
+            self.tables.popitem(last=False)
+
+    def clear(self) -> None:
+        self.tables.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Composite tables are shared by every machine, so repeated trials over the same states reuse them
+composite_cache = CompositeTableCache()
+
+
+# Static rotors folded with the reflector, shared by every machine
+virtual_reflector_cache = CompositeTableCache()
+
+class SteppingSchedule:
+    """
+    Rotor positions at every character of a message. Stepping depends only on the rotors' notches and start
+    positions - not on the text, ring settings, plugboard or reflector - so one schedule serves every such candidate.
+    """
+    def __init__(self, notch_indices: tuple, initial_positions: tuple, length: int) -> None:
+        self.number_of_rotors = len(initial_positions)
+        self.length = length
+
+        # Row p holds the positions the rotors have when character p passes through them (after stepping)
+        self.positions = bytearray(length * self.number_of_rotors)
+
+        # Characters at which any rotor other than the rightmost steps
+        self.turnovers = []
+
+        positions = list(initial_positions)
+        for char_idx in range(length):
+
+            # Rotate rightmost rotor, and inner rotors while the one to their right was on its notch
+            i = self.number_of_rotors - 1
+            rotor_was_on_notch = positions[i] == notch_indices[i]
+            positions[i] = (positions[i] + 1) % 26
+            while i != 0 and rotor_was_on_notch:
+                i -= 1
+                rotor_was_on_notch = positions[i] == notch_indices[i]
+                positions[i] = (positions[i] + 1) % 26
+
+            if i != self.number_of_rotors - 1: self.turnovers.append(char_idx)
+
+            self.positions[char_idx * self.number_of_rotors:(char_idx + 1) * self.number_of_rotors] = bytes(positions)
+
+        self.positions = bytes(self.positions)
+
+    def state(self, char_idx: int) -> bytes:
+        """
+        Rotor positions at a character as bytes of alphabet indices, e.g. bytes([0, 1, 2]) for 'A B C'.
+        """
+        return self.positions[char_idx * self.number_of_rotors:(char_idx + 1) * self.number_of_rotors]
+
+
+@lru_cache(maxsize=1024)
+def stepping_schedule(notch_indices: tuple, initial_positions: tuple, length: int) -> SteppingSchedule:
+    """
+    Returns the (cached) stepping schedule for the rotors' notches (-1 for none), start positions as alphabet
+    indices and a message length.
+    """
+    return SteppingSchedule(notch_indices, initial_positions, length)
+
+
+def stepping_period(enigma: object) -> int:
+    """
+    Number of letters after which the machine's rotors are back where they started.
+    """
+    # The rightmost rotor always moves; each rotor to its left moves only if the one to its right has a notch
+    moving_rotors = 1
+    for rotor in enigma.rotors[:0:-1]:
+        if rotor.notch_index < 0: break
+        moving_rotors += 1
+
+    return 26 ** moving_rotors
+
+
+def save_mapped_file(path: str, magic: bytes, header: object, sections: list) -> None:
+    """
+    Writes magic, a one line JSON header and the bytes-like sections. The header is padded so the sections start
+    4-byte aligned for memoryview.cast, and the file goes through a temporary so no reader sees it half written.
+    """
+    header = json.dumps(header).encode("ascii")
+    header += b" " * (-(len(magic) + len(header) + 1) % 4) + b"\n"
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as mapped_file:
+        mapped_file.write(magic + header)
+        for section in sections: mapped_file.write(section)
+    os.replace(temporary_path, path)
+
+
+def open_mapped_file(path: str, magic: bytes, section_sizes) -> tuple:
+    """
+    Memory maps a file written by save_mapped_file, returning its header and a memoryview of each section.
+    section_sizes(header) gives the sections' lengths in bytes. Raises ValueError if the file has another magic
+    line or was cut short.
+    """
+    with open(path, "rb") as mapped_file:
+        if mapped_file.readline() != magic: raise ValueError(path)
+        header = json.loads(mapped_file.readline())
+        header_length = mapped_file.tell()
+        file_map = mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    sizes = section_sizes(header)
+
+    # Raise error if the file was cut short
+    if len(file_map) != header_length + sum(sizes): raise ValueError(path)
+
+    view, sections, start = memoryview(file_map), [], header_length
+    for size in sizes:
+        sections.append(view[start:start + size])
+        start += size
+
+    return header, sections
+
+
+class StateTable:
+    """
+    The composite substitution of one wiring (rotors, reflector and ring settings) at every rotor position, as
+    26 ** rotors states of 26 bytes: table[state * 26 + letter] -> letter, with letters as alphabet indices and the
+    state the positions read as a base 26 number ('A B C' -> 0 * 676 + 1 * 26 + 2).
+
+    A machine's rotors only ever pass through these states, so once built, encoding under this wiring is a lookup
+    per letter. Saved tables are opened as memory maps, so processes share one copy through the page cache.
+    """
+    MAGIC = b"ENIGMA-STATES\n"
+
+    def __init__(self, wiring_key: tuple, table, number_of_rotors: int) -> None:
+        self.wiring_key = wiring_key
+        self.table = table
+        self.number_of_rotors = number_of_rotors
+
+    @classmethod
+    def build(cls, enigma: object) -> object:
+        """
+        Walks every rotor position of the machine's wiring once. The machine is left where it was.
+        """
+        start_positions = [rotor.position_index for rotor in enigma.rotors]
+        rightmost_rotor = enigma.rotors[-1]
+
+        table = bytearray()
+        for static_positions in itertools.product(range(26), repeat=len(enigma.rotors) - 1):
+
+            # The rotors left of the rightmost fold into one virtual reflector for 26 states at a time
+            for rotor, position_index in zip(enigma.rotors, static_positions): rotor.position_index = position_index
+            virtual_reflector = enigma.virtual_reflector()
+
+            for position_index in range(26):
+                rightmost_rotor.position_index = position_index
+                table += bytes(rightmost_rotor.encode_index_left_to_right(virtual_reflector[rightmost_rotor.encode_index_right_to_left(idx)]) for idx in range(26))
+
+        enigma.set_positions(start_positions)
+        return cls(enigma.wiring_key(), bytes(table), len(enigma.rotors))
+
+    def state(self, positions) -> int:
+        """
+        State index of rotor positions given as alphabet indices, e.g. (0, 1, 2) -> 28
+        """
+        state = 0
+        for position_index in positions: state = state * 26 + position_index
+        return state
+
+    def save(self, path: str) -> None:
+        """
+        Writes the table after a one line JSON header recording the wiring it was built for.
+        """
+        save_mapped_file(path, self.MAGIC, [list(self.wiring_key[0]), self.wiring_key[1], list(self.wiring_key[2])], [self.table])
+
+    @classmethod
+    def open(cls, path: str) -> object:
+        """
+        Memory maps a table written by save. Raises ValueError if the file is not a state table.
+        """
+        header, (table,) = open_mapped_file(path, cls.MAGIC, lambda header: [26 ** (len(header[0]) + 1)])
+
+        rotor_mappings, reflector_mapping, ring_settings = header
+        return cls((tuple(rotor_mappings), reflector_mapping, tuple(ring_settings)), table, len(rotor_mappings))
+
+    @staticmethod
+    def file_name(enigma: object) -> str:
+        """
+        File name for a machine's table, e.g. 'I-II-III_B_01-02-03_<hash of the wiring>.states'.
+        The hash tells apart rewired reflectors that keep their name.
+        """
+        wiring_hash = hashlib.sha1(repr(enigma.wiring_key()).encode("utf-8")).hexdigest()[:12]
+        return "%s_%s_%s_%s.states" % (
+            "-".join(rotor.name for rotor in enigma.rotors),
+            enigma.reflector.name,
+            "-".join("%02d" % (rotor.ring_setting + 1) for rotor in enigma.rotors),
+            wiring_hash
+        )
+
+
+# Recently used state tables by wiring key. Each one is 26 ** (rotors + 1) bytes, so only a few are kept
+state_table_cache = CompositeTableCache(maxsize=8)
+
+
 class EnigmaMachine:
     def __init__(self, enigma_rotors: list, enigma_reflector: object, enigma_plugboard: object) -> None:
         self.rotors = enigma_rotors
         self.reflector = enigma_reflector
         self.plugboard = enigma_plugboard
 
+    def step(self) -> bool:
+        """
+        Rotates the rightmost rotor and cascades the rotation through any rotors on their notch.
+        Returns True if any rotor other than the rightmost rotated.
+        """
+        # 1. Rotate rightmost rotor
+        i = len(self.rotors) - 1
+        current_rotor = self.rotors[i]
+        rotor_was_on_notch = current_rotor.rotate()
+
+        # 2. If current rotor is on notch -> rotate inner rotor
+        while i != 0 and rotor_was_on_notch:
+            i -= 1
+            current_rotor = self.rotors[i]
+            rotor_was_on_notch = current_rotor.rotate()
+
+        return i != len(self.rotors) - 1
+
+    def set_positions(self, positions) -> None:
+        """
+        Moves the rotors to new positions in place, given as 'A B C' or as alphabet indices, e.g. (0, 1, 2).
+        """
+        if type(positions) == str: positions = [ALPHABET_INDEX[position] for position in positions.split(" ")]
+        if len(positions) != len(self.rotors): raise ValueError(positions)
+
+        for rotor, position_index in zip(self.rotors, positions):
+            rotor.position_index = position_index
+
+    def reset(self, spec: object) -> None:
+        """
+        Re-keys the machine in place from a MachineSpec. Nothing is allocated unless the rotor or reflector
+        names change, so a search can reuse one machine for every candidate key.
+        """
+        # 1. Swap rotors only if the spec uses a different number or order of them
+        if len(self.rotors) != len(spec.rotor_names):
+            self.rotors = [rotor_from_name(rotor_name) for rotor_name in spec.rotor_names]
+
+        for rotor, rotor_name, ring_setting, position_index in zip(self.rotors, spec.rotor_names, spec.ring_settings, spec.initial_positions):
+            if rotor.name != rotor_name or rotor.mapping is not ROTOR_BOX[rotor_name][0]:
+                rotor.name = rotor_name
+                rotor.mapping, rotor.notch_position = ROTOR_BOX[rotor_name]
+
+            rotor.ring_setting = ring_setting
+            rotor.position_index = position_index
+
+        # 2. The reflector may also have been rewired since it was built
+        if self.reflector.name != spec.reflector_name or self.reflector.mapping is not ROTOR_BOX[spec.reflector_name][0]:
+            self.reflector.name = spec.reflector_name
+            self.reflector.mapping, self.reflector.notch_position = ROTOR_BOX[spec.reflector_name]
+
+        # 3. Rewire the plugboard
+        self.plugboard.connections.clear()
+        self.plugboard.connections.update(spec.connections)
+
+    def encode_index_through_rotors(self, encrypted_idx: int) -> int:
+        """
+        Passes an alphabet index through the rotors, reflector and back at the current rotor positions.
+        """
+        # 1. Signal is passed through rightmost -> leftmost rotor
+        for rotor in self.rotors[::-1]:
+
+            # rotor receives signal on X1 pin and connects to Y1 contact
+            encrypted_idx = rotor.encode_index_right_to_left(encrypted_idx)
+
+        # 2. Leftmost rotor passes signal to reflector
+        encrypted_idx = self.reflector.encode_index_right_to_left(encrypted_idx)
+
+        # 3. Signal is passed back from leftmost -> rightmost rotor.
+        for rotor in self.rotors:
+
+            # rotor receives signal on Y2 contact and connects to X2 pin
+            encrypted_idx = rotor.encode_index_left_to_right(encrypted_idx)
+
+        return encrypted_idx
+
+    def virtual_reflector(self) -> list:
+        """
+        Folds every rotor left of the rightmost, together with the reflector, into one permutation of alphabet
+        indices. Those rotors only move at a turnover, so the (cached) permutation serves every keypress until then.
+        """
+        static_rotors = self.rotors[:-1]
+
+        key = (
+            tuple(rotor.mapping for rotor in static_rotors),
+            self.reflector.mapping,
+            tuple(rotor.ring_setting for rotor in static_rotors),
+            bytes([rotor.position_index for rotor in static_rotors])
+        )
+        table = virtual_reflector_cache.get(key)
+
+        if table is None:
+            table = []
+            for encrypted_idx in range(26):
+
+                # static rotors right -> left, reflector, static rotors left -> right
+                for rotor in static_rotors[::-1]: encrypted_idx = rotor.encode_index_right_to_left(encrypted_idx)
+                encrypted_idx = self.reflector.encode_index_right_to_left(encrypted_idx)
+                for rotor in static_rotors: encrypted_idx = rotor.encode_index_left_to_right(encrypted_idx)
+
+                table.append(encrypted_idx)
+
+            virtual_reflector_cache.put(key, table)
+
+        return table
+
+    def wiring_key(self) -> tuple:
+        """
+        Key identifying the rotor/reflector wiring and ring settings, which stay fixed while encoding.
+        """
+        return (
+            tuple(rotor.mapping for rotor in self.rotors),
+            self.reflector.mapping,
+            tuple(rotor.ring_setting for rotor in self.rotors)
+        )
+
+    def state_key(self, wiring_key: tuple = None) -> tuple:
+        """
+        Key identifying the wiring, ring settings and current rotor positions.
+        """
+        if wiring_key is None: wiring_key = self.wiring_key()
+        return (wiring_key, bytes([rotor.position_index for rotor in self.rotors]))
+
+    def composite_table(self, wiring_key: tuple = None) -> list:
+        """
+        Returns the 26-letter involution the rotors and reflector apply at the current state.
+        """
+        # Reuse the table if this state has been seen before
+        key = self.state_key(wiring_key)
+        table = composite_cache.get(key)
+
+        # Otherwise send every letter through the rotors once and remember the result
+        if table is None:
+            table = [ALPHABET[self.encode_index_through_rotors(idx)] for idx in range(26)]
+            composite_cache.put(key, table)
+
+        return table
+
+    def stepping_schedule(self, length: int) -> SteppingSchedule:
+        """
+        Returns the rotor positions at each of the next length characters, without moving the rotors.
+        """
+        # Keyed on the notches the rotors actually have, so renamed or re-notched rotors get their own schedule
+        return stepping_schedule(tuple(rotor.notch_index for rotor in self.rotors), tuple(rotor.position_index for rotor in self.rotors), length)
+
+    def encode_indices(self, indices):
+        """
+        Yields what each alphabet index (already through the plugboard) encodes to, stepping the rotors before
+        each one as a key press does. None only steps the rotors, e.g. past a letter nobody needs, and yields None.
+        encode, encode_characters, encode_into and find_crib all run through here.
+        """
+        # Only the rightmost rotor moves between turnovers - the rest are folded into the reflector
+        rightmost_rotor = self.rotors[-1]
+        right_to_left, left_to_right = rightmost_rotor.encode_index_right_to_left, rightmost_rotor.encode_index_left_to_right
+        step = self.step
+        virtual_reflector = self.virtual_reflector()
+
+        for encrypted_idx in indices:
+
+            # 1. Rotate the rotors before the signal passes through them. A turnover changes the folded rotors
+            if step(): virtual_reflector = self.virtual_reflector()
+
+            if encrypted_idx is None:
+                yield None
+                continue
+
+            # 2. Signal passes through the rightmost rotor, the virtual reflector and back
+            yield left_to_right(virtual_reflector[right_to_left(encrypted_idx)])
+
+    def plugboard_tables(self) -> tuple:
+        """
+        The plugboard as {letter: alphabet index} on the way in and [letter] by alphabet index on the way out.
+        """
+        connections = self.plugboard.connections
+        plugged = [connections.get(letter, letter) for letter in ALPHABET]
+        return {letter: ALPHABET_INDEX[plugged_letter] for letter, plugged_letter in zip(ALPHABET, plugged)}, plugged
+
     def encode(self, plaintext):
 
-        ciphertext = ''
+        # plugboard -> rotors and reflector -> plugboard
+        plugboard_in, plugboard_out = self.plugboard_tables()
+        return "".join(map(plugboard_out.__getitem__, self.encode_indices(map(plugboard_in.__getitem__, plaintext))))
+
+    def encode_characters(self, plaintext):
+        """
+        Yields the encoded characters one at a time, stepping exactly as encode does, so a caller can stop early.
+        """
+        plugboard_in, plugboard_out = self.plugboard_tables()
+        for encrypted_idx in self.encode_indices(map(plugboard_in.__getitem__, plaintext)): yield plugboard_out[encrypted_idx]
+
+    def encode_into(self, data: bytes, buffer: bytearray, start: int = 0, non_alphabet: str = "keep") -> int:
+        """
+        Encodes ASCII bytes into a preallocated buffer from index start, returning the index after the last byte
+        written. The rotors carry on from where they are, so a long message can be encoded a chunk at a time.
+        Bytes outside the alphabet are handled by the non_alphabet policy, see NON_ALPHABET_POLICIES.
+        """
+        if non_alphabet not in NON_ALPHABET_POLICIES: raise ValueError(non_alphabet)
+
+        # Plugboard as a table of alphabet indices
+        connections = self.plugboard.connections
+        plugboard = [ALPHABET_INDEX[connections.get(letter, letter)] for letter in ALPHABET]
+
+        end = start
+
+        def letters():
+            nonlocal end
+            for byte in data:
+                encrypted_idx = BYTE_INDEX[byte]
+                if encrypted_idx >= 0:
+                    yield plugboard[encrypted_idx]
+                    continue
+
+                # Apply the policy to bytes the machine cannot encode. They are reached in order, between letters
+                if non_alphabet == "error": raise ValueError(bytes([byte]))
+                if non_alphabet == "keep":
+                    buffer[end] = byte
+                    end += 1
+
+        for encrypted_idx in self.encode_indices(letters()):
+            buffer[end] = ALPHABET_BYTES[plugboard[encrypted_idx]]
+            end += 1
+
+        return end
+
+    def encode_composite(self, plaintext):
+        """
+        Same result as encode, but each rotor state is applied as one lookup in a cached composite table.
+        """
+        connections = self.plugboard.connections
+        wiring_key = self.wiring_key()
+
+        # Rotor states come from the shared stepping schedule rather than stepping character by character
+        schedule = self.stepping_schedule(len(plaintext))
+
+        ciphertext = []
+        for char_idx, char in enumerate(plaintext):
+
+            # 1. Look up the composite table for the rotor state at this character
+            state = schedule.state(char_idx)
+            table = composite_cache.get((wiring_key, state))
+
+            # Only a new state needs the rotors moved there to build its table
+            if table is None:
+                self.set_positions(state)
+                table = self.composite_table(wiring_key)
+
+            # 2. plugboard -> composite table -> plugboard
+            encrypted_char = table[ALPHABET_INDEX[connections.get(char, char)]]
+            ciphertext.append(connections.get(encrypted_char, encrypted_char))
+
+        # Leave the rotors where encode would have
+        if plaintext: self.set_positions(schedule.state(len(plaintext) - 1))
+
+        return "".join(ciphertext)
+
+    def state_table(self, directory: str = None) -> StateTable:
+        """
+        Returns the StateTable of the machine's wiring, building it on first use. With a directory, the table is
+        opened from there if a previous run saved it, and saved there otherwise.
+        """
+        wiring_key = self.wiring_key()
+        state_table = state_table_cache.get(wiring_key)
+        if state_table is not None: return state_table
+
+        path = None if directory is None else os.path.join(directory, StateTable.file_name(self))
+
+        if path is not None and os.path.exists(path):
+            state_table = StateTable.open(path)
+
+            # Raise error if the file was built for a different wiring
+            if state_table.wiring_key != wiring_key: raise ValueError(path)
+        else:
+            state_table = StateTable.build(self)
+            if path is not None: state_table.save(path)
+
+        state_table_cache.put(wiring_key, state_table)
+        return state_table
+
+    def encode_state_table(self, plaintext, state_table: StateTable = None):
+        """
+        Same result as encode, looking up each letter in the state table (the machine's own by default).
+        """
+        if state_table is None: state_table = self.state_table()
+        table = state_table.table
+
+        connections = self.plugboard.connections
+
+        ciphertext = []
         for char in plaintext:
 
-            # 1. Input plugboard encrypted character
-            encrypted_char = self.plugboard.encode(char)
+            # 1. Step, then find the state the rotors are in
+            self.step()
+            state = 0
+            for rotor in self.rotors: state = state * 26 + rotor.position_index
 
-            # 2. Rotate rightmost rotor
-            i = len(self.rotors) - 1
-            current_rotor = self.rotors[i]
-            rotor_was_on_notch = current_rotor.rotate()
+            # 2. plugboard -> state table -> plugboard
+            encrypted_char = ALPHABET[table[state * 26 + ALPHABET_INDEX[connections.get(char, char)]]]
+            ciphertext.append(connections.get(encrypted_char, encrypted_char))
 
-            # 3. If current rotor is on notch -> rotate inner rotor
-            while i != 0 and rotor_was_on_notch:
-                i -= 1
-                current_rotor = self.rotors[i]
-                rotor_was_on_notch = current_rotor.rotate()
+        return "".join(ciphertext)
+
+    def encode_character(self, char: str) -> str:
+        """
+        Encodes a single character, stepping the rotors exactly as encode does.
+        """
+        connections = self.plugboard.connections
+
+        self.step()
+        encrypted_char = ALPHABET[self.encode_index_through_rotors(ALPHABET_INDEX[connections.get(char, char)])]
+        return connections.get(encrypted_char, encrypted_char)
+
+    def find_crib(self, ciphertext: str, crib: str, offsets: list = None) -> list:
+        """
+        Returns the offsets, in ascending order, at which the ciphertext decrypts to the crib. Only the crib windows are decrypted,
+        stopping at the first mismatched letter, and each letter is decrypted at most once.
+        The machine is left at its starting positions.
+        """
+        if offsets is None: offsets = possible_crib_offsets(ciphertext, crib)
 
-            # 4. Signal is passed through rightmost -> leftmost rotor
-            for rotor in self.rotors[::-1]:
+        # The walk only moves forward, so offsets are taken once each in order
+        offsets = sorted(set(offsets))
 
-                # rotor receives signal on X1 pin and connects to Y1 contact
-                encrypted_char = rotor.encode_right_to_left(encrypted_char)
+        # Every window matches an empty crib, with nothing decrypted
+        if not crib: return offsets
 
-            # 5. Leftmost rotor passes signal to reflector
-            encrypted_char = self.reflector.encode_right_to_left(encrypted_char)
+        start_positions = [rotor.position_index for rotor in self.rotors]
 
-            # 6. Signal is passed back from leftmost -> rightmost rotor.
-            for rotor in self.rotors:
+        connections = self.plugboard.connections
 
-                # rotor receives signal on Y2 contact and connects to X2 pin
-                encrypted_char = rotor.encode_left_to_right(encrypted_char)
+        # Offsets whose crib windows are open and matching so far, and how many offsets have yet to open
+        live, opened = [], 0
 
-            # 7. Output plugboard encyption
-            encrypted_char = self.plugboard.encode(encrypted_char)
+        def needed_letters():
+            nonlocal opened
+            position = 0
+            while live or opened < len(offsets):
+                while opened < len(offsets) and offsets[opened] == position:
+                    live.append(offsets[opened])
+                    opened += 1
 
-            # 8. Add encoded character to ciphertext
-            ciphertext += encrypted_char
+                # Letters outside every open window are stepped past without being decrypted
+                cipher_char = ciphertext[position]
+                yield ALPHABET_INDEX[connections.get(cipher_char, cipher_char)] if live else None
+                position += 1
 
-        return ciphertext
+        found_offsets = []
+        for position, encrypted_idx in enumerate(self.encode_indices(needed_letters())):
+            if encrypted_idx is None: continue
+
+            encrypted_char = ALPHABET[encrypted_idx]
+            decrypted_char = connections.get(encrypted_char, encrypted_char)
+
+            # Close each window at its first mismatch, or once the whole crib has matched. Windows are the same
+            # length, so they finish in order
+            for offset in list(live):
+                if decrypted_char != crib[position - offset]:
+                    live.remove(offset)
+                elif position - offset == len(crib) - 1:
+                    live.remove(offset)
+                    found_offsets.append(offset)
+
+        # Put the machine back where it started
+        for rotor, position_index in zip(self.rotors, start_positions): rotor.position_index = position_index
+
+        return found_offsets
+
+
+def possible_crib_offsets(ciphertext: str, crib: str) -> list:
+    """
+    Returns the offsets the crib could sit at in the ciphertext. Enigma never encrypts a letter to itself,
+    so any offset lining a crib letter up with the same ciphertext letter is ruled out.
+    """
+    return [
+        offset for offset in range(len(ciphertext) - len(crib) + 1)
+        if all(crib_char != cipher_char for crib_char, cipher_char in zip(crib, ciphertext[offset:]))
+    ]
             
 
 def create_enigma_machine(names_of_rotors: list, reflector_name: str, ring_settings: str, initial_positions: str, plugboard_pairs: list = []) -> object:
@@ -266,12 +873,108 @@ def create_enigma_machine(names_of_rotors: list, reflector_name: str, ring_setti
 
     return EnigmaMachine(rotors, reflector, plugboard)
 
+
+# Parsers for the key strings, cached because searches see the same few strings over and over
+@lru_cache(maxsize=4096)
+def parse_rotor_names(names_of_rotors: str) -> tuple:
+    return tuple(names_of_rotors.split(" "))
+
+
+@lru_cache(maxsize=4096)
+def parse_ring_settings(ring_settings: str) -> tuple:
+    # Convert ring settings into a tuple of ints. '01 02 03' -> (0, 1, 2)
+    return tuple(int(ring_setting) - 1 for ring_setting in ring_settings.split(" "))
+
+
+@lru_cache(maxsize=4096)
+def parse_positions(initial_positions: str) -> tuple:
+    # Convert initial positions into a tuple of alphabet indices. 'A B C' -> (0, 1, 2)
+    return tuple(ALPHABET_INDEX[position] for position in initial_positions.split(" "))
+
+
+@lru_cache(maxsize=4096)
+def parse_plugboard(plugboard_pairs: tuple) -> tuple:
+    """
+    Validates plugboard pairs with PlugLead/Plugboard and returns its connections as ((a, b), (b, a), ...)
+    """
+    plugboard = Plugboard()
+    for pluglead_pair in plugboard_pairs:
+        plugboard.add(PlugLead(pluglead_pair))
+
+    return tuple(plugboard.connections.items())
+
+
+class MachineSpec:
+    """
+    A machine key parsed once: rotor names, reflector name, 0-based ring settings, start positions as
+    alphabet indices and plugboard pairs. Specs are immutable and hashable, so they can be cached.
+    """
+    __slots__ = ("rotor_names", "reflector_name", "ring_settings", "initial_positions", "plugboard_pairs", "connections", "_hash")
+
+    def __init__(self, rotor_names: tuple, reflector_name: str, ring_settings: tuple, initial_positions: tuple, plugboard_pairs: tuple = ()) -> None:
+
+        # Raise error if the settings do not give one ring setting and position per rotor
+        if not len(rotor_names) == len(ring_settings) == len(initial_positions): raise ValueError((rotor_names, ring_settings, initial_positions))
+
+        # Raise error for unknown rotors
+        rotor_names = tuple(rotor_names)
+        for rotor_name in rotor_names + (reflector_name,):
+            if rotor_name not in ROTOR_BOX: raise ValueError(rotor_name)
+
+        set_attribute = object.__setattr__
+        set_attribute(self, "rotor_names", rotor_names)
+        set_attribute(self, "reflector_name", reflector_name)
+        set_attribute(self, "ring_settings", tuple(ring_settings))
+        set_attribute(self, "initial_positions", tuple(initial_positions))
+        set_attribute(self, "plugboard_pairs", tuple(plugboard_pairs))
+        set_attribute(self, "connections", parse_plugboard(self.plugboard_pairs))
+        set_attribute(self, "_hash", hash(self.key()))
+
+    @classmethod
+    def parse(cls, names_of_rotors: str, reflector_name: str, ring_settings: str, initial_positions: str, plugboard_pairs: list = []) -> object:
+        """
+        Builds a spec from the same strings create_enigma_machine takes. Invalid plug leads raise ValueError/TypeError.
+        """
+        return cls(parse_rotor_names(names_of_rotors), reflector_name, parse_ring_settings(ring_settings), parse_positions(initial_positions), tuple(plugboard_pairs))
+
+    def key(self) -> tuple:
+        return (self.rotor_names, self.reflector_name, self.ring_settings, self.initial_positions, self.plugboard_pairs)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(name)
+
+    def __reduce__(self) -> tuple:
+        # Rebuilt through __init__, as the slots cannot be set afterwards and the hash differs between processes
+        return (MachineSpec, self.key())
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MachineSpec) and self.key() == other.key()
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __repr__(self) -> str:
+        return "MachineSpec(%r, %r, %r, %r, %r)" % self.key()
+
+
+def machine_from_spec(spec: MachineSpec) -> object:
+    """
+    Builds a new enigma machine from a spec. To re-key an existing machine use EnigmaMachine.reset instead.
+    """
+    rotors = [rotor_from_name(rotor_name) for rotor_name in spec.rotor_names]
+    enigma = EnigmaMachine(rotors, rotor_from_name(spec.reflector_name), Plugboard())
+    enigma.reset(spec)
+    return enigma
+
 # # Part 2 : functions to implement to demonstrate code breaking.
 # # each function should return a list of all the possible answers
 # # code_one provides an example of how you might declare variables and the return type
 
 
-def code_one():
+def code_one(checkpoint: str = None, processes: int = None):
+
+    # The search engine imports this module, so it is imported here rather than at the top
+    from enigma_search import KeySpace, CribPredicate, search_messages
 
     # Define code we're looking at and crib included
     code = "DMEXBMKYCVPNQBEDHXVPZGKMTFFBJRPJTLHLCHOTKOYXGGHZ"
@@ -283,21 +986,16 @@ def code_one():
     initial_positions = "M J M"
     plugboard = ["KI", "FL", "XN"]
 
-    # Possible messages - if crib is in encoded list
-    possible_messages = []
-
     # Try all reflectors in the enigma machine
-    for reflector in ["A", "B", "C"]:
-        enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard)
-        possible_message = enigma.encode(code)
+    keyspace = KeySpace([rotors], ["A", "B", "C"], [ring_settings], [initial_positions], [plugboard])
 
-        if crib in possible_message:
-            possible_messages.append(possible_message)
+    # Possible messages - if crib is in encoded list
+    return search_messages(keyspace, code, CribPredicate([crib]), processes=processes, checkpoint=checkpoint)
 
-    return possible_messages
 
+def code_two(checkpoint: str = None, processes: int = None):
 
-def code_two():
+    from enigma_search import KeySpace, CribPredicate, all_initial_positions, search_messages
 
     # Define code we're looking at and crib included
     code = "CMFSUPKNCBMUYEQVVDYKLRQZTPUFHSWWAKTUGXMPAMYAFITXIJKMH"
@@ -309,37 +1007,23 @@ def code_two():
     ring_settings = "23 02 10"
     plugboard = ["VH", "PT", "ZG", "BJ", "EY", "FS"]
 
-    # Possible messages - if crib is in encoded list
-    possible_messages = []
-
     # Try all combos of P1 P2 P3 [1-26] (inclusive)
-    for p1 in range(26):
-        for p2 in range(26):
-            for p3 in range(26):
+    keyspace = KeySpace([rotors], [reflector], [ring_settings], all_initial_positions(3), [plugboard])
 
-                # create initial position from p1, p2, p3
-                initial_positions = ALPHABET[p1] + " " + ALPHABET[p2] + " " + ALPHABET[p3]
+    # Neighbouring start positions share most rotor states, so use the composite table engine
+    return search_messages(keyspace, code, CribPredicate([crib], anchored=True), processes=processes, composite=True, checkpoint=checkpoint)
 
-                # create enigma based off 
-                enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard)
-                possible_message = enigma.encode(code)
 
-                # check if crib in message
-                if crib in possible_message:
-                    possible_messages.append(possible_message)
-
-    return possible_messages
-
-
-def code_three():
+def code_three_search() -> tuple:
+    """
+    The keyspace, ciphertext, predicate and composite flag code_three searches, e.g. to shard it across machines.
+    """
+    from enigma_search import KeySpace, CribPredicate
 
     # Define code we're looking at and crib included
     code = "ABSKJAKKMRITTNYURBJFWQGRSGNNYJSDRYLAPQWIAGKJYEPCTAGDCTHLCDRZRFZHKNRSDLNPFPEBVESHPY"
     crib = "THOUSANDS"
 
-    # Possible messages - if crib is in encoded list
-    possible_messages = []
-
     # Define known enigma settings
     initial_positions = "E M Y"
     plugboard_pairs = ["FH", "TS", "BE", "UQ", "KD", "AL"]
@@ -351,41 +1035,33 @@ def code_three():
     rotor_choices = ['II', 'IV', 'Beta', 'Gamma']
 
     combinations_of_rotors = [" ".join([r1, r2, r3]) for r1 in rotor_choices for r2 in rotor_choices for r3 in rotor_choices]
+    combinations_of_ring_settings = [" ".join([p1, p2, p3]) for p1 in possible_ring_setting for p2 in possible_ring_setting for p3 in possible_ring_setting]
 
-    # Try every combination of rotor
-    for rotors in combinations_of_rotors:
+    # Try every combination of rotor, every reflector and every combination of ring settings
+    keyspace = KeySpace(combinations_of_rotors, ["A", "B", "C"], combinations_of_ring_settings, [initial_positions], [plugboard_pairs])
 
-        # Try every reflector
-        for reflector in ["A", "B", "C"]:
+    # Only decrypt the crib window until a machine survives it
+    return keyspace, code, CribPredicate([crib], anchored=True), False
 
-            # Try all combos of P1 P2 P3 [1-26] (inclusive)
-            for p1 in possible_ring_setting:
-                for p2 in possible_ring_setting:
-                    for p3 in possible_ring_setting:
 
-                        # create initial position from p1, p2, p3
-                        ring_settings = p1 + " " + p2 + " " + p3
+def code_three(checkpoint: str = None, processes: int = None):
 
-                        # create enigma based off 
-                        enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard_pairs)
-                        possible_message = enigma.encode(code)
+    from enigma_search import search_messages
 
-                        # check if crib in message
-                        if crib in possible_message:
-                            possible_messages.append(possible_message)
-    
-    return possible_messages
+    keyspace, code, accept, composite = code_three_search()
+    return search_messages(keyspace, code, accept, processes=processes, composite=composite, checkpoint=checkpoint)
 
 
-def code_four():
+def code_four_search() -> tuple:
+    """
+    The keyspace, ciphertext, predicate and composite flag code_four searches.
+    """
+    from enigma_search import KeySpace, CribPredicate
 
     # Define code we're looking at and crib included
     code = "SDNTVTPHRBNWTLMZTQKZGADDQYPFNHBPNHCQGBGMZPZLUAVGDQVYRBFYYEIXQWVTHXGNW"
     crib = "TUTOR"
 
-    # Possible messages - if crib is in encoded list
-    possible_messages = []
-
     # Define known settings of enigma machine
     rotors = "V III IV"
     reflector = "A"
@@ -396,147 +1072,97 @@ def code_four():
     pluglead_pairs = ["WP", "RJ", "VF", "HN", "CG", "BS"]
     unknown_connections = ["A", "I"]
 
-    # Create a list of possible connections for 'A' and 'I'
-    possible_letters_for_a = []
-    for letter in ALPHABET:
+    # possible connections for A and I are those not already plugged in
+    possible_letters = [letter for letter in ALPHABET if letter not in unknown_connections and letter not in "".join(pluglead_pairs)]
 
-        # possible connections for A and I are those not already plugged in
-        if letter not in unknown_connections and letter not in "".join(pluglead_pairs):
-            possible_letters_for_a.append(letter)
-    
-    # Try possible connections for the unknknown side of the pair [A?, I?] 
-    for unknown_side in possible_letters_for_a:
+    # Try possible connections for the unknown side of the pairs [A?, I?], each letter used once
+    possible_plugboards = [
+        pluglead_pairs + ["A" + letter_for_a, "I" + letter_for_i]
+        for letter_for_a in possible_letters for letter_for_i in possible_letters if letter_for_i != letter_for_a
+    ]
 
-        # Add connection to end of plugboard pairs
-        possible_pair = "A" + unknown_side
-        pluglead_pairs.append(possible_pair)
+    keyspace = KeySpace([rotors], [reflector], [ring_settings], [initial_positions], possible_plugboards)
 
-        # Remove used connection before trying again
-        possible_letters_for_i = possible_letters_for_a.copy()
-        possible_letters_for_i.remove(unknown_side)
+    # The rotor states are the same for every plugboard, so use the composite table engine
+    return keyspace, code, CribPredicate([crib], anchored=True), True
 
-        for unknown_side in possible_letters_for_i:
 
-            # Add connection to end of plugboard pairs
-            possible_pair = "I" + unknown_side
-            pluglead_pairs.append(possible_pair)
+def code_four(checkpoint: str = None, processes: int = None):
 
-            # Try enigma machine
-            enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, pluglead_pairs)
-            possible_message = enigma.encode(code)
+    from enigma_search import search_messages
 
-            # check if crib in message
-            if crib in possible_message:
-                possible_messages.append(possible_message)
+    keyspace, code, accept, composite = code_four_search()
+    return search_messages(keyspace, code, accept, processes=processes, composite=composite, checkpoint=checkpoint)
 
-            pluglead_pairs.pop()
 
-        pluglead_pairs.pop()
+def pairings(items: tuple):
+    """
+    Every way to split the items into pairs, e.g. (a, b, c, d) -> [(a, b), (c, d)], [(a, c), (b, d)], [(a, d), (b, c)]
+    """
+    if not items:
+        yield []
+        return
 
-    return possible_messages
+    # The first item goes with each of the others in turn, and the rest are paired up recursively
+    first, rest = items[0], items[1:]
+    for i, partner in enumerate(rest):
+        for remaining_pairs in pairings(rest[:i] + rest[i + 1:]):
+            yield [(first, partner)] + remaining_pairs
 
 
+def reflector_rewirings(reflector_name: str, number_of_pairs: int = 4):
+    """
+    Yields every way to swap the wires between pairs of the reflector's connections, choosing an even
+    number_of_pairs connections and swapping them two at a time. Each rewiring is a list of the new letter
+    pairs, e.g. [('A', 'B'), ...]
+    """
+    if number_of_pairs % 2: raise ValueError(number_of_pairs)
+
+    # 1. Create all pairs in reflector (a, b) with a < b
+    original_reflector = rotor_from_name(reflector_name)
+    original_pairs = sorted({tuple(sorted([letter, original_reflector.encode_right_to_left(letter)])) for letter in ALPHABET})
+
+    # 2. Get every combination of choosing the pairs out of 13
+    for chosen_pairs in itertools.combinations(original_pairs, number_of_pairs):
+
+        # 3. Get every way to group the chosen pairs into pairs of wires to swap
+        for wire_pairings in pairings(chosen_pairs):
 
-def code_five():
+            # 4. 2 ways to swap each pair of wires (a1, a2), (b1, b2): a1 <-> b1 and a2 <-> b2, or a1 <-> b2 and a2 <-> b1
+            for swap_choices in itertools.product([False, True], repeat=len(wire_pairings)):
+                rewiring = []
+                for ((a1, a2), (b1, b2)), crossed in zip(wire_pairings, swap_choices):
+                    rewiring += [(a1, b2), (a2, b1)] if crossed else [(a1, b1), (a2, b2)]
+
+                yield rewiring
+
+
+def code_five(checkpoint: str = None):
+
+    from enigma_search import ReflectorSearch
 
     # Define code we're looking at and crib included
     code = "HWREISXLGTTBYVXRCWWJAKZDTVZWKBDJPVQYNEQIOTIFX"
     cribs = ["INSTAGRAM", "FACEBOOK", "TWITTER"]
 
-    # Possible messages - if crib is in encoded list
-    possible_messages = []
-
     # Define known engigma attributes / settings
     rotors = "V II IV"
     ring_settings = "06 18 07"
     initial_positions = "A J L"
     plugboard_pairs = ["UG", "IE", "PO", "NX", "WT"]
 
-    for reflector_name in ["A", "B", "C"]:
-
-        # 1. Create all pairs in reflector
-        original_reflector = rotor_from_name(reflector_name)
-        original_pairs = set()
-
-        for letter in ALPHABET:
-
-            # Create pair as a set so order doesn't matter {a, b} = {b, a}
-            pair = frozenset([letter, original_reflector.encode_right_to_left(letter)])
-
-            # if {b, a} not in pairs, add (a, b)
-            if pair not in original_pairs:
-                original_pairs.add(tuple(pair))
-
-        # 2. Get every combination of choosing 4 pairs out of 13
-        chosen_pairs_list = list(itertools.combinations(original_pairs, 4))
-
-        for chosen_pairs in chosen_pairs_list:
-
-            # Get every order of the 4 chosen pairs
-            combinations_of_wire_pairings = [
-
-                # pair of wires 1
-                ((chosen_pairs[i], chosen_pairs[j]),
-
-                # pair of wires 2
-                tuple([x for idx, x in enumerate(chosen_pairs) if idx not in (i, j)]))
-
-                for i in range(len(chosen_pairs)) for j in range(i + 1, len(chosen_pairs))
-            ]
-
-            # Swap the wires for every order of pairs
-            for combination_of_wires in combinations_of_wire_pairings:
-                
-                # Now swap wirings
-                (pairA, pairB), (pairX, pairY) = combination_of_wires
-
-                # Unwire wires A and B
-                a1, a2 = pairA
-                b1, b2 = pairB
-
-                # Unwire wires X and Y
-                x1, x2 = pairX
-                y1, y2 = pairY
-
-                # 4 ways to swap pair wirings
-                swapped_pairs_configurations = [
-                    [(a1, b1), (a2, b2), (x1, y1), (x2, y2)], # 1
-                    [(a1, b1), (a2, b2), (x1, y2), (x2, y1)], # 2
-                    [(a1, b2), (a2, b1), (x1, y1), (x2, y2)], # 3
-                    [(a1, b2), (a2, b1), (x1, y2), (x2, y1)] # 4
-                ]
-
-                for swapped_wires in swapped_pairs_configurations:
-
-                    # Input regular reflector
-                    enigma = create_enigma_machine(rotors, reflector_name, ring_settings, initial_positions, plugboard_pairs)
-
-                    # Rewire reflector
-                    rewired_reflector_mapping = list(enigma.reflector.mapping)
-
-                    for new_wiring in swapped_wires:
-                        
-                        # Get the pair to wire
-                        char1, char2 = new_wiring
+    # The rotor passes either side of the reflector are the same for every rewiring, so they are worked out once
+    reflector_search = ReflectorSearch(code, rotors, ring_settings, initial_positions, plugboard_pairs)
 
-                        # Get their mapping in the alphabet
-                        char1_idx = ALPHABET.index(char1)
-                        char2_idx = ALPHABET.index(char2)
-                        
-                        # Update wiring to reflector
-                        rewired_reflector_mapping[char1_idx] = char2
-                        rewired_reflector_mapping[char2_idx] = char1
+    # Try every reflector, swapping 4 of its pairs. Check if any of the cribs in message
+    possible_messages = []
+    for reflector_name in ["A", "B", "C"]:
 
-                    # Add new reflector to enigma machine
-                    enigma.reflector.mapping = "".join(rewired_reflector_mapping)
-                    
-                    # Encode message
-                    possible_message = enigma.encode(code)
+        # Each reflector is a separate search, so it keeps its own progress file
+        reflector_checkpoint = None if checkpoint is None else checkpoint + "." + reflector_name
 
-                    # Check if any of the cribs in message
-                    for crib in cribs:
-                        if crib in possible_message:
-                            possible_messages.append(possible_message)
+        for rewiring, possible_message in reflector_search.search(reflector_name, cribs, number_of_pairs=4, checkpoint=reflector_checkpoint):
+            possible_messages.append(possible_message)
 
     return possible_messages
 
@@ -606,3 +1232,63 @@ if __name__ == "__main__":
     # Set enigma back to original settings
     enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, [])
     assert(enigma.encode(encoded_message) == test_word)
+
+    # --------------  TEST 5 ----------------------------------
+
+    # Encoding bytes a chunk at a time into a buffer gives the same result, skipping non-letters under "keep"
+
+    plugboard = ["HL", "MO", "AJ", "CX", "BZ", "SR", "NI", "YW", "DG", "PK"]
+    message = "THEQUICKBROWNFOXJUMPSOVERTHELAZYDOG" * 30
+    expected = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard).encode(message)
+
+    enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard)
+    buffer, end = bytearray(2 * len(message)), 0
+    for start in range(0, len(message), 7):
+        end = enigma.encode_into(message[start:start + 7].encode("ascii") + b" ", buffer, end)
+
+    assert(buffer[:end].replace(b" ", b"").decode("ascii") == expected)
+
+    # --------------  TEST 6 ----------------------------------
+
+    # Encoding through the full-cycle state table matches encode, from a table saved to disk and opened again
+
+    import tempfile
+
+    enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard)
+    with tempfile.TemporaryDirectory() as directory:
+        enigma.state_table(directory)
+        state_table_cache.clear()
+        assert(enigma.encode_state_table(message, enigma.state_table(directory)) == expected)
+
+    # --------------  TEST 7 ----------------------------------
+
+    # Crib offsets in any order, or repeated, find every match once
+    plaintext = "XXXXXXXXXXWETTERXXXXXWETTERXX"
+    ciphertext = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard).encode(plaintext)
+    enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, plugboard)
+    assert(enigma.find_crib(ciphertext, "WETTER", [21, 10]) == [10, 21])
+    assert(enigma.find_crib(ciphertext, "WETTER", [10, 10]) == [10])
+
+    # --------------  TEST 8 ----------------------------------
+
+    # The composite engine follows the machine's own rotors: one missing from ROTOR_BOX, and one re-notched
+    message = "THEQUICKBROWNFOXJUMPSOVERTHELAZYDOG" * 25
+    for notch_position in ["Q", "A"]:
+        machines = []
+        for _ in range(2):
+            enigma = create_enigma_machine("I II III", "B", "01 01 01", "A A Z", plugboard)
+            enigma.rotors[-1] = Rotor("X", "QWERTZUIOASDFGHJKPYXCVBNML", "E")
+            enigma.rotors[1].notch_position = notch_position
+            machines.append(enigma)
+
+        assert(machines[0].encode(message) == machines[1].encode_composite(message))
+
+    # --------------  TEST 9 ----------------------------------
+
+    # Specs survive pickling and copying as equal values that build the same machine, from tuples or lists
+    import copy, pickle
+
+    spec = MachineSpec.parse("I II III", "B", "01 01 01", "A A Z", plugboard)
+    for spec_copy in [pickle.loads(pickle.dumps(spec)), copy.copy(spec), copy.deepcopy(spec), MachineSpec(list(spec.rotor_names), "B", spec.ring_settings, spec.initial_positions, spec.plugboard_pairs)]:
+        assert(spec_copy == spec and hash(spec_copy) == hash(spec))
+        assert(machine_from_spec(spec_copy).encode(message) == machine_from_spec(spec).encode(message))
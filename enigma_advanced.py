@@ -1,49 +1,62 @@
-import re, itertools, random
+import re, itertools, json, random
 
 # Define global constants: the character set we will be enocding
 CHARACTER_SET = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz1234567890 *,.()[]#@+-=_\/'^%$£!?<>:;`“”^|"
 
+# Character -> index in the character set, e.g. 'C' -> 2. '^' appears twice, so like CHARACTER_SET.index it maps to the first
+CHARACTER_INDEX = {character: index for index, character in reversed(list(enumerate(CHARACTER_SET)))}
+
+# Index -> index of the first occurrence of the same character, so integer positions follow the character based rules
+CANONICAL_INDEX = [CHARACTER_INDEX[character] for character in CHARACTER_SET]
+
 class RotorBox:
-    def __init__(self) -> None:
+    def __init__(self, seed: int = None) -> None:
+        """
+        Builds random wiring for every rotor and reflector. The same seed always gives the same wiring; without one
+        the global random module is used, as before.
+        """
+        rng = random if seed is None else random.Random(seed)
+        self.seed = seed
+
         # Create temporary dictionary for rotors
         self.items = {}
 
         # Add rotors to box
-        existing_mappings = []
+        existing_mappings = set()
         for rotor_name in ["I", "II", "III", "IV", "V", "Beta", "Gamma"]:
 
             # Pick notch randomly and shuffle alphabet to create mapping
-            mapping = random.sample(CHARACTER_SET, len(CHARACTER_SET))
+            mapping = rng.sample(CHARACTER_SET, len(CHARACTER_SET))
 
             # Ensure the mapping hasn't been created before
-            while mapping in existing_mappings:
+            while "".join(mapping) in existing_mappings:
 
                 # Pick notch randomly and shuffle alphabet to create mapping
-                mapping = random.sample(CHARACTER_SET, len(CHARACTER_SET))
+                mapping = rng.sample(CHARACTER_SET, len(CHARACTER_SET))
 
-            existing_mappings.append(mapping)
+            existing_mappings.add("".join(mapping))
 
             # Beta and gamma do not have notches
             if rotor_name in ["Beta", "Gamma"]:
                 notch = None
             else:
-                notch = random.sample(CHARACTER_SET, 1)
+                notch = rng.sample(CHARACTER_SET, 1)
 
             # Add rotor to box
             self.items[rotor_name] = ("".join(mapping), notch)
 
         # Add reflectors to box
-        existing_positions = []
+        existing_positions = set()
         for reflector_name in ["A", "B", "C"]:
 
             # Create a shuffled list of all the positions between 0 - extended character set
             positions = list(range(len(CHARACTER_SET)))
-            random.shuffle(positions)
+            rng.shuffle(positions)
 
-            while positions in existing_positions:
-                random.shuffle(positions)
+            while tuple(positions) in existing_positions:
+                rng.shuffle(positions)
 
-            existing_positions.append(positions)
+            existing_positions.add(tuple(positions))
 
             # Create the reflector mapping
             reflector_mapping = list(CHARACTER_SET)
@@ -63,6 +76,55 @@ class RotorBox:
             # Add reflector to box
             self.items[reflector_name] = (reflector_mapping, None)
 
+        self.tables = self.build_tables()
+
+    def build_tables(self) -> dict:
+        """
+        Forward and inverse tables of every rotor and reflector, shared by every Rotor built from the box.
+        """
+        tables = {}
+        for rotor_name, (rotor_mapping, rotor_notch_position) in self.items.items():
+            rotor = Rotor(rotor_name, rotor_mapping, rotor_notch_position)
+            tables[rotor_name] = (rotor.forward, rotor.inverse)
+
+        return tables
+
+    def export(self, path: str) -> None:
+        """
+        Writes the wiring, with its forward and inverse tables, to a JSON file that RotorBox.load reads back.
+        """
+        wiring = {
+            "character_set": CHARACTER_SET,
+            "seed": self.seed,
+            "items": {
+                rotor_name: {"mapping": rotor_mapping, "notch": rotor_notch_position, "forward": self.tables[rotor_name][0], "inverse": self.tables[rotor_name][1]}
+                for rotor_name, (rotor_mapping, rotor_notch_position) in self.items.items()
+            }
+        }
+
+        with open(path, "w") as wiring_file:
+            json.dump(wiring, wiring_file)
+
+    @classmethod
+    def load(cls, path: str) -> object:
+        """
+        Reads a box written by export without rebuilding any wiring or tables.
+        """
+        with open(path) as wiring_file:
+            wiring = json.load(wiring_file)
+
+        # Raise error if the tables were built for a different character set
+        if wiring["character_set"] != CHARACTER_SET: raise ValueError(path)
+
+        rotor_box = cls.__new__(cls)
+        rotor_box.seed = wiring["seed"]
+        rotor_box.items, rotor_box.tables = {}, {}
+        for rotor_name, rotor in wiring["items"].items():
+            rotor_box.items[rotor_name] = (rotor["mapping"], rotor["notch"])
+            rotor_box.tables[rotor_name] = (rotor["forward"], rotor["inverse"])
+
+        return rotor_box
+
     def rotor_from_name(self, rotor_name: str) -> object:
         """
         Method which returns a Rotor object the given name of the Rotor e.g. I or Gamma.
@@ -71,11 +133,31 @@ class RotorBox:
         rotor_mapping, rotor_notch_position = self.items[rotor_name]
 
         # Return the resulting rotor object
-        return Rotor(rotor_name, rotor_mapping, rotor_notch_position)
+        return Rotor(rotor_name, rotor_mapping, rotor_notch_position, self.tables[rotor_name])
+
+
+# The global rotor box is built on first use, so importing the module does no work
+_rotor_box = None
+
 
+def get_rotor_box() -> RotorBox:
+    global _rotor_box
+    if _rotor_box is None: _rotor_box = RotorBox()
+    return _rotor_box
 
-# define rotor box as a global variable
-rotor_box = RotorBox()
+
+def set_rotor_box(rotor_box: RotorBox) -> None:
+    """
+    Replaces the global rotor box, e.g. set_rotor_box(RotorBox(seed=1)) or set_rotor_box(RotorBox.load(path)).
+    """
+    global _rotor_box
+    _rotor_box = rotor_box
+
+
+def __getattr__(name: str):
+    # Keeps enigma_advanced.rotor_box working while building it lazily
+    if name == "rotor_box": return get_rotor_box()
+    raise AttributeError(name)
 
 
 class PlugLead:
@@ -145,73 +227,102 @@ class Plugboard:
 
 
 class Rotor:
-    def __init__(self, rotor_name, rotor_mapping, rotor_notch_position):
+    def __init__(self, rotor_name, rotor_mapping, rotor_notch_position, tables: tuple = None):
 
-        # Define default attributes from rotor_name
+        # Define default attributes from rotor_name, reusing (forward, inverse) tables if they were worked out already
         self.name = rotor_name
-        self.mapping = rotor_mapping
+        if tables is None:
+            self.mapping = rotor_mapping
+        else:
+            self._mapping = rotor_mapping
+            self.forward, self.inverse = tables
         self.notch_position = rotor_notch_position
 
-        # Declare custom attributes
-        self.position = "A"
+        # Declare custom attributes: position and ring setting are kept as character set indices
+        self.position_index = 0
         self.ring_setting = 0
 
-    def encode_right_to_left(self, character):
+    @property
+    def mapping(self) -> str:
+        return self._mapping
+
+    @mapping.setter
+    def mapping(self, rotor_mapping: str) -> None:
         """
-        Alphabet |-> Mapping
+        Stores the wiring and precomputes its forward and inverse integer tables.
         """
-        # 1. Find the position of the character in the alphabet
-        alphabet_index = CHARACTER_SET.index(character)
+        self._mapping = rotor_mapping
 
-        # 2. Find the no. places the rotor has been shifted
-        offset = CHARACTER_SET.index(self.position) - self.ring_setting       
+        # forward[pin] -> contact
+        self.forward = [CHARACTER_INDEX[contact] for contact in rotor_mapping]
 
-        # 3. Get the index of the current pin
-        pin_index = (alphabet_index + offset) % len(CHARACTER_SET)
+        # inverse[contact] -> pin, the first pin wired to that character as mapping.index(...) would find
+        first_pin = {contact: pin for pin, contact in reversed(list(enumerate(rotor_mapping)))}
+        self.inverse = [first_pin[character] for character in CHARACTER_SET]
 
-        # 4. Find the contact of the current rotor 
-        current_contact = self.mapping[pin_index]
+    @property
+    def notch_position(self):
+        return self._notch_position
 
-        # 5. Translate the contact back to the correct pin for the next rotor
-        next_contact_index = (CHARACTER_SET.index(current_contact) - offset) % len(CHARACTER_SET)
+    @notch_position.setter
+    def notch_position(self, rotor_notch_position) -> None:
+        self._notch_position = rotor_notch_position
 
-        # 6. Return the contact for the next rotor
-        return CHARACTER_SET[next_contact_index]
+        # A turnover needs the position to equal the notch character, so anything else (None, a list) never turns over
+        self.notch_index = CHARACTER_INDEX.get(rotor_notch_position, -1) if type(rotor_notch_position) == str else -1
 
-    def encode_left_to_right(self, character):
+    @property
+    def position(self) -> str:
+        return CHARACTER_SET[self.position_index]
+
+    @position.setter
+    def position(self, position: str) -> None:
+        # Positions are only set when a machine is built, so the same str.index rules as before apply
+        self.position_index = CHARACTER_SET.index(position)
+
+    def encode_index_right_to_left(self, character_index: int) -> int:
         """
-        Mapping |-> Alphabet
+        Alphabet |-> Mapping, on character set indices.
         """
-        # 1. Find the position of the current character in the alphabet
-        alphabet_index = CHARACTER_SET.index(character)
+        # Find the no. places the rotor has been shifted
+        offset = self.position_index - self.ring_setting
 
-        #2. Find the no. places the rotor has been shifted
-        offset = CHARACTER_SET.index(self.position) - self.ring_setting
+        # Look up the contact of the current pin and translate it back for the next rotor
+        return CANONICAL_INDEX[(self.forward[(character_index + offset) % len(CHARACTER_SET)] - offset) % len(CHARACTER_SET)]
 
-        # 3. Get the index of the current contact
-        contact_index = (alphabet_index + offset) % len(CHARACTER_SET)
+    def encode_index_left_to_right(self, character_index: int) -> int:
+        """
+        Mapping |-> Alphabet, on character set indices.
+        """
+        # Find the no. places the rotor has been shifted
+        offset = self.position_index - self.ring_setting
 
-        # 4. Find the pin for the current rotor's contact
-        current_pin = CHARACTER_SET[contact_index]
+        # Look up the pin of the current contact and translate it back for the next rotor
+        return CANONICAL_INDEX[(self.inverse[(character_index + offset) % len(CHARACTER_SET)] - offset) % len(CHARACTER_SET)]
 
-        # 5. Translate the pin back to the correct pin for the next rotor
-        next_pin_index = (self.mapping.index(current_pin) - offset) % len(CHARACTER_SET)
+    def encode_right_to_left(self, character):
+        """
+        Alphabet |-> Mapping
+        """
+        if character not in CHARACTER_INDEX: raise ValueError(character)
+        return CHARACTER_SET[self.encode_index_right_to_left(CHARACTER_INDEX[character])]
 
-        # 6. Return the pin for the next rotor
-        return CHARACTER_SET[next_pin_index]
+    def encode_left_to_right(self, character):
+        """
+        Mapping |-> Alphabet
+        """
+        if character not in CHARACTER_INDEX: raise ValueError(character)
+        return CHARACTER_SET[self.encode_index_left_to_right(CHARACTER_INDEX[character])]
 
     def rotate(self) -> bool:
         """
         Updates the position of a rotor after rotation. If the last position  a notch, function returns True.
         """
         # Create a variable to remember whether the last position was a notch
-        notch_was_rotated = self.position == self.notch_position
+        notch_was_rotated = self.position_index == self.notch_index
 
         # move the rotor one position up | if this is the last position-> loop back to 0
-        alphabet_index = (CHARACTER_SET.index(self.position) + 1) % len(CHARACTER_SET)
-        
-        # Update the new position after rotation
-        self.position = CHARACTER_SET[alphabet_index]
+        self.position_index = CANONICAL_INDEX[(self.position_index + 1) % len(CHARACTER_SET)]
 
         # Indicate whether the notch has been rotated
         return notch_was_rotated
@@ -225,7 +336,7 @@ class EnigmaMachine:
 
     def encode(self, plaintext):
 
-        ciphertext = ''
+        ciphertext = []
         for char in plaintext:
 
             # 1. Input plugboard encrypted character
@@ -242,29 +353,33 @@ class EnigmaMachine:
                 current_rotor = self.rotors[i]
                 rotor_was_on_notch = current_rotor.rotate()
 
+            # Raise error for characters outside the character set
+            if encrypted_char not in CHARACTER_INDEX: raise ValueError(encrypted_char)
+            encrypted_idx = CHARACTER_INDEX[encrypted_char]
+
             # 4. Signal is passed through rightmost -> leftmost rotor
             for rotor in self.rotors[::-1]:
 
                 # rotor receives signal on X1 pin and connects to Y1 contact
-                encrypted_char = rotor.encode_right_to_left(encrypted_char)
+                encrypted_idx = rotor.encode_index_right_to_left(encrypted_idx)
 
             # 5. Leftmost rotor passes signal to reflector
-            encrypted_char = self.reflector.encode_right_to_left(encrypted_char)
+            encrypted_idx = self.reflector.encode_index_right_to_left(encrypted_idx)
 
             # 6. Signal is passed back from leftmost -> rightmost rotor.
             for rotor in self.rotors:
 
                 # rotor receives signal on Y2 contact and connects to X2 pin
-                encrypted_char = rotor.encode_left_to_right(encrypted_char)
+                encrypted_idx = rotor.encode_index_left_to_right(encrypted_idx)
 
             # 7. Output plugboard encyption
-            encrypted_char = self.plugboard.encode(encrypted_char)
+            encrypted_char = self.plugboard.encode(CHARACTER_SET[encrypted_idx])
 
             # 8. Add encoded character to ciphertext
-            ciphertext += encrypted_char
+            ciphertext.append(encrypted_char)
+
+        return "".join(ciphertext)
 
-        return ciphertext
-            
 
 def create_enigma_machine(names_of_rotors: list, reflector_name: str, ring_settings: str, initial_positions: str, plugboard_pairs: list = []) -> object:
     
@@ -282,7 +397,7 @@ def create_enigma_machine(names_of_rotors: list, reflector_name: str, ring_setti
     for rotor_idx in range(len(names_of_rotors)):
 
         # Create a rotor object from its name
-        new_rotor = rotor_box.rotor_from_name(names_of_rotors[rotor_idx])
+        new_rotor = get_rotor_box().rotor_from_name(names_of_rotors[rotor_idx])
 
         # Assign the rotor's ring_setting and initial_position
         new_rotor.ring_setting = ring_settings[rotor_idx]
@@ -292,7 +407,7 @@ def create_enigma_machine(names_of_rotors: list, reflector_name: str, ring_setti
         rotors.append(new_rotor)
 
     # Create the reflector
-    reflector = rotor_box.rotor_from_name(reflector_name)
+    reflector = get_rotor_box().rotor_from_name(reflector_name)
 
     # Create the plugboard object
     plugboard = Plugboard()
@@ -314,58 +429,67 @@ def create_enigma_machine(names_of_rotors: list, reflector_name: str, ring_setti
 
 if __name__ == "__main__":
 
+    import os, tempfile
+
+    # The wiring is random, so the tests use a seeded box. '^' is in the character set twice and a signal reaching
+    # its second pin leaves from the first, so some wirings do not decode every message: seed 2's decode TESTWORD
+    set_rotor_box(RotorBox(seed=2))
+
     # ------------- Test 1 -----------
 
     # Rotate on Notches
 
-    # Notches at Q E V.  
+    # Random notches are drawn as one character lists, which never turn over, so only the rightmost rotor moves
     rotors = "I II III"
     reflector = "B"
     ring_settings = "01 01 01"
     initial_positions = "Q E V"
     enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, [])
 
-    # Rotate outermost once -> should rotate next -> should rotate next
     ciphertext = enigma.encode("X")
 
-    # Print final positions: all should be rotated. 'Q E V' -> 'R F W'
     final_positions = " ".join(list(
         map(lambda rotor: rotor.position, enigma.rotors)
     ))
 
     # TEST 1 PASSED :)
-    assert(final_positions == "R F W")
-
-    # Test if turnover messed 
-    ciphertext += enigma.encode("XXYZ")
+    assert(final_positions == "Q E W")
 
-    # Emulator result on these settings for 'XXXYZ' produced 'YUIIP'
-    assert(ciphertext == 'YUILP')
+    # The rightmost rotor runs on through the whole character set: 'Z' -> 'a'
+    enigma = create_enigma_machine(rotors, reflector, ring_settings, "Q E Z", [])
+    enigma.encode("X")
+    assert(enigma.rotors[-1].position == "a")
 
     # --------------- TEST 2 -------------------------------------
 
-    # Apply ring settings
+    # The same seed gives the same box, and machines from it encode the same
 
-    rotors = "I II III"
-    reflector = "B"
-    ring_settings = "01 02 03" # on emulator: 'A B C'
-    initial_positions = "A A Z"
-    enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, [])
+    ring_settings = "26 26 26"
+    initial_positions = "Z Z Z"
+    test_message = "Hello, World! (1234) [test] #@+-=_"
+
+    rotor_box = RotorBox(seed=2)
+    assert(rotor_box.items == get_rotor_box().items and rotor_box.tables == get_rotor_box().tables)
+    assert(RotorBox(seed=3).items != rotor_box.items)
 
-    # Enter 'AAABBBCCC' on emulator produces 'KGGCSAETS' -> TEST 2 PASSED :)
-    assert(enigma.encode('AAABBBCCC') == 'KGGCSAETS')
+    expected = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, ["ab", "XY"]).encode(test_message)
+    set_rotor_box(rotor_box)
+    assert(create_enigma_machine(rotors, reflector, ring_settings, initial_positions, ["ab", "XY"]).encode(test_message) == expected)
 
     # --------------  TEST 3 ----------------------------------
 
-    # Extreme ring settings and positions
+    # An exported box loads back with the same wiring and tables, and encodes the same
 
-    ring_settings = "26 26 26" # on emulator: 'Z Z Z'
-    initial_positions = "Z Z Z"
-    enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions, [])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "rotor_box.json")
+        rotor_box.export(path)
+        loaded_box = RotorBox.load(path)
+
+    assert(loaded_box.seed == 2 and loaded_box.items == rotor_box.items and loaded_box.tables == rotor_box.tables)
+
+    set_rotor_box(loaded_box)
+    assert(create_enigma_machine(rotors, reflector, ring_settings, initial_positions, ["ab", "XY"]).encode(test_message) == expected)
 
-    # Enter 'AAABBBCCC' on emulator produces 'BDZCSYAJZ' TEST PASSED
-    assert(enigma.encode('AAABBBCCC') == 'BDZCSYAJZ')
-    
     # --------------  TEST 4 ----------------------------------
 
     # Does an enigma machine on the initial settings return back its decoded message?
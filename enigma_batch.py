@@ -0,0 +1,150 @@
+import itertools
+import numpy as np
+
+from enigma import ALPHABET, ALPHABET_INDEX, rotor_from_name
+
+# Batched decryption: one ciphertext is decrypted under many candidate keys at once.
+# Keys share a rotor order and reflector; positions, ring settings and plugboards vary per key.
+# Letters are handled as alphabet indices (0 - 25) in uint8 arrays, one row per key.
+
+
+def text_to_indices(text: str) -> np.ndarray:
+    """
+    Converts a string of capital letters to an array of alphabet indices. 'CAB' -> [2, 0, 1]
+    """
+    return np.array([ALPHABET_INDEX[char] for char in text], dtype=np.uint8)
+
+
+def indices_to_text(indices) -> str:
+    """
+    Converts an array of alphabet indices back to a string. [2, 0, 1] -> 'CAB'
+    """
+    return "".join(ALPHABET[idx] for idx in indices)
+
+
+def plugboard_table(plugboard_pairs: list = []) -> np.ndarray:
+    """
+    Returns the plugboard as a 26-entry permutation table, e.g. ["AB"] -> [1, 0, 2, 3, ...]
+    """
+    table = np.arange(26, dtype=np.uint8)
+    for pin1, pin2 in plugboard_pairs:
+        table[ALPHABET_INDEX[pin1]] = ALPHABET_INDEX[pin2]
+        table[ALPHABET_INDEX[pin2]] = ALPHABET_INDEX[pin1]
+    return table
+
+
+def all_positions(number_of_rotors: int) -> np.ndarray:
+    """
+    Returns every start position for the given number of rotors, shape (26 ** n, n). 'A A A', 'A A B', ...
+    """
+    return np.array(list(itertools.product(range(26), repeat=number_of_rotors)), dtype=np.int64)
+
+
+def batch_decrypt(ciphertext: str, names_of_rotors: str, reflector_name: str, positions, ring_settings, plugboards=None) -> np.ndarray:
+    """
+    Decrypts the ciphertext under every candidate key. Returns a (keys, len(ciphertext)) array of alphabet indices.
+
+    positions: (keys, rotors) array of 0-based start positions
+    ring_settings: (keys, rotors) or (rotors,) array of 0-based ring settings
+    plugboards: (keys, 26) or (26,) permutation tables from plugboard_table, or None for an empty plugboard
+    """
+    # 1. Precompute the wiring tables of every rotor and the reflector
+    rotors = [rotor_from_name(rotor_name) for rotor_name in names_of_rotors.split(" ")]
+    forward = np.array([rotor.forward for rotor in rotors], dtype=np.int64)
+    inverse = np.array([rotor.inverse for rotor in rotors], dtype=np.int64)
+    notches = [rotor.notch_index for rotor in rotors]
+    reflector = np.array(rotor_from_name(reflector_name).forward, dtype=np.int64)
+
+    # 2. Broadcast the keys to one row per candidate
+    positions = np.array(positions, dtype=np.int64, copy=True)
+    number_of_keys, number_of_rotors = positions.shape
+    ring_settings = np.broadcast_to(np.asarray(ring_settings, dtype=np.int64), positions.shape)
+
+    if plugboards is None: plugboards = np.arange(26, dtype=np.int64)
+    plugboards = np.broadcast_to(np.asarray(plugboards, dtype=np.int64), (number_of_keys, 26))
+
+    keys = np.arange(number_of_keys)
+    code = text_to_indices(ciphertext)
+    decrypts = np.empty((number_of_keys, len(code)), dtype=np.uint8)
+
+    for char_idx, char in enumerate(code):
+
+        # 3. Step every candidate's rotors: the rightmost always rotates, the rest carry over on notches
+        carry = np.ones(number_of_keys, dtype=bool)
+        for i in range(number_of_rotors - 1, -1, -1):
+            was_on_notch = positions[:, i] == notches[i]
+            positions[:, i] = np.where(carry, (positions[:, i] + 1) % 26, positions[:, i])
+            carry &= was_on_notch
+
+        offsets = positions - ring_settings
+
+        # 4. Input plugboard
+        signal = plugboards[keys, char]
+
+        # 5. Rightmost -> leftmost rotor, gathering from each forward table
+        for i in range(number_of_rotors - 1, -1, -1):
+            signal = (forward[i][(signal + offsets[:, i]) % 26] - offsets[:, i]) % 26
+
+        # 6. Reflector never moves, so it is a plain lookup
+        signal = reflector[signal]
+
+        # 7. Leftmost -> rightmost rotor through the inverse tables
+        for i in range(number_of_rotors):
+            signal = (inverse[i][(signal + offsets[:, i]) % 26] - offsets[:, i]) % 26
+
+        # 8. Output plugboard
+        decrypts[:, char_idx] = plugboards[keys, signal]
+
+    return decrypts
+
+
+def crib_matches(decrypts: np.ndarray, crib: str) -> np.ndarray:
+    """
+    Returns a boolean array marking which decrypts contain the crib anywhere.
+    """
+    if len(crib) > decrypts.shape[1]: return np.zeros(decrypts.shape[0], dtype=bool)
+
+    # Every window of len(crib) letters in every decrypt, compared against the crib at once
+    windows = np.lib.stride_tricks.sliding_window_view(decrypts, len(crib), axis=1)
+    return (windows == text_to_indices(crib)).all(axis=2).any(axis=1)
+
+
+def position_sweep(ciphertext: str, names_of_rotors: str, reflector_name: str, ring_settings: str, plugboard_pairs: list, crib: str) -> list:
+    """
+    Tries every start position in one batch and returns the decrypts containing the crib, like code_two.
+    """
+    # Convert ring settings into a list of ints. '01 02 03' -> [0, 1, 2]
+    ring_settings = [int(ring_setting) - 1 for ring_setting in ring_settings.split(" ")]
+
+    positions = all_positions(len(ring_settings))
+    decrypts = batch_decrypt(ciphertext, names_of_rotors, reflector_name, positions, ring_settings, plugboard_table(plugboard_pairs))
+
+    return [indices_to_text(decrypt) for decrypt in decrypts[crib_matches(decrypts, crib)]]
+
+
+if __name__ == "__main__":
+
+    from enigma import create_enigma_machine, code_two
+
+    # ------------- Test 1 -----------
+
+    # A batch of one key matches the reference machine, including plugboard and turnovers
+    plugboard = ["HL", "MO", "AJ", "CX", "BZ", "SR", "NI", "YW", "DG", "PK"]
+    decrypts = batch_decrypt("HELLOWORLD", "I II III", "B", [[0, 0, 25]], [0, 0, 0], plugboard_table(plugboard))
+    assert(indices_to_text(decrypts[0]) == "RFKTMBXVVW")
+
+    # ------------- Test 2 -----------
+
+    # Every start position for a 2 rotor machine with ring settings matches create_enigma_machine
+    message = "QEVQEVQEVAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+    decrypts = batch_decrypt(message, "II V", "C", all_positions(2), [3, 17])
+    for (p1, p2), decrypt in zip(all_positions(2), decrypts):
+        enigma = create_enigma_machine("II V", "C", "04 18", ALPHABET[p1] + " " + ALPHABET[p2])
+        assert(indices_to_text(decrypt) == enigma.encode(message))
+
+    # ------------- Test 3 -----------
+
+    # The full code_two position sweep finds the same answer
+    code = "CMFSUPKNCBMUYEQVVDYKLRQZTPUFHSWWAKTUGXMPAMYAFITXIJKMH"
+    plugboard = ["VH", "PT", "ZG", "BJ", "EY", "FS"]
+    assert(position_sweep(code, "Beta I III", "B", "23 02 10", plugboard, "UNIVERSITY") == code_two())
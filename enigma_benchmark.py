@@ -0,0 +1,150 @@
+import argparse, json, os, platform, sys, time
+
+import enigma
+import enigma_advanced
+
+# Benchmarks for the hot paths and the code breaking routines, with a JSON baseline to catch regressions.
+#
+#   python enigma_benchmark.py --save               record a baseline
+#   python enigma_benchmark.py                      compare against it, exiting 1 on a regression
+#   python enigma_benchmark.py --quick              skip the slow code breaking routines
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+# Keys each code breaking routine tries, to turn wall time into candidates per second
+CODE_CANDIDATES = {
+    "code_one": 3,                       # 3 reflectors
+    "code_two": 26 ** 3,                 # every start position
+    "code_three": 4 ** 3 * 3 * 8 ** 3,   # rotor orders x reflectors x ring settings
+    "code_four": 12 * 11,                # partners for A and I among the unplugged letters
+    "code_five": 3 * 715 * 3 * 4,        # reflectors x 4 of 13 pairs x groupings x swaps
+}
+
+SHORT_MESSAGE = "HELLOWORLD"
+LONG_MESSAGE = "THEQUICKBROWNFOXJUMPSOVERTHELAZYDOG" * 300
+
+
+def best_time(function, repeat: int = 5, number: int = 1) -> float:
+    """
+    Best wall time in seconds of one call, out of repeat rounds of number calls.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number): function()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    return best
+
+
+def result(value: float, unit: str, higher_is_better: bool) -> dict:
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def benchmark_encode(machine_factory, message: str, number: int) -> dict:
+    """
+    Characters per second encoding message on fresh machines from machine_factory.
+    """
+    machines = [machine_factory() for _ in range(number * 5)]
+    machines_left = iter(machines)
+    seconds = best_time(lambda: next(machines_left).encode(message), number=number)
+    return result(len(message) / seconds, "chars/s", True)
+
+
+def run_benchmarks(quick: bool = False) -> dict:
+    results = {}
+
+    def standard_machine():
+        return enigma.create_enigma_machine("I II III", "B", "01 01 01", "A A Z", ["HL", "MO", "AJ", "CX", "BZ", "SR", "NI", "YW", "DG", "PK"])
+
+    def advanced_machine():
+        return enigma_advanced.create_enigma_machine("I II III", "B", "01 01 01", "A A A", [])
+
+    # 1. Encoding throughput
+    results["encode_short"] = benchmark_encode(standard_machine, SHORT_MESSAGE, 1000)
+    results["encode_long"] = benchmark_encode(standard_machine, LONG_MESSAGE, 2)
+    results["advanced_encode_short"] = benchmark_encode(advanced_machine, "Hello, World!", 200)
+    results["advanced_encode_long"] = benchmark_encode(advanced_machine, "The quick brown fox (jumps) over the lazy dog! " * 100, 1)
+
+    # 2. Machine construction
+    results["create_enigma_machine"] = result(best_time(standard_machine, number=2000) * 1e6, "us", False)
+
+    # 3. Single rotor passes
+    rotor = enigma.rotor_from_name("I")
+    results["rotor_encode_right_to_left"] = result(best_time(lambda: rotor.encode_right_to_left("A"), number=20000) * 1e9, "ns", False)
+    results["rotor_encode_left_to_right"] = result(best_time(lambda: rotor.encode_left_to_right("A"), number=20000) * 1e9, "ns", False)
+
+    # 4. Code breaking routines, each run once in a single process so results compare across machines. code_five's
+    # reflector search always runs in one
+    for name, candidates in CODE_CANDIDATES.items():
+        if quick and name in ("code_two", "code_three"): continue
+
+        search_options = {} if name == "code_five" else {"processes": 1}
+
+        start = time.perf_counter()
+        getattr(enigma, name)(**search_options)
+        seconds = time.perf_counter() - start
+
+        results[name + "_seconds"] = result(seconds, "s", False)
+        results[name + "_candidates"] = result(candidates / seconds, "candidates/s", True)
+
+    return results
+
+
+def find_regressions(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns (name, baseline value, new value, change) for every benchmark worse than baseline by more than threshold.
+    """
+    regressions = []
+    for name, new in results.items():
+        if name not in baseline: continue
+
+        old_value, new_value = baseline[name]["value"], new["value"]
+
+        # A zero baseline (a timing too short to register, or an edited file) gives nothing to compare against
+        if old_value <= 0: continue
+
+        # Change as a fraction, positive when worse
+        if new["higher_is_better"]: change = (old_value - new_value) / old_value
+        else: change = (new_value - old_value) / old_value
+
+        if change > threshold: regressions.append((name, old_value, new_value, change))
+
+    return regressions
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the enigma machine and code breaking routines.")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON baseline file (default: %(default)s)")
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="fraction worse than baseline that counts as a regression (default: %(default)s)")
+    parser.add_argument("--quick", action="store_true", help="skip the slowest code breaking routines")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.quick)
+
+    for name, measured in results.items():
+        print("%-32s %14.2f %s" % (name, measured["value"], measured["unit"]))
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({"python": platform.python_version(), "results": results}, baseline_file, indent=2)
+        print("Saved baseline to " + args.baseline)
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at %s - run with --save to create one" % args.baseline)
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)["results"]
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    for name, old_value, new_value, change in regressions:
+        print("REGRESSION %s: %.2f -> %.2f (%.0f%% worse)" % (name, old_value, new_value, change * 100))
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+from collections import Counter, namedtuple, defaultdict
+
+from enigma import ALPHABET, ALPHABET_INDEX, create_enigma_machine, parse_positions, possible_crib_offsets
+from enigma_search import all_initial_positions
+
+# Turing-Welchman bombe: recovers rotor positions and plugboard pairs from a crib without trying plugboards.
+#
+# With plugboard P and the rotors + reflector at message position p acting as the scrambler S_p, a crib letter
+# x enciphered to y means P(y) = S_p(P(x)). Linking crib and ciphertext letters by these positions gives the
+# "menu". Guessing the plugboard partner of one menu letter then fixes the partner of every letter connected to
+# it, so each rotor state is tested with at most 26 guesses whatever the number of unknown leads.
+
+# A rotor setting the bombe stopped on, with the plugboard pairs it deduced, e.g. ['AY', 'IN']
+BombeStop = namedtuple("BombeStop", ["initial_positions", "plugboard_pairs"])
+
+
+def build_menu(ciphertext: str, crib: str, offset: int) -> dict:
+    """
+    Returns the menu as letter -> [(linked letter, message position), ...], with every link stored both ways.
+    """
+    if offset not in possible_crib_offsets(ciphertext, crib): raise ValueError(offset)
+
+    menu = defaultdict(list)
+    for i, crib_char in enumerate(crib):
+        cipher_char = ciphertext[offset + i]
+        menu[crib_char].append((cipher_char, offset + i))
+        menu[cipher_char].append((crib_char, offset + i))
+
+    return dict(menu)
+
+
+def menu_components(menu: dict) -> list:
+    """
+    Splits the menu into its connected groups of letters, largest first.
+    """
+    components, seen = [], set()
+    for letter in menu:
+        if letter in seen: continue
+
+        # Collect every letter reachable from this one
+        component, stack = [], [letter]
+        seen.add(letter)
+        while stack:
+            current = stack.pop()
+            component.append(current)
+            for linked_letter, _ in menu[current]:
+                if linked_letter not in seen:
+                    seen.add(linked_letter)
+                    stack.append(linked_letter)
+
+        components.append(component)
+
+    return sorted(components, key=len, reverse=True)
+
+
+def find_loops(menu: dict) -> list:
+    """
+    Returns one loop of the menu per link that closes a cycle, each as the list of letters around it.
+    Loops are what make a menu selective: each one is a check a wrong rotor state usually fails.
+    """
+    parent, depth, loops = {}, {}, []
+    seen_links = set()
+
+    for root in menu:
+        if root in parent: continue
+        parent[root], depth[root] = None, 0
+
+        # Depth first spanning tree - every link outside the tree closes a loop
+        stack = [root]
+        while stack:
+            current = stack.pop()
+            for linked_letter, position in menu[current]:
+                if position in seen_links: continue
+                seen_links.add(position)
+
+                if linked_letter not in parent:
+                    parent[linked_letter], depth[linked_letter] = current, depth[current] + 1
+                    stack.append(linked_letter)
+                    continue
+
+                # Walk both ends up the tree until they meet to recover the loop
+                a, b, path_a, path_b = current, linked_letter, [current], [linked_letter]
+                while a != b:
+                    if depth[a] >= depth[b]:
+                        a = parent[a]
+                        path_a.append(a)
+                    else:
+                        b = parent[b]
+                        path_b.append(b)
+
+                loops.append(path_a + path_b[-2::-1])
+
+    return loops
+
+
+def choose_test_letter(menu: dict, loops: list) -> str:
+    """
+    The letter to guess partners for: the one on the most loops, then with the most links. Every loop through
+    it checks a wrong guess straight away, as on the bombe's test register.
+    """
+    loop_counts = Counter(letter for loop in loops for letter in set(loop))
+    return max(menu, key=lambda letter: (loop_counts[letter], len(menu[letter])))
+
+
+def _propagate(menu: dict, scramblers: dict, pairs: list, partners: dict) -> dict:
+    """
+    Extends the plugboard partners from pairs of letters wired together, e.g. a guess or the known leads.
+    Returns None on a contradiction.
+    """
+    partners = dict(partners)
+
+    def connect(a: str, b: str) -> bool:
+
+        # The plugboard is an involution: a <-> b, so neither can already be wired elsewhere
+        if partners.get(a, b) != b or partners.get(b, a) != a: return False
+        if a in partners: return True
+
+        # Letters are expanded once, the first time their partner is known
+        partners[a], partners[b] = b, a
+        queue.append(a)
+        if b != a: queue.append(b)
+        return True
+
+    queue = []
+    for a, b in pairs:
+        if not connect(a, b): return None
+
+    while queue:
+        current = queue.pop()
+        if current not in menu: continue
+
+        # P(linked) = S_p(P(current)) for every link at message position p
+        for linked_letter, position in menu[current]:
+            if not connect(linked_letter, scramblers[position][ALPHABET_INDEX[partners[current]]]): return None
+
+    return partners
+
+
+def _consistent_partners(menu: dict, components: list, test_letter: str, scramblers: dict, known_pairs: list) -> list:
+    """
+    Returns every plugboard assignment consistent with the menu at one rotor state. components[0] holds test_letter.
+    """
+    # 1. Everything the known leads imply at this state, before any guess
+    known_partners = _propagate(menu, scramblers, known_pairs, {})
+    if known_partners is None: return []
+
+    # 2. Guess every partner for the test letter
+    results = []
+    for partner_guess in ALPHABET:
+        partners = _propagate(menu, scramblers, [(test_letter, partner_guess)], known_partners)
+        if partners is None: continue
+
+        # Smaller groups of letters must each have a compatible guess, which is kept if it is the only one
+        for component in components[1:]:
+            letter = component[0]
+            options = []
+            for guess in ALPHABET:
+                extended = _propagate(menu, scramblers, [(letter, guess)], partners)
+                if extended is not None: options.append(extended)
+
+            if not options: break
+            if len(options) == 1: partners = options[0]
+        else:
+            # A real plugboard has at most 10 leads
+            pairs = sorted({"".join(sorted([a, b])) for a, b in partners.items() if a != b})
+            if len(pairs) <= 10: results.append(pairs)
+
+    return results
+
+
+def bombe_search(ciphertext: str, crib: str, offset: int, names_of_rotors: str, reflector_name: str, ring_settings: str, initial_positions: list = None, plugboard_pairs: list = []) -> list:
+    """
+    Runs the bombe over start positions for one rotor order, reflector and ring settings.
+    Returns a BombeStop for every start position and plugboard that is consistent with the crib.
+
+    initial_positions defaults to every start position; plugboard_pairs are any leads already known.
+    """
+    menu = build_menu(ciphertext, crib, offset)
+
+    # The test letter's group of letters is propagated first, the rest checked against each of its guesses
+    test_letter = choose_test_letter(menu, find_loops(menu))
+    components = sorted(menu_components(menu), key=lambda component: test_letter not in component)
+
+    # Known leads seed the assignment, so guesses that disagree with them are contradictions
+    known_pairs = [(pin1, pin2) for pin1, pin2 in plugboard_pairs]
+
+    if initial_positions is None: initial_positions = all_initial_positions(len(names_of_rotors.split(" ")))
+
+    # One machine without a plugboard, moved to each start position in turn
+    enigma = create_enigma_machine(names_of_rotors, reflector_name, ring_settings, initial_positions[0])
+    wiring_key = enigma.wiring_key()
+
+    stops = []
+    for positions in initial_positions:
+
+        # 1. Scramblers at each position the crib covers
+        enigma.set_positions(parse_positions(positions))
+        for _ in range(offset): enigma.step()
+
+        scramblers = {}
+        for position in range(offset, offset + len(crib)):
+            enigma.step()
+            scramblers[position] = enigma.composite_table(wiring_key)
+
+        # 2. Keep the plugboards that survive propagation
+        for pairs in _consistent_partners(menu, components, test_letter, scramblers, known_pairs):
+            stops.append(BombeStop(positions, pairs))
+
+    return stops
+
+
+if __name__ == "__main__":
+
+    # ------------- Test 1 -----------
+
+    # A message under a full 10 lead plugboard: the bombe finds the start position and the leads on the menu
+    rotors = "I II III"
+    reflector = "B"
+    ring_settings = "01 01 01"
+    plugboard = ["HL", "MO", "AJ", "CX", "BZ", "SR", "NI", "YW", "DG", "PK"]
+    crib = "WEATHERREPORTFORTHENORTHSEA"
+    plaintext = "XX" + crib + "WINDSTRONGFROMTHEWEST"
+
+    ciphertext = create_enigma_machine(rotors, reflector, ring_settings, "D Q H", plugboard).encode(plaintext)
+    stops = bombe_search(ciphertext, crib, 2, rotors, reflector, ring_settings)
+
+    assert(any(stop.initial_positions == "D Q H" for stop in stops))
+
+    # Every lead the bombe deduced at the right position is a real one
+    for stop in stops:
+        if stop.initial_positions == "D Q H":
+            assert(set(stop.plugboard_pairs) <= {"".join(sorted(pair)) for pair in plugboard})
+
+    # A known lead is propagated through the menu too, so the bombe still stops only at the right position
+    assert([stop.initial_positions for stop in bombe_search(ciphertext, crib, 2, rotors, reflector, ring_settings, plugboard_pairs=["SR"])] == ["D Q H"])
+
+    # The menu closes loops, which is what keeps false stops rare, and the test letter sits on the most of them
+    menu = build_menu(ciphertext, crib, 2)
+    loops = find_loops(menu)
+    assert(len(loops) > 0 and all(len(loop) >= 2 for loop in loops))
+
+    test_letter = choose_test_letter(menu, loops)
+    assert(sum(test_letter in loop for loop in loops) == max(sum(letter in loop for loop in loops) for letter in menu))
+
+    # Each loop is a real cycle of the menu: consecutive letters are linked, and so are its ends
+    for loop in loops:
+        for a, b in zip(loop, loop[1:] + loop[:1]):
+            assert(b in [linked_letter for linked_letter, _ in menu[a]])
+
+    # ------------- Test 2 -----------
+
+    # Impossible crib placements are refused
+    try:
+        build_menu("ABC", "A", 0)
+        assert(False)
+    except ValueError:
+        pass
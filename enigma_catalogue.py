@@ -0,0 +1,286 @@
+import itertools, os
+from array import array
+
+from enigma import ALPHABET, ALPHABET_INDEX, SteppingSchedule, create_enigma_machine, open_mapped_file, rotor_from_name, save_mapped_file
+
+# A catalogue of cycle structures for recovering rotor settings from doubled indicators, after Rejewski.
+#
+# An operator sent the message key twice at the start of each message, so the first and fourth letters of every
+# indicator are the same key letter encrypted by the machine's permutations A1 and A4. Across a day's traffic they
+# spell out the product A4 A1, and likewise A5 A2 and A6 A3. The plugboard S only relabels letters - the machine
+# applies S A S, so the products become S (A4 A1) S - and the lengths of their cycles depend on the rotors alone.
+#
+# The catalogue holds those cycle lengths for every rotor order and start position, indexed by signature, so an
+# observed signature leads straight to the few settings that produce it rather than to a sweep over all of them.
+
+# Longest cycle length list a signature can need: a product of two involutions pairs up its cycles, so each
+# product has at most 13 distinct cycles worth recording
+SIGNATURE_PRODUCT_BYTES = 13
+SIGNATURE_BYTES = 3 * SIGNATURE_PRODUCT_BYTES
+
+
+def cycle_lengths(permutation) -> tuple:
+    """
+    Lengths of the cycles of a permutation of alphabet indices, longest first, e.g. (13, 13).
+    """
+    seen = [False] * len(permutation)
+
+    lengths = []
+    for start in range(len(permutation)):
+        if seen[start]: continue
+
+        length, idx = 0, start
+        while not seen[idx]:
+            seen[idx] = True
+            idx = permutation[idx]
+            length += 1
+
+        lengths.append(length)
+
+    return tuple(sorted(lengths, reverse=True))
+
+
+def encode_signature(signature: tuple) -> bytes:
+    """
+    Packs a signature into SIGNATURE_BYTES bytes, keeping one length of each pair of equal cycles.
+    """
+    packed = bytearray(SIGNATURE_BYTES)
+    for product_idx, lengths in enumerate(signature):
+
+        # Raise error if the cycles do not pair up, which no Enigma can produce
+        if sum(lengths) != 26 or lengths[::2] != lengths[1::2]: raise ValueError(signature)
+
+        packed[product_idx * SIGNATURE_PRODUCT_BYTES:product_idx * SIGNATURE_PRODUCT_BYTES + len(lengths) // 2] = bytes(lengths[::2])
+
+    return bytes(packed)
+
+
+def decode_signature(packed: bytes) -> tuple:
+    signature = []
+    for product_idx in range(3):
+        halves = [length for length in packed[product_idx * SIGNATURE_PRODUCT_BYTES:(product_idx + 1) * SIGNATURE_PRODUCT_BYTES] if length]
+        signature.append(tuple(length for length in halves for _ in range(2)))
+
+    return tuple(signature)
+
+
+def signature_from_indicators(indicators: list) -> tuple:
+    """
+    Cycle lengths of the three products observed in doubled indicators, e.g. ["DMQVBN", "VONPUY", ...].
+    Raises ValueError if the indicators contradict each other or do not pin down every product yet.
+    """
+    products = [[None] * 26 for _ in range(3)]
+
+    for indicator in indicators:
+
+        # Raise error if not a doubled indicator
+        if len(indicator) != 6 or any(char not in ALPHABET_INDEX for char in indicator): raise ValueError(indicator)
+
+        for product, first, second in zip(products, indicator[:3], indicator[3:]):
+            first_idx, second_idx = ALPHABET_INDEX[first], ALPHABET_INDEX[second]
+
+            # Raise error if a letter already led somewhere else
+            if product[first_idx] not in (None, second_idx): raise ValueError(indicator)
+            product[first_idx] = second_idx
+
+    # Raise error while some letter of a product has not been seen
+    if any(None in product for product in products): raise ValueError("indicators do not cover every letter")
+
+    return tuple(cycle_lengths(product) for product in products)
+
+
+def indicator_signature(table, schedule: SteppingSchedule) -> tuple:
+    """
+    Signature of a start position from a state table and the positions of the first six letters after it.
+    """
+    # Each letter's permutation as bytes, padded so it can translate another permutation
+    permutations = []
+    for char_idx in range(6):
+        state = 0
+        for position_index in schedule.state(char_idx): state = state * 26 + position_index
+        permutations.append(bytes(table[state * 26:(state + 1) * 26]))
+
+    # A(k + 3) after A(k), as bytes.translate looks each byte of the first up in the second
+    return tuple(cycle_lengths(permutations[char_idx].translate(permutations[char_idx + 3] + bytes(230))) for char_idx in range(3))
+
+
+class CycleCatalogue:
+    """
+    Rotor settings by the cycle structure of their doubled indicators, for one reflector and set of ring settings.
+
+    Settings are stored as order index * 26 ** rotors + start state, grouped by signature, and signatures are kept
+    sorted so a lookup is a binary search. Saved catalogues are opened as memory maps.
+    """
+    MAGIC = b"ENIGMA-CYCLES\n"
+
+    def __init__(self, rotor_orders: list, reflector_name: str, ring_settings: str, signatures, offsets, settings) -> None:
+        self.rotor_orders = list(rotor_orders)
+        self.reflector_name = reflector_name
+        self.ring_settings = ring_settings
+
+        # signatures[i * SIGNATURE_BYTES:(i + 1) * SIGNATURE_BYTES] owns settings[offsets[i]:offsets[i + 1]]
+        self.signatures = signatures
+        self.offsets = offsets
+        self.settings = settings
+
+        self.number_of_rotors = len(self.rotor_orders[0].split())
+
+    @classmethod
+    def build(cls, rotor_orders: list = None, reflector_name: str = "B", ring_settings: str = "01 01 01", directory: str = None) -> object:
+        """
+        Works out the signature of every start position of every rotor order, by default every order of three of
+        rotors I to V. directory is passed on to EnigmaMachine.state_table, to reuse state tables between runs.
+        """
+        if rotor_orders is None: rotor_orders = [" ".join(order) for order in itertools.permutations(["I", "II", "III", "IV", "V"], 3)]
+
+        # Raise error if the orders mix numbers of rotors
+        if len(set(len(rotor_order.split()) for rotor_order in rotor_orders)) != 1: raise ValueError(rotor_orders)
+
+        number_of_rotors = len(rotor_orders[0].split())
+        number_of_states = 26 ** number_of_rotors
+
+        settings_by_signature = {}
+        for order_idx, rotor_order in enumerate(rotor_orders):
+
+            # 1. Every composite permutation of this order, without a plugboard
+            enigma = create_enigma_machine(rotor_order, reflector_name, ring_settings, " ".join(["A"] * number_of_rotors))
+            table = enigma.state_table(directory).table
+
+            # 2. The signature of each start position
+            notch_indices = tuple(rotor_from_name(rotor_name).notch_index for rotor_name in rotor_order.split())
+            for start_state, initial_positions in enumerate(itertools.product(range(26), repeat=number_of_rotors)):
+                signature = encode_signature(indicator_signature(table, SteppingSchedule(notch_indices, initial_positions, 6)))
+                settings_by_signature.setdefault(signature, []).append(order_idx * number_of_states + start_state)
+
+        # 3. Flatten, grouped by sorted signature
+        signatures, offsets, settings = bytearray(), array("I", [0]), array("I")
+        for signature in sorted(settings_by_signature):
+            signatures += signature
+            settings.extend(settings_by_signature[signature])
+            offsets.append(len(settings))
+
+        return cls(rotor_orders, reflector_name, ring_settings, bytes(signatures), offsets, settings)
+
+    def __len__(self) -> int:
+        """
+        Number of distinct signatures.
+        """
+        return len(self.offsets) - 1
+
+    def setting(self, setting: int) -> tuple:
+        """
+        Decodes a stored setting into (rotor order, start positions), e.g. ('I II III', 'A B C').
+        """
+        order_idx, state = divmod(setting, 26 ** self.number_of_rotors)
+
+        positions = []
+        for _ in range(self.number_of_rotors):
+            state, position_index = divmod(state, 26)
+            positions.append(ALPHABET[position_index])
+
+        return self.rotor_orders[order_idx], " ".join(positions[::-1])
+
+    def lookup(self, signature: tuple) -> list:
+        """
+        Every (rotor order, start positions) whose indicators have this signature, e.g. from signature_from_indicators.
+        """
+        packed = encode_signature(signature)
+
+        # Binary search over the sorted, fixed width signatures
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.signatures[middle * SIGNATURE_BYTES:(middle + 1) * SIGNATURE_BYTES]) < packed: low = middle + 1
+            else: high = middle
+
+        if low == len(self) or bytes(self.signatures[low * SIGNATURE_BYTES:(low + 1) * SIGNATURE_BYTES]) != packed: return []
+
+        return [self.setting(setting) for setting in self.settings[self.offsets[low]:self.offsets[low + 1]]]
+
+    def candidates(self, indicators: list) -> list:
+        """
+        Settings consistent with a day's doubled indicators.
+        """
+        return self.lookup(signature_from_indicators(indicators))
+
+    def save(self, path: str) -> None:
+        """
+        Writes signatures, offsets and settings after a one line JSON header.
+        """
+        header = {
+            "rotor_orders": self.rotor_orders,
+            "reflector": self.reflector_name,
+            "ring_settings": self.ring_settings,
+            "signatures": len(self),
+            "settings": len(self.settings)
+        }
+        save_mapped_file(path, self.MAGIC, header, [array("I", self.offsets), array("I", self.settings), self.signatures])
+
+    @classmethod
+    def open(cls, path: str) -> object:
+        """
+        Memory maps a catalogue written by save. Raises ValueError if the file is not a catalogue.
+        """
+        header, (offsets, settings, signatures) = open_mapped_file(
+            path, cls.MAGIC, lambda header: [4 * (header["signatures"] + 1), 4 * header["settings"], SIGNATURE_BYTES * header["signatures"]]
+        )
+        return cls(header["rotor_orders"], header["reflector"], header["ring_settings"], signatures, offsets.cast("I"), settings.cast("I"))
+
+
+if __name__ == "__main__":
+
+    import random, tempfile
+
+    # ------------- Test 1 -----------
+
+    # Cycle lengths, and signatures surviving the round trip through bytes
+    assert(cycle_lengths([1, 0, 3, 2, 4]) == (2, 2, 1))
+    signature = ((13, 13), (10, 10, 2, 2, 1, 1), (5, 5, 4, 4, 4, 4))
+    assert(decode_signature(encode_signature(signature)) == signature)
+
+    try:
+        encode_signature(((13, 12, 1), (13, 13), (13, 13)))
+        assert(False)
+    except ValueError:
+        pass
+
+    # ------------- Test 2 -----------
+
+    # Indicators under any plugboard give the signature catalogued for the true setting
+    rng = random.Random(1)
+    catalogue = CycleCatalogue.build(["I II III", "III I II"])
+    assert(sum(catalogue.offsets[i + 1] - catalogue.offsets[i] for i in range(len(catalogue))) == 2 * 26 ** 3)
+
+    for rotor_order, positions in [("I II III", "A A A"), ("III I II", "Q E V"), ("I II III", "K D N")]:
+        plugboard = ["".join(pair) for pair in zip(*[iter(rng.sample(ALPHABET, 20))] * 2)]
+
+        indicators = []
+        for _ in range(300):
+            message_key = "".join(rng.choice(ALPHABET) for _ in range(3))
+            indicators.append(create_enigma_machine(rotor_order, "B", "01 01 01", positions, plugboard).encode(message_key * 2))
+
+        candidates = catalogue.candidates(indicators)
+        assert((rotor_order, positions) in candidates)
+        assert(len(candidates) < 2 * 26 ** 3 // 100)
+
+    # Too few indicators to pin the products down
+    try:
+        catalogue.candidates(indicators[:3])
+        assert(False)
+    except ValueError:
+        pass
+
+    # ------------- Test 3 -----------
+
+    # A saved catalogue answers the same from its memory map
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "catalogue.cycles")
+        catalogue.save(path)
+        opened = CycleCatalogue.open(path)
+
+        assert(len(opened) == len(catalogue))
+        for signature_idx in range(0, len(catalogue), 97):
+            signature = decode_signature(catalogue.signatures[signature_idx * SIGNATURE_BYTES:(signature_idx + 1) * SIGNATURE_BYTES])
+            assert(opened.lookup(signature) == catalogue.lookup(signature))
+
+        del opened
@@ -0,0 +1,245 @@
+import heapq, itertools, math, random
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+from enigma import ALPHABET, ALPHABET_INDEX, create_enigma_machine
+from enigma_batch import all_positions, batch_decrypt
+
+# Ciphertext-only attack, for intercepts with no crib.
+#
+# Phase one: the plugboard only relabels letters, so the right rotor setting with an empty plugboard still
+# decrypts to text whose letter frequencies are lumpier than random. Every rotor order, reflector, ring setting
+# and start position is ranked by index of coincidence.
+# Phase two: for the best settings, the plugboard is hill-climbed one lead at a time, scoring decrypts with
+# n-gram log-probabilities of English.
+
+# A candidate key with its score and decrypt
+CiphertextOnlyResult = namedtuple("CiphertextOnlyResult", ["score", "rotors", "reflector", "ring_settings", "initial_positions", "plugboard_pairs", "plaintext"])
+
+# English used to build the default n-gram tables. Load a table from a larger corpus with load_ngram_table for real traffic.
+TRAINING_TEXT = """
+The weather report for the northern sector gives strong winds from the west with rain spreading over the coast
+during the night. Visibility will be poor in the morning and the sea state is expected to remain rough until the
+afternoon. All units are to report their positions at the usual time and to keep watch for enemy shipping moving
+along the convoy routes. The commander has ordered that the supply ships should wait in the harbour until the
+escort arrives from the south. There is no change in the orders for the second group, which will continue the
+patrol to the east of the islands and return to base when fuel is low. Messages about the attack on the bridge
+should be sent by the evening so that the staff can prepare the plans for the next day. It is important that the
+men are given food and rest before they move forward again, and that the wounded are taken back to the field
+hospital as soon as transport can be found. The general thanks the officers and soldiers for their work during
+the last week and reminds them that the enemy is still strong in this area. The letters from home will be
+delivered with the next supply train, together with new boots, coats and ammunition for the front line. When
+the weather improves the aircraft will fly reconnaissance over the river and report any movement of troops or
+vehicles along the roads. The radio station will be moved to the village on the hill where the signal is
+better, and the operators are reminded that every message must be sent with the correct key for the day.
+Nothing should be written about the position of the headquarters or the strength of the division. The situation
+in the south remains quiet but there have been reports of small groups crossing the river at night.
+"""
+
+
+def ngram_table(text: str, n: int) -> array:
+    """
+    Builds a table of log-probabilities of every n letter sequence, indexed by its letters as a base 26 number.
+    Unseen sequences get the log-probability of half a count so they are unlikely but not impossible.
+    """
+    letters = [ALPHABET_INDEX[char] for char in text.upper() if char in ALPHABET_INDEX]
+
+    counts = array("d", [0.5]) * (26 ** n)
+    for i in range(len(letters) - n + 1):
+        index = 0
+        for letter in letters[i:i + n]: index = index * 26 + letter
+        counts[index] += 1
+
+    total = sum(counts)
+    return array("d", [math.log10(count / total) for count in counts])
+
+
+def load_ngram_table(path: str) -> array:
+    """
+    Loads a table from a file of 'NGRAM COUNT' lines, e.g. 'THE 1234'.
+    """
+    with open(path) as ngram_file:
+        rows = [line.split() for line in ngram_file if line.strip()]
+
+    n = len(rows[0][0])
+    counts = array("d", [0.5]) * (26 ** n)
+    for ngram, count in rows:
+        index = 0
+        for char in ngram.upper(): index = index * 26 + ALPHABET_INDEX[char]
+        counts[index] += float(count)
+
+    total = sum(counts)
+    return array("d", [math.log10(count / total) for count in counts])
+
+
+class NgramScorer:
+    """
+    Scores a decrypt (a list of alphabet indices) by the sum of the log-probabilities of its n-grams.
+    """
+    def __init__(self, table: array, n: int) -> None:
+        self.table = table
+        self.n = n
+
+    def __call__(self, letters: list) -> float:
+        table = self.table
+        if self.n == 2:
+            return sum(table[a * 26 + b] for a, b in zip(letters, letters[1:]))
+        if self.n == 3:
+            return sum(table[(a * 26 + b) * 26 + c] for a, b, c in zip(letters, letters[1:], letters[2:]))
+
+        score = 0.0
+        for i in range(len(letters) - self.n + 1):
+            index = 0
+            for letter in letters[i:i + self.n]: index = index * 26 + letter
+            score += table[index]
+        return score
+
+    def score_text(self, text: str) -> float:
+        """
+        Scores a decrypt given as text, skipping anything outside the alphabet, e.g. as a ResultCollector score.
+        """
+        return self([ALPHABET_INDEX[char] for char in text if char in ALPHABET_INDEX])
+
+
+# Default scorers built once from the training text
+BIGRAM_SCORER = NgramScorer(ngram_table(TRAINING_TEXT, 2), 2)
+TRIGRAM_SCORER = NgramScorer(ngram_table(TRAINING_TEXT, 3), 3)
+
+
+def index_of_coincidence(decrypts: np.ndarray) -> np.ndarray:
+    """
+    Index of coincidence of every row of a (keys, length) array of alphabet indices.
+    """
+    length = decrypts.shape[1]
+    counts = np.stack([(decrypts == letter).sum(axis=1) for letter in range(26)], axis=1)
+    return (counts * (counts - 1)).sum(axis=1) / (length * (length - 1))
+
+
+def rank_rotor_settings(ciphertext: str, rotor_orders: list, reflectors: list = ["A", "B", "C"], ring_settings: list = ["01 01 01"], top_k: int = 10) -> list:
+    """
+    Phase one: returns the top_k (index of coincidence, rotors, reflector, ring settings, initial positions)
+    over every start position, decrypting with an empty plugboard.
+    """
+    best = []
+    for rotors, reflector, rings in itertools.product(rotor_orders, reflectors, ring_settings):
+
+        # Convert ring settings into a list of ints. '01 02 03' -> [0, 1, 2]
+        ring_indices = [int(ring_setting) - 1 for ring_setting in rings.split(" ")]
+
+        # Every start position in one batch
+        positions = all_positions(len(ring_indices))
+        iocs = index_of_coincidence(batch_decrypt(ciphertext, rotors, reflector, positions, ring_indices))
+
+        # Only the best of this batch can make the overall top_k
+        for key_idx in np.argsort(-iocs)[:top_k]:
+            initial_positions = " ".join(ALPHABET[position] for position in positions[key_idx])
+            candidate = (float(iocs[key_idx]), rotors, reflector, rings, initial_positions)
+
+            if len(best) < top_k: heapq.heappush(best, candidate)
+            else: heapq.heappushpop(best, candidate)
+
+    return sorted(best, reverse=True)
+
+
+def hill_climb_plugboard(ciphertext: str, rotors: str, reflector: str, ring_settings: str, initial_positions: str, scorer: object = TRIGRAM_SCORER, restarts: int = 3, iterations: int = 20, max_leads: int = 10, seed: int = None) -> tuple:
+    """
+    Phase two: searches for the plugboard that makes the decrypt score best. Returns (score, plugboard pairs, plaintext).
+
+    Each restart begins from random leads and makes passes over every pair of letters, keeping any rewiring
+    that improves the score, until a pass finds none or iterations passes have been made.
+    """
+    rng = random.Random(seed)
+
+    # The rotor states are fixed for this key, so the scramblers are worked out once
+    enigma = create_enigma_machine(rotors, reflector, ring_settings, initial_positions)
+    wiring_key = enigma.wiring_key()
+    scramblers = []
+    for _ in ciphertext:
+        enigma.step()
+        scramblers.append([ALPHABET_INDEX[char] for char in enigma.composite_table(wiring_key)])
+
+    code = [ALPHABET_INDEX[char] for char in ciphertext]
+
+    def decrypt(plugboard: list) -> list:
+        return [plugboard[scrambler[plugboard[char]]] for scrambler, char in zip(scramblers, code)]
+
+    def rewire(plugboard: list, i: int, j: int) -> list:
+
+        # Free both letters and whatever they were plugged to, then connect them unless they were already a lead
+        rewired = plugboard[:]
+        for letter in (i, j):
+            partner = rewired[letter]
+            rewired[partner], rewired[letter] = partner, letter
+
+        if plugboard[i] != j: rewired[i], rewired[j] = j, i
+        return rewired
+
+    best_score, best_plugboard = -math.inf, list(range(26))
+    for _ in range(restarts):
+
+        # 1. Random starting leads
+        plugboard = list(range(26))
+        letters = rng.sample(range(26), 2 * rng.randint(0, max_leads))
+        for i, j in zip(letters[::2], letters[1::2]):
+            plugboard[i], plugboard[j] = j, i
+
+        score = scorer(decrypt(plugboard))
+
+        # 2. Climb until no single rewiring improves the score
+        for _ in range(iterations):
+            improved = False
+            for i, j in itertools.combinations(range(26), 2):
+                rewired = rewire(plugboard, i, j)
+                if sum(1 for letter, partner in enumerate(rewired) if letter < partner) > max_leads: continue
+
+                rewired_score = scorer(decrypt(rewired))
+                if rewired_score > score:
+                    plugboard, score, improved = rewired, rewired_score, True
+
+            if not improved: break
+
+        if score > best_score: best_score, best_plugboard = score, plugboard
+
+    pairs = [ALPHABET[letter] + ALPHABET[partner] for letter, partner in enumerate(best_plugboard) if letter < partner]
+    return best_score, pairs, "".join(ALPHABET[char] for char in decrypt(best_plugboard))
+
+
+def ciphertext_only_attack(ciphertext: str, rotor_orders: list = None, reflectors: list = ["A", "B", "C"], ring_settings: list = ["01 01 01"], candidates: int = 10, top_k: int = 3, scorer: object = TRIGRAM_SCORER, restarts: int = 3, iterations: int = 20, seed: int = None) -> list:
+    """
+    Runs both phases and returns the top_k CiphertextOnlyResults, best first.
+
+    rotor_orders defaults to every order of three of the rotors I - V; candidates is how many phase one
+    settings go on to the plugboard search.
+    """
+    if rotor_orders is None: rotor_orders = [" ".join(order) for order in itertools.permutations(["I", "II", "III", "IV", "V"], 3)]
+
+    results = []
+    for ioc, rotors, reflector, rings, initial_positions in rank_rotor_settings(ciphertext, rotor_orders, reflectors, ring_settings, candidates):
+        score, pairs, plaintext = hill_climb_plugboard(ciphertext, rotors, reflector, rings, initial_positions, scorer, restarts, iterations, seed=seed)
+        results.append(CiphertextOnlyResult(score, rotors, reflector, rings, initial_positions, pairs, plaintext))
+
+    return sorted(results, reverse=True)[:top_k]
+
+
+if __name__ == "__main__":
+
+    # ------------- Test 1 -----------
+
+    # A message with no crib, 4 plug leads and unknown start positions
+    plaintext = (
+        "THESHIPSLEFTTHEPORTATDAWNANDSAILEDNORTHTOWARDSTHEISLANDSWHERETHEFLEETWASWAITINGFORORDERSFROMTHEADMIRAL"
+        "THECAPTAINREPORTEDTHATTHEENGINESWEREWORKINGWELLANDTHATTHECREWWASREADYFORTHELONGVOYAGEAHEADOFTHEM"
+    )
+    plugboard = ["QX", "AJ", "KZ", "MP"]
+    ciphertext = create_enigma_machine("II IV I", "B", "01 01 01", "K D W", plugboard).encode(plaintext)
+
+    # Phase one finds the start position with an empty plugboard
+    ranked = rank_rotor_settings(ciphertext, ["II IV I"], ["B"], top_k=5)
+    assert("K D W" in [initial_positions for *_, initial_positions in ranked])
+
+    # Phase two recovers the leads and the message
+    results = ciphertext_only_attack(ciphertext, ["II IV I"], ["B"], candidates=5, seed=0)
+    assert(results[0].plaintext == plaintext)
+    assert(set(results[0].plugboard_pairs) == {"".join(sorted(pair)) for pair in plugboard})
@@ -0,0 +1,230 @@
+from collections import deque
+
+from enigma import ALPHABET, ALPHABET_INDEX, possible_crib_offsets
+
+# Matching many cribs at once with an Aho-Corasick automaton.
+#
+# The cribs are compiled once into a state machine over the alphabet: after each letter of a decrypt, the state
+# is the longest tail of the text so far that starts some crib, and every crib ending there is reported. A decrypt
+# is scanned in one pass whatever the number of cribs, and the scan can run on letters as the machine produces
+# them, accepting a candidate at its first match or rejecting it once no allowed crib placement is left.
+
+
+class CribAutomaton:
+    """
+    Compiles cribs into an Aho-Corasick automaton.
+
+    offsets optionally restricts cribs to given start offsets, e.g. {"WETTER": [0, 1, 2]}; cribs missing from it
+    may sit anywhere.
+    """
+    def __init__(self, cribs: list, offsets: dict = None) -> None:
+        for crib in cribs:
+
+            # Raise error for cribs the machine could never decrypt to
+            if not crib or any(char not in ALPHABET_INDEX for char in crib): raise ValueError(crib)
+
+        self.cribs = list(cribs)
+        self.offsets = [None if offsets is None or crib not in offsets else frozenset(offsets[crib]) for crib in self.cribs]
+
+        # 1. Trie of the cribs: goto[state][letter] -> state, with the cribs that end at each state
+        goto, outputs, self.depth = [{}], [[]], [0]
+        for crib_id, crib in enumerate(self.cribs):
+            state = 0
+            for char in crib:
+                if char not in goto[state]:
+                    goto[state][char] = len(goto)
+                    goto.append({})
+                    outputs.append([])
+                    self.depth.append(self.depth[state] + 1)
+                state = goto[state][char]
+
+            outputs[state].append(crib_id)
+
+        # 2. Failure links breadth first, folded into a full table: transitions[state * 26 + letter] -> state
+        self.transitions = [0] * (26 * len(goto))
+        failure = [0] * len(goto)
+        queue = deque()
+
+        for letter_idx, letter in enumerate(ALPHABET):
+            next_state = goto[0].get(letter, 0)
+            self.transitions[letter_idx] = next_state
+            if next_state: queue.append(next_state)
+
+        while queue:
+            state = queue.popleft()
+
+            # A state also ends every crib its failure state ends, which is shallower and so already complete
+            outputs[state] = outputs[state] + outputs[failure[state]]
+
+            for letter_idx, letter in enumerate(ALPHABET):
+                next_state = goto[state].get(letter)
+                if next_state is None:
+                    self.transitions[state * 26 + letter_idx] = self.transitions[failure[state] * 26 + letter_idx]
+                else:
+                    failure[next_state] = self.transitions[failure[state] * 26 + letter_idx]
+                    self.transitions[state * 26 + letter_idx] = next_state
+                    queue.append(next_state)
+
+        self.outputs = [tuple(state_outputs) for state_outputs in outputs]
+
+    def allowed(self, crib_id: int, offset: int) -> bool:
+        return self.offsets[crib_id] is None or offset in self.offsets[crib_id]
+
+    def scan(self, text: str) -> list:
+        """
+        Returns every (offset, crib) at an allowed offset, in the order the cribs end. Other characters reset the scan.
+        """
+        transitions, outputs = self.transitions, self.outputs
+
+        matches, state = [], 0
+        for position, char in enumerate(text):
+            letter_idx = ALPHABET_INDEX.get(char)
+            state = 0 if letter_idx is None else transitions[state * 26 + letter_idx]
+
+            for crib_id in outputs[state]:
+                offset = position + 1 - len(self.cribs[crib_id])
+                if self.allowed(crib_id, offset): matches.append((offset, self.cribs[crib_id]))
+
+        return matches
+
+    def matches(self, text: str) -> bool:
+        """
+        True if any crib appears at an allowed offset, stopping at the first.
+        """
+        transitions, outputs = self.transitions, self.outputs
+
+        state = 0
+        for position, char in enumerate(text):
+            letter_idx = ALPHABET_INDEX.get(char)
+            state = 0 if letter_idx is None else transitions[state * 26 + letter_idx]
+
+            for crib_id in outputs[state]:
+                if self.allowed(crib_id, position + 1 - len(self.cribs[crib_id])): return True
+
+        return False
+
+    def scanner(self, ciphertext: str) -> object:
+        return CribScanner(self, ciphertext)
+
+
+class CribScanner:
+    """
+    Runs the automaton over the decrypt of one ciphertext as its letters arrive.
+
+    A crib can only sit where the ciphertext never has the same letter (Enigma never encrypts a letter to itself),
+    so the allowed offsets are narrowed to those once. After each letter, a candidate is accepted at its first
+    match, or rejected as soon as every allowed placement has been passed without one.
+    """
+    def __init__(self, automaton: CribAutomaton, ciphertext: str) -> None:
+        self.automaton = automaton
+
+        # Offsets each crib can still take for this ciphertext
+        self.allowed = []
+        for crib_id, crib in enumerate(automaton.cribs):
+            self.allowed.append(frozenset(offset for offset in possible_crib_offsets(ciphertext, crib) if automaton.allowed(crib_id, offset)))
+
+        # Past this offset no crib can start
+        self.last_offset = max((max(offsets) for offsets in self.allowed if offsets), default=-1)
+
+    def run(self, letters) -> bool:
+        """
+        Consumes letters (e.g. EnigmaMachine.encode_characters) until the candidate is decided.
+        Returns True on a match and False once none is possible.
+        """
+        transitions, outputs, depth = self.automaton.transitions, self.automaton.outputs, self.automaton.depth
+        cribs, allowed = self.automaton.cribs, self.allowed
+
+        state, read = 0, 0
+        for char in letters:
+            state = transitions[state * 26 + ALPHABET_INDEX[char]]
+            read += 1
+
+            for crib_id in outputs[state]:
+                if read - len(cribs[crib_id]) in allowed[crib_id]: return True
+
+            # A crib still in play started at most depth letters back, or has not started yet
+            if self.last_offset < read - depth[state]: return False
+
+        return False
+
+
+class AutomatonPredicate:
+    """
+    Accepts a decrypt containing any of the cribs at an allowed offset, like CribPredicate but for many cribs.
+
+    The screen decrypts letter by letter through the automaton, so most machines are rejected after their last
+    possible crib placement and matches are found without finishing the decrypt.
+    """
+    def __init__(self, cribs: list, offsets: dict = None) -> None:
+        self.automaton = CribAutomaton(cribs, offsets)
+
+        # Scanners worked out once per ciphertext
+        self.scanners = {}
+
+    def __getstate__(self) -> dict:
+
+        # The scanners are a cache, left out so a predicate pickles (and fingerprints) the same before and after use
+        return {"automaton": self.automaton}
+
+    def __setstate__(self, state: dict) -> None:
+        self.automaton = state["automaton"]
+        self.scanners = {}
+
+    def __call__(self, possible_message: str) -> bool:
+        return self.automaton.matches(possible_message)
+
+    def screen(self, enigma: object, ciphertext: str) -> bool:
+        """
+        Returns False if the machine cannot decrypt any crib into the ciphertext. The machine is left where it started.
+        """
+        if ciphertext not in self.scanners: self.scanners[ciphertext] = self.automaton.scanner(ciphertext)
+
+        start_positions = [rotor.position_index for rotor in enigma.rotors]
+        found = self.scanners[ciphertext].run(enigma.encode_characters(ciphertext))
+        enigma.set_positions(start_positions)
+
+        return found
+
+
+if __name__ == "__main__":
+
+    import random
+
+    from enigma import create_enigma_machine
+    from enigma_search import CribPredicate, KeySpace, search_messages
+
+    # ------------- Test 1 -----------
+
+    # Every occurrence of every crib, overlapping and nested ones included, as a naive scan finds them
+    rng = random.Random(0)
+    cribs = ["HE", "SHE", "HIS", "HERS", "WETTER", "ETT", "E"]
+    automaton = CribAutomaton(cribs)
+    for _ in range(200):
+        text = "".join(rng.choice("EHIRSTW") for _ in range(rng.randint(0, 40)))
+        naive = sorted((offset, crib) for crib in cribs for offset in range(len(text)) if text.startswith(crib, offset))
+        assert(sorted(automaton.scan(text)) == naive)
+        assert(automaton.matches(text) == bool(naive))
+
+    # Offsets restrict where a crib counts
+    automaton = CribAutomaton(["WETTER", "HEIL"], {"WETTER": [0]})
+    assert(automaton.scan("XWETTERHEIL") == [(7, "HEIL")])
+    assert(automaton.scan("WETTERXHEIL") == [(0, "WETTER"), (7, "HEIL")])
+
+    # ------------- Test 2 -----------
+
+    # Incremental scanning accepts and rejects the same candidates as a full decrypt, leaving the machine untouched
+    plaintext = "XXWETTERVORHERSAGEBISKAYAXXNORDWINDSTAERKEVIERXX"
+    ciphertext = create_enigma_machine("II IV V", "B", "02 21 12", "B L A").encode(plaintext)
+    predicate = AutomatonPredicate(["WETTER", "BISKAYA", "NORDWIND"], {"WETTER": range(5)})
+
+    for positions in ["B L A", "B L B", "A A A", "Q E V"]:
+        enigma = create_enigma_machine("II IV V", "B", "02 21 12", positions)
+        found = predicate.screen(enigma, ciphertext)
+        assert(" ".join(rotor.position for rotor in enigma.rotors) == positions)
+        assert(found == predicate(enigma.encode(ciphertext)))
+
+    # ------------- Test 3 -----------
+
+    # The same hits as the substring predicate over a keyspace
+    keyspace = KeySpace(["II IV V"], ["B"], ["02 21 12"], [" ".join(positions) for positions in ["BLA", "BLB", "CLA", "BKA"]])
+    assert(search_messages(keyspace, ciphertext, predicate, processes=1) == search_messages(keyspace, ciphertext, CribPredicate(["WETTER", "BISKAYA", "NORDWIND"]), processes=1) == [plaintext])
@@ -0,0 +1,472 @@
+import argparse, json, os, pickle, socket, sys, time
+from multiprocessing import Process
+
+from enigma_search import ResultCollector, SearchProgress, _init_worker, _search_chunk, keyspace_chunks, search_fingerprint
+
+# Key searches split into shards that workers on several machines claim through a shared directory.
+#
+#   python enigma_distributed.py create /shared/search --search code_three     once, by the coordinator
+#   python enigma_distributed.py worker /shared/search                          on every node, as many as it has cores
+#   python enigma_distributed.py collect /shared/search                         any time, for progress and hits
+#   python enigma_distributed.py run /shared/search --workers 4                 workers as local processes
+#
+# The directory holds the manifest (shard ranges and the search, pickled), a claim file per shard being worked on
+# and a result file per shard finished. A claim is created with O_EXCL so only one worker wins it, and the worker
+# touches it as it goes. A claim whose worker died - its process is gone, or it has not been touched for the
+# lease - is taken over with an O_EXCL claim of the next generation, so of the workers that see it die only one takes
+# the shard on, and every shard is finished however many workers are lost.
+# Results are written atomically and depend only on the shard, so a shard finished twice does no harm.
+
+DEFAULT_SHARD_SIZE = 4096
+DEFAULT_LEASE = 300.0
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class ShardManifest:
+    """
+    A search split into [start, stop) shards of key indices, in a directory shared by its workers.
+    """
+    MANIFEST = "manifest.json"
+    SEARCH = "search.pickle"
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+        with open(os.path.join(directory, self.MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        self.search_id = manifest["search_id"]
+        self.fingerprint = manifest["fingerprint"]
+        self.keys_total = manifest["keys_total"]
+        self.shards = [tuple(shard) for shard in manifest["shards"]]
+        self.lease = manifest["lease_seconds"]
+
+        # The keyspace, ciphertext, predicate and composite flag, loaded when a worker first needs them
+        self._search = None
+
+        # Shard -> generation of the claims this process holds
+        self.claimed = {}
+
+    @classmethod
+    def create(cls, directory: str, keyspace: object, ciphertext: str, accept: object, composite: bool = False, shard_size: int = DEFAULT_SHARD_SIZE, search_id: object = None, lease: float = DEFAULT_LEASE) -> object:
+        """
+        Writes the manifest for a search, or opens the one already there so an interrupted search carries on.
+        search_id is any JSON value naming the search. Raises ValueError if the directory holds a different search,
+        whether its id, keyspace or predicate differ.
+        """
+        fingerprint = search_fingerprint(keyspace, accept)
+        if search_id is None: search_id = [len(keyspace), fingerprint]
+        search_id = json.loads(json.dumps(search_id))
+
+        if os.path.exists(os.path.join(directory, cls.MANIFEST)):
+            manifest = cls(directory)
+
+            # Raise error if the directory belongs to another search
+            if manifest.search_id != search_id or manifest.keys_total != len(keyspace) or manifest.fingerprint != fingerprint: raise ValueError(directory)
+            return manifest
+
+        for subdirectory in ("claims", "results"): os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+        # 1. The search itself, for workers to load
+        with open(os.path.join(directory, cls.SEARCH), "wb") as search_file:
+            pickle.dump((keyspace, ciphertext, accept, composite), search_file)
+
+        # 2. The manifest last, so a worker never sees one without its search
+        manifest = {
+            "search_id": search_id,
+            "fingerprint": fingerprint,
+            "keys_total": len(keyspace),
+            "shards": keyspace_chunks(len(keyspace), shard_size),
+            "lease_seconds": lease
+        }
+
+        temporary_path = os.path.join(directory, cls.MANIFEST + ".tmp")
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.replace(temporary_path, os.path.join(directory, cls.MANIFEST))
+
+        return cls(directory)
+
+    def search(self) -> tuple:
+        if self._search is None:
+            with open(os.path.join(self.directory, self.SEARCH), "rb") as search_file:
+                self._search = pickle.load(search_file)
+
+        return self._search
+
+    def claim_path(self, shard_idx: int, generation: int) -> str:
+        return os.path.join(self.directory, "claims", "shard-%06d.claim.%d" % (shard_idx, generation))
+
+    def result_path(self, shard_idx: int) -> str:
+        return os.path.join(self.directory, "results", "shard-%06d.json" % shard_idx)
+
+    def finished(self, shard_idx: int) -> bool:
+        return os.path.exists(self.result_path(shard_idx))
+
+    def generation(self, shard_idx: int) -> int:
+        """
+        Generation of a shard's current claim, -1 if it was never claimed. Each take over adds one.
+        """
+        generation = -1
+        while os.path.exists(self.claim_path(shard_idx, generation + 1)): generation += 1
+        return generation
+
+    def stale(self, shard_idx: int, generation: int) -> bool:
+        """
+        True if a claim belongs to a worker that has died: its process is gone from this host, or the claim has not
+        been touched for the lease.
+        """
+        path = self.claim_path(shard_idx, generation)
+        try:
+            touched = os.path.getmtime(path)
+            with open(path) as claim_file:
+                claim = json.load(claim_file)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+
+            # Still being written, or its worker died before it could say who it was
+            claim = None
+
+        if claim is not None and claim["host"] == socket.gethostname() and not process_alive(claim["pid"]): return True
+        return time.time() - touched > self.lease
+
+    def claimable(self, shard_idx: int) -> bool:
+        if self.finished(shard_idx): return False
+
+        generation = self.generation(shard_idx)
+        return generation < 0 or self.stale(shard_idx, generation)
+
+    def try_claim(self, shard_idx: int, generation: int, worker_id: str) -> bool:
+        """
+        Creates a shard's claim of the given generation, failing if any worker already has.
+        """
+        try:
+            claim_fd = os.open(self.claim_path(shard_idx, generation), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(claim_fd, "w") as claim_file:
+            json.dump({"worker": worker_id, "host": socket.gethostname(), "pid": os.getpid()}, claim_file)
+
+        self.claimed[shard_idx] = generation
+        return True
+
+    def claim(self, worker_id: str) -> int:
+        """
+        Claims the first shard that is neither finished nor held by a live worker. Returns its index, or None.
+
+        A dead worker's claim is never removed: it is overtaken by a claim of the next generation, created with
+        O_EXCL. Workers that all judged the same claim stale race for one file, and only one can create it.
+        """
+        for shard_idx in range(len(self.shards)):
+            if self.finished(shard_idx): continue
+
+            generation = self.generation(shard_idx)
+            if generation >= 0 and not self.stale(shard_idx, generation): continue
+            if not self.try_claim(shard_idx, generation + 1, worker_id): continue
+
+            # A result may have landed since the check above
+            if self.finished(shard_idx):
+                os.remove(self.claim_path(shard_idx, generation + 1))
+                continue
+
+            return shard_idx
+
+        return None
+
+    def heartbeat(self, shard_idx: int) -> None:
+        os.utime(self.claim_path(shard_idx, self.claimed[shard_idx]))
+
+    def complete(self, shard_idx: int, hits: list, screened_out: int, worker_id: str, elapsed: float) -> None:
+        """
+        Records a shard's (index, message) hits and drops its claims, every generation.
+        """
+        result = {"shard": list(self.shards[shard_idx]), "hits": hits, "screened_out": screened_out, "worker": worker_id, "elapsed_seconds": elapsed}
+
+        temporary_path = "%s.%s.tmp" % (self.result_path(shard_idx), worker_id)
+        with open(temporary_path, "w") as result_file:
+            json.dump(result, result_file)
+        os.replace(temporary_path, self.result_path(shard_idx))
+
+        claim_prefix = os.path.basename(self.claim_path(shard_idx, 0))[:-1]
+        for claim_name in os.listdir(os.path.join(self.directory, "claims")):
+            if not claim_name.startswith(claim_prefix): continue
+
+            try:
+                os.remove(os.path.join(self.directory, "claims", claim_name))
+            except FileNotFoundError:
+                pass
+
+    def load_result(self, shard_idx: int) -> dict:
+        with open(self.result_path(shard_idx)) as result_file:
+            return json.load(result_file)
+
+    def status(self) -> dict:
+        """
+        Number of shards finished, claimed by live workers and waiting (including those of dead workers).
+        """
+        counts = {"finished": 0, "claimed": 0, "waiting": 0}
+        for shard_idx in range(len(self.shards)):
+            if self.finished(shard_idx): counts["finished"] += 1
+            elif self.claimable(shard_idx): counts["waiting"] += 1
+            else: counts["claimed"] += 1
+
+        return counts
+
+    def done(self) -> bool:
+        return all(self.finished(shard_idx) for shard_idx in range(len(self.shards)))
+
+    def progress(self, path: str = None) -> SearchProgress:
+        """
+        The finished shards as a SearchProgress, saved to path if given (by default progress.json in the directory).
+        search() resumes from it, given the same keyspace, ciphertext and predicate.
+        """
+        if path is None: path = os.path.join(self.directory, "progress.json")
+        ciphertext = self.search()[1]
+
+        # Rebuilt from the results every time rather than resumed
+        if os.path.exists(path): os.remove(path)
+        # Under the id search() checks its checkpoints against
+        progress = SearchProgress(path, ciphertext, [self.keys_total, self.fingerprint])
+
+        for shard_idx in range(len(self.shards)):
+            if self.finished(shard_idx):
+                result = self.load_result(shard_idx)
+                progress.record(self.shards[shard_idx], [tuple(hit) for hit in result["hits"]])
+                progress.previous_elapsed += result["elapsed_seconds"]
+
+        progress.save()
+        return progress
+
+    def results(self) -> list:
+        """
+        (index, key, message) for every hit of the finished shards, in keyspace order.
+        """
+        keyspace = self.search()[0]
+
+        hits = []
+        for shard_idx in range(len(self.shards)):
+            if self.finished(shard_idx): hits += [(index, keyspace.key(index), possible_message) for index, possible_message in self.load_result(shard_idx)["hits"]]
+
+        return sorted(hits, key=lambda hit: hit[0])
+
+    def top(self, k: int = 10, score: object = None) -> list:
+        """
+        The k best distinct decrypts of the finished shards as SearchResults, best first, merged shard by shard.
+        """
+        keyspace = self.search()[0]
+
+        collector = ResultCollector(k, score)
+        for shard_idx in range(len(self.shards)):
+            if not self.finished(shard_idx): continue
+
+            shard_collector = ResultCollector(k, score)
+            for index, possible_message in self.load_result(shard_idx)["hits"]: shard_collector.add(index, keyspace.key(index), possible_message)
+            collector.merge(shard_collector)
+
+        return collector.results()
+
+
+def run_worker(directory: str, worker_id: str = None, chunksize: int = 256) -> int:
+    """
+    Claims and runs shards until none is left to claim, touching the claim every chunksize keys.
+    Returns the number of shards this worker finished.
+    """
+    if worker_id is None: worker_id = "%s-%d" % (socket.gethostname(), os.getpid())
+
+    manifest = ShardManifest(directory)
+    _init_worker(*manifest.search())
+
+    shards_finished = 0
+    shard_idx = manifest.claim(worker_id)
+    while shard_idx is not None:
+        started = time.time()
+        start, stop = manifest.shards[shard_idx]
+
+        hits, screened_out = [], 0
+        for chunk in keyspace_chunks(stop, chunksize, start):
+            chunk, chunk_hits, chunk_screened_out = _search_chunk(chunk)
+            hits += [(index, possible_message) for index, key, possible_message in chunk_hits]
+            screened_out += chunk_screened_out
+            manifest.heartbeat(shard_idx)
+
+        manifest.complete(shard_idx, hits, screened_out, worker_id, time.time() - started)
+        shards_finished += 1
+
+        shard_idx = manifest.claim(worker_id)
+
+    return shards_finished
+
+
+def run_local(directory: str, workers: int = None, poll_interval: float = 0.5) -> list:
+    """
+    Runs the search in a manifest directory with worker processes standing in for nodes, starting a new worker
+    whenever one dies with shards left. Returns the hits in keyspace order.
+    """
+    if workers is None: workers = os.cpu_count() or 1
+    manifest = ShardManifest(directory)
+
+    processes, started = [], 0
+    while not manifest.done():
+        processes = [process for process in processes if process.is_alive()]
+
+        # Top the workers up while any shard is waiting, e.g. one a dead worker left behind
+        waiting = manifest.status()["waiting"]
+        while len(processes) < workers and waiting:
+            process = Process(target=run_worker, args=(directory, "local-%d" % started))
+            process.start()
+            processes.append(process)
+            started += 1
+            waiting -= 1
+
+        time.sleep(poll_interval)
+
+    for process in processes: process.join()
+
+    return manifest.results()
+
+
+def main(argv: list = None) -> int:
+    import enigma
+
+    parser = argparse.ArgumentParser(description="Split a key search into shards and run them on several machines.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    create = commands.add_parser("create", help="write the manifest for a search")
+    create.add_argument("directory")
+    create.add_argument("--search", required=True, choices=["code_three", "code_four"], help="search to shard")
+    create.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE, help="keys per shard (default: %(default)s)")
+    create.add_argument("--lease", type=float, default=DEFAULT_LEASE, help="seconds without a heartbeat before a shard is re-issued (default: %(default)s)")
+
+    worker = commands.add_parser("worker", help="claim and run shards until none is left")
+    worker.add_argument("directory")
+    worker.add_argument("--worker-id", help="name recorded with the shards this worker finishes")
+
+    run = commands.add_parser("run", help="run every shard with local worker processes")
+    run.add_argument("directory")
+    run.add_argument("--workers", type=int, help="worker processes (default: one per core)")
+
+    collect = commands.add_parser("collect", help="print progress and the hits so far")
+    collect.add_argument("directory")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "create":
+        keyspace, ciphertext, accept, composite = getattr(enigma, args.search + "_search")()
+        search_id = [args.search, search_fingerprint(keyspace, accept)]
+        manifest = ShardManifest.create(args.directory, keyspace, ciphertext, accept, composite, shard_size=args.shard_size, search_id=search_id, lease=args.lease)
+        print("%d keys in %d shards" % (manifest.keys_total, len(manifest.shards)))
+    elif args.command == "worker":
+        print("finished %d shards" % run_worker(args.directory, args.worker_id))
+    else:
+        if args.command == "run": run_local(args.directory, args.workers)
+
+        manifest = ShardManifest(args.directory)
+        print("%(finished)d finished, %(claimed)d claimed, %(waiting)d waiting" % manifest.status())
+        for index, key, possible_message in manifest.results(): print(index, " / ".join(str(setting) for setting in key), possible_message)
+
+    return 0
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1: sys.exit(main())
+
+    import signal, tempfile
+
+    from enigma import code_four, code_four_search
+    from enigma_search import CribPredicate, CribScore, search_messages
+
+    expected = code_four()
+
+    # ------------- Test 1 -----------
+
+    # Local workers standing in for nodes find the same hits as the pool search
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = ShardManifest.create(directory, *code_four_search(), shard_size=16)
+        assert(len(manifest.shards) == 9)
+
+        hits = run_local(directory, workers=3, poll_interval=0.05)
+        assert([possible_message for index, key, possible_message in hits] == expected)
+        assert(manifest.status() == {"finished": 9, "claimed": 0, "waiting": 0})
+
+        # Merged per shard into the best decrypts (tied on score, so in keyspace order), and recorded as a finished search
+        assert([result.message for result in manifest.top(3, CribScore(["TUTOR"]))] == expected[:3])
+        assert(manifest.progress().completed == [(0, manifest.keys_total)])
+
+        # The same search reopens the manifest; another is refused, including one of the same size on the same message
+        assert(ShardManifest.create(directory, *code_four_search(), shard_size=16).shards == manifest.shards)
+        keyspace, code, accept, composite = code_four_search()
+        for other_search, search_id in [((keyspace, code, accept, composite), "another"), ((keyspace, code, CribPredicate(["TEACHER"], anchored=True), composite), None)]:
+            try:
+                ShardManifest.create(directory, *other_search, search_id=search_id)
+                assert(False)
+            except ValueError:
+                pass
+
+    # ------------- Test 2 -----------
+
+    # Shards held by dead workers are re-issued: one whose process is gone, and one past its lease on another host
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = ShardManifest.create(directory, *code_four_search(), shard_size=16, lease=60.0)
+
+        dead_process = Process(target=time.sleep, args=(60,))
+        dead_process.start()
+        os.kill(dead_process.pid, signal.SIGKILL)
+        dead_process.join()
+
+        with open(manifest.claim_path(0, 0), "w") as claim_file:
+            json.dump({"worker": "dead", "host": socket.gethostname(), "pid": dead_process.pid}, claim_file)
+        with open(manifest.claim_path(1, 0), "w") as claim_file:
+            json.dump({"worker": "silent", "host": "elsewhere", "pid": os.getpid()}, claim_file)
+        os.utime(manifest.claim_path(1, 0), (time.time() - 120, time.time() - 120))
+
+        # A live claim is left alone
+        with open(manifest.claim_path(2, 0), "w") as claim_file:
+            json.dump({"worker": "busy", "host": "elsewhere", "pid": os.getpid()}, claim_file)
+
+        assert(manifest.status() == {"finished": 0, "claimed": 1, "waiting": 8})
+        assert(run_worker(directory, "survivor") == 8)
+        assert(manifest.status() == {"finished": 8, "claimed": 1, "waiting": 0})
+
+        # The finished shards export as a checkpoint a pool search resumes, trying only the shard still claimed
+        progress = manifest.progress()
+        assert(progress.completed == [(0, 32), (48, manifest.keys_total)])
+        assert(search_messages(*code_four_search()[:3], processes=1, composite=True, checkpoint=progress.path) == expected)
+
+        # Once its lease runs out, the last shard goes too
+        os.utime(manifest.claim_path(2, 0), (time.time() - 120, time.time() - 120))
+        assert(run_worker(directory, "survivor") == 1)
+        assert(manifest.done() and [possible_message for index, key, possible_message in manifest.results()] == expected)
+        assert(os.listdir(os.path.join(directory, "claims")) == [])
+
+    # ------------- Test 3 -----------
+
+    # Workers that both saw a claim go stale race for the next generation, and only the first gets the shard
+    with tempfile.TemporaryDirectory() as directory:
+        manifest = ShardManifest.create(directory, *code_four_search(), shard_size=16, lease=60.0)
+        rival = ShardManifest(directory)
+
+        with open(manifest.claim_path(0, 0), "w") as claim_file:
+            json.dump({"worker": "silent", "host": "elsewhere", "pid": os.getpid()}, claim_file)
+        os.utime(manifest.claim_path(0, 0), (time.time() - 120, time.time() - 120))
+        assert(manifest.stale(0, 0) and rival.stale(0, 0))
+
+        assert(manifest.try_claim(0, 1, "first") and not rival.try_claim(0, 1, "second"))
+        assert(manifest.generation(0) == 1 and not rival.claimable(0))
+        assert(rival.claim("second") == 1 and manifest.claimed == {0: 1} and rival.claimed == {1: 0})
+
+        # Heartbeats go to the generation each worker holds
+        manifest.heartbeat(0)
+        assert(os.path.getmtime(manifest.claim_path(0, 0)) < os.path.getmtime(manifest.claim_path(0, 1)) - 60)
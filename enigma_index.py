@@ -0,0 +1,231 @@
+import bisect, os
+from array import array
+
+from enigma import ALPHABET, ALPHABET_INDEX, SteppingSchedule, open_mapped_file, save_mapped_file, stepping_period
+
+# An inverted index from letter pairs to rotor states, for finding start positions from a crib in milliseconds.
+#
+# At every rotor state the rotors and reflector swap the letters in 13 pairs. For one wiring (rotor order,
+# reflector and ring settings) the index lists, for each pair, the states that swap it. A crib letter p over
+# ciphertext letter c, k letters into the message, then allows only the start states k + 1 steps before a state
+# in the posting list of (p, c), and the start states a whole crib allows are the intersection over its letters.
+#
+# States are numbered by when the rotors reach them, so stepping back is a subtraction: without double stepping the
+# moving rotors turn like an odometer, and every state lies on a cycle of period states that all start positions
+# on it walk through in the same order. One index serves every message sent under the wiring, whatever its
+# start position, and saved indices are opened as memory maps so worker processes share one copy.
+
+
+class CribStateIndex:
+    """
+    States of one wiring by the letter pairs they swap.
+
+    Times are cycle * period + step: order[time] is the state reached at that time.
+    postings[offsets[a * 26 + b]:offsets[a * 26 + b + 1]] holds, sorted, the times of the states swapping a and b
+    (alphabet indices, a < b).
+    """
+    MAGIC = b"ENIGMA-INDEX\n"
+
+    def __init__(self, wiring_key: tuple, number_of_rotors: int, period: int, order, offsets, postings) -> None:
+        self.wiring_key = wiring_key
+        self.number_of_rotors = number_of_rotors
+        self.period = period
+        self.order = order
+        self.offsets = offsets
+        self.postings = postings
+
+    @classmethod
+    def build(cls, enigma: object) -> object:
+        """
+        Indexes the machine's wiring from its state table. The plugboard plays no part.
+        """
+        table = enigma.state_table().table
+        number_of_rotors = len(enigma.rotors)
+        period = stepping_period(enigma)
+        notch_indices = tuple(rotor.notch_index for rotor in enigma.rotors)
+
+        # 1. Order the states along their stepping cycles
+        order, seen = array("I"), bytearray(26 ** number_of_rotors)
+        for state in range(26 ** number_of_rotors):
+            if seen[state]: continue
+
+            schedule = SteppingSchedule(notch_indices, positions_of(state, number_of_rotors), period)
+            for char_idx in range(period):
+
+                # The cycle starts with state itself, which the schedule reaches on its last character
+                cycle_state = 0
+                for position_index in schedule.state((char_idx - 1) % period): cycle_state = cycle_state * 26 + position_index
+
+                order.append(cycle_state)
+                seen[cycle_state] = 1
+
+        # 2. Posting list of times for every swapped pair
+        postings_by_pair = [array("I") for _ in range(26 * 26)]
+        for time, state in enumerate(order):
+            row = table[state * 26:(state + 1) * 26]
+            for letter_idx in range(26):
+                if letter_idx < row[letter_idx]: postings_by_pair[letter_idx * 26 + row[letter_idx]].append(time)
+
+        # 3. Flatten
+        offsets, postings = array("I", [0]), array("I")
+        for pair_postings in postings_by_pair:
+            postings.extend(pair_postings)
+            offsets.append(len(postings))
+
+        return cls(enigma.wiring_key(), number_of_rotors, period, order, offsets, postings)
+
+    def posting(self, a: int, b: int):
+        """
+        Sorted times of the states swapping alphabet indices a and b.
+        """
+        if a > b: a, b = b, a
+        return self.postings[self.offsets[a * 26 + b]:self.offsets[a * 26 + b + 1]]
+
+    def later(self, time: int, steps: int) -> int:
+        """
+        Time steps after time, along the same cycle.
+        """
+        cycle_start = time - time % self.period
+        return cycle_start + (time - cycle_start + steps) % self.period
+
+    def start_positions(self, crib: str, ciphertext: str, offset: int = 0, plugboard_pairs: list = ()) -> list:
+        """
+        Start positions, e.g. ['A B C', ...], from which a crib could sit under the ciphertext at offset. Crib letters
+        must be unplugged, or go through known plugboard_pairs.
+        """
+        # Raise error if the crib runs off the ciphertext
+        if offset < 0 or offset + len(crib) > len(ciphertext): raise ValueError(offset)
+
+        connections = {}
+        for pair in plugboard_pairs:
+            connections[pair[0]], connections[pair[1]] = pair[1], pair[0]
+
+        # 1. The pair each crib letter needs, and how many steps into the message
+        alignment = []
+        for char_idx, (plain_char, cipher_char) in enumerate(zip(crib, ciphertext[offset:])):
+
+            # Raise error for letters outside the alphabet
+            if plain_char not in ALPHABET_INDEX or cipher_char not in ALPHABET_INDEX: raise ValueError(plain_char + cipher_char)
+
+            a, b = ALPHABET_INDEX[connections.get(plain_char, plain_char)], ALPHABET_INDEX[connections.get(cipher_char, cipher_char)]
+
+            # No state sends a letter to itself
+            if a == b: return []
+
+            alignment.append((offset + char_idx + 1, self.posting(a, b)))
+
+        if not alignment: raise ValueError(crib)
+
+        # 2. Start times from the shortest posting list, narrowed by each of the others
+        alignment.sort(key=lambda steps_and_posting: len(steps_and_posting[1]))
+        steps, posting = alignment[0]
+        start_times = [self.later(time, -steps) for time in posting]
+
+        for steps, posting in alignment[1:]:
+            narrowed = []
+            for start_time in start_times:
+                time = self.later(start_time, steps)
+                found = bisect.bisect_left(posting, time)
+                if found < len(posting) and posting[found] == time: narrowed.append(start_time)
+
+            start_times = narrowed
+            if not start_times: break
+
+        return sorted(" ".join(ALPHABET[position_index] for position_index in positions_of(self.order[start_time], self.number_of_rotors)) for start_time in start_times)
+
+    def save(self, path: str) -> None:
+        """
+        Writes order, offsets and postings after a one line JSON header.
+        """
+        header = {
+            "wiring_key": [list(self.wiring_key[0]), self.wiring_key[1], list(self.wiring_key[2])],
+            "period": self.period,
+            "postings": len(self.postings)
+        }
+        save_mapped_file(path, self.MAGIC, header, [array("I", integers) for integers in (self.order, self.offsets, self.postings)])
+
+    @classmethod
+    def open(cls, path: str) -> object:
+        """
+        Memory maps an index written by save. Raises ValueError if the file is not an index.
+        """
+        header, sections = open_mapped_file(
+            path, cls.MAGIC, lambda header: [4 * 26 ** len(header["wiring_key"][0]), 4 * (26 * 26 + 1), 4 * header["postings"]]
+        )
+
+        rotor_mappings, reflector_mapping, ring_settings = header["wiring_key"]
+        order, offsets, postings = [section.cast("I") for section in sections]
+        return cls((tuple(rotor_mappings), reflector_mapping, tuple(ring_settings)), len(rotor_mappings), header["period"], order, offsets, postings)
+
+
+def positions_of(state: int, number_of_rotors: int) -> tuple:
+    """
+    Rotor positions as alphabet indices of a state, e.g. 28 -> (0, 1, 2) for three rotors.
+    """
+    positions = []
+    for _ in range(number_of_rotors):
+        state, position_index = divmod(state, 26)
+        positions.append(position_index)
+
+    return tuple(positions[::-1])
+
+
+if __name__ == "__main__":
+
+    import itertools, tempfile
+
+    from enigma import create_enigma_machine
+
+    # ------------- Test 1 -----------
+
+    # Every start position a brute force sweep accepts, and no other
+    enigma = create_enigma_machine("I II III", "B", "01 05 09", "A A A")
+    index = CribStateIndex.build(enigma)
+    assert(sorted(index.order) == list(range(26 ** 3)))
+
+    plaintext = "WETTERVORHERSAGE"
+    ciphertext = create_enigma_machine("I II III", "B", "01 05 09", "Q D V").encode("XX" + plaintext)
+    found = index.start_positions(plaintext[:6], ciphertext, 2)
+
+    swept = []
+    for positions in itertools.product(ALPHABET, repeat=3):
+        if create_enigma_machine("I II III", "B", "01 05 09", " ".join(positions)).encode(ciphertext)[2:8] == plaintext[:6]: swept.append(" ".join(positions))
+    assert(found == swept and "Q D V" in found)
+
+    # A longer crib leaves the true start alone
+    assert(index.start_positions(plaintext, ciphertext, 2) == ["Q D V"])
+
+    # ------------- Test 2 -----------
+
+    # Rotors that never move give shorter cycles; known plug leads are taken off first
+    plugboard = ["VH", "PT", "ZG", "BJ", "EY", "FS"]
+    enigma = create_enigma_machine("II Gamma IV", "C", "23 02 10", "A A A")
+    index = CribStateIndex.build(enigma)
+    assert(index.period == 26 * 26)
+
+    ciphertext = create_enigma_machine("II Gamma IV", "C", "23 02 10", "K R Z", plugboard).encode("UNIVERSITYOFBATH")
+    assert("K R Z" in index.start_positions("UNIVERSITY", ciphertext, 0, plugboard))
+    assert(index.start_positions("U", "U") == [])
+
+    # ------------- Test 3 -----------
+
+    # A saved index answers the same from its memory map
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "index.bin")
+        index.save(path)
+        opened = CribStateIndex.open(path)
+
+        assert(opened.wiring_key == enigma.wiring_key() and opened.period == index.period)
+        assert(opened.start_positions("UNIVERSITY", ciphertext, 0, plugboard) == index.start_positions("UNIVERSITY", ciphertext, 0, plugboard))
+        del opened
+
+    # ------------- Test 4 -----------
+
+    # code_two's start position from every offset of its crib, without sweeping positions
+    code = "CMFSUPKNCBMUYEQVVDYKLRQZTPUFHSWWAKTUGXMPAMYAFITXIJKMH"
+    plugboard = ["VH", "PT", "ZG", "BJ", "EY", "FS"]
+    index = CribStateIndex.build(create_enigma_machine("Beta I III", "B", "23 02 10", "A A A"))
+
+    found = [(offset, positions) for offset in range(len(code) - 9) for positions in index.start_positions("UNIVERSITY", code, offset, plugboard)]
+    assert(found == [(22, "I M G")])
+    assert("UNIVERSITY" in create_enigma_machine("Beta I III", "B", "23 02 10", "I M G", plugboard).encode(code))
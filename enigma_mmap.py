@@ -0,0 +1,254 @@
+import mmap, os
+import numpy as np
+
+from enigma import ALPHABET, ALPHABET_INDEX, NON_ALPHABET_POLICIES, stepping_period
+
+# Bulk encoding of large files as raw bytes through memory maps.
+#
+# Without double stepping the rotors turn like an odometer, so a machine returns to its start positions after
+# 26 ** (number of rotors that ever move) letters. For each rotor state in that cycle a 256-entry table
+# translates every byte: letters through plugboard, rotors, reflector and back, other bytes to themselves.
+# Encoding a chunk is then one gather, tables[state of each letter, byte], with no Python objects per byte.
+
+DEFAULT_CHUNK_SIZE = 1 << 22
+
+
+def byte_indices(uppercase: bool = False) -> np.ndarray:
+    """
+    Alphabet index of every byte value, -1 outside the alphabet. With uppercase, lower case letters count as capitals.
+    """
+    indices = np.full(256, -1, dtype=np.int16)
+    for letter, index in ALPHABET_INDEX.items():
+        indices[ord(letter)] = index
+        if uppercase: indices[ord(letter.lower())] = index
+
+    return indices
+
+
+def translation_tables(enigma: object, uppercase: bool = False) -> np.ndarray:
+    """
+    Returns a (period, 256) uint8 array: row k translates any byte at the (k + 1)th letter from the machine's
+    current positions.
+    """
+    connections = enigma.plugboard.connections
+
+    # Composite substitutions come from the machine's full-cycle state table
+    state_table = enigma.state_table()
+
+    period = stepping_period(enigma)
+    schedule = enigma.stepping_schedule(period)
+
+    # Every row starts as the identity, so bytes outside the alphabet translate to themselves
+    tables = np.tile(np.arange(256, dtype=np.uint8), (period, 1))
+    letters = [letter for letter in ALPHABET] + ([letter.lower() for letter in ALPHABET] if uppercase else [])
+
+    for state_idx in range(period):
+
+        # plugboard -> composite substitution of the rotors and reflector at this state -> plugboard
+        state = state_table.state(schedule.state(state_idx))
+        composite_table = state_table.table[state * 26:(state + 1) * 26]
+
+        row = tables[state_idx]
+        for letter in letters:
+            capital = letter.upper()
+            encrypted_char = ALPHABET[composite_table[ALPHABET_INDEX[connections.get(capital, capital)]]]
+            row[ord(letter)] = ord(connections.get(encrypted_char, encrypted_char))
+
+    return tables
+
+
+class BulkEncoder:
+    """
+    Encodes bytes with a machine's key through its translation tables, carrying the rotor state from one chunk
+    to the next. Call finish() to move the machine to the positions encode would have left it in.
+    """
+    def __init__(self, enigma: object, non_alphabet: str = "keep", uppercase: bool = False) -> None:
+        if non_alphabet not in NON_ALPHABET_POLICIES: raise ValueError(non_alphabet)
+
+        self.enigma = enigma
+        self.non_alphabet = non_alphabet
+        self.period = stepping_period(enigma)
+
+        # Flattened so a letter at state s with byte b is one lookup at s * 256 + b
+        self.tables = translation_tables(enigma, uppercase).reshape(-1)
+        self.indices = byte_indices(uppercase)
+
+        # Letters encoded so far
+        self.letters = 0
+
+    def encode_chunk(self, data: np.ndarray, out: np.ndarray) -> int:
+        """
+        Encodes a uint8 array into out (at least as long), returning the number of bytes written.
+        """
+        is_letter = self.indices[data] >= 0
+
+        # 1. Under "error" nothing is written if the chunk has a byte outside the alphabet
+        if self.non_alphabet == "error" and not is_letter.all():
+            raise ValueError(bytes([data[np.argmin(is_letter)]]))
+
+        # 2. State of every byte: how many letters precede it, around the stepping cycle. Only letters step the rotors
+        states = np.cumsum(is_letter, dtype=np.int64)
+        states += self.letters - 1
+        states %= self.period
+        self.letters += int(np.count_nonzero(is_letter))
+
+        # 3. One gather through the tables
+        states *= 256
+        states += data
+        encoded = self.tables[states]
+
+        if self.non_alphabet == "drop": encoded = encoded[is_letter]
+
+        out[:encoded.size] = encoded
+        return encoded.size
+
+    def finish(self) -> None:
+        if self.letters:
+            schedule = self.enigma.stepping_schedule(self.period)
+            self.enigma.set_positions(schedule.state((self.letters - 1) % self.period))
+            self.letters = 0
+
+
+def encode_bytes(enigma: object, data: bytes, non_alphabet: str = "keep", uppercase: bool = False) -> bytes:
+    """
+    Encodes a bytes-like object in memory, e.g. encode_bytes(enigma, b"HELLO WORLD").
+    """
+    encoder = BulkEncoder(enigma, non_alphabet, uppercase)
+    out = np.empty(len(data), dtype=np.uint8)
+    written = encoder.encode_chunk(np.frombuffer(data, dtype=np.uint8), out)
+    encoder.finish()
+    return out[:written].tobytes()
+
+
+def encode_mmap(enigma: object, input_path: str, output_path: str, non_alphabet: str = "keep", uppercase: bool = False, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    Encodes one file into another through memory maps, a chunk at a time so memory use stays flat. The same path
+    for both encodes the file in place. Returns the number of bytes written; under "drop" the output file is
+    truncated to that.
+    """
+    encoder = BulkEncoder(enigma, non_alphabet, uppercase)
+    size = os.path.getsize(input_path)
+
+    in_place = os.path.exists(output_path) and os.path.samefile(input_path, output_path)
+
+    # The output never needs more room than the input
+    if not in_place:
+        with open(output_path, "wb") as output_file:
+            output_file.truncate(size)
+
+    if size == 0: return 0
+
+    written = 0
+    with open(input_path, "rb" if not in_place else "r+b") as input_file, open(output_path, "r+b") as output_file:
+        with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ if not in_place else mmap.ACCESS_WRITE) as input_map:
+            output_map = input_map if in_place else mmap.mmap(output_file.fileno(), size)
+            source = np.frombuffer(input_map, dtype=np.uint8)
+            destination = source if in_place else np.frombuffer(output_map, dtype=np.uint8)
+
+            # A refused byte is raised once the maps are closed, as the traceback would keep views of them alive
+            refused = None
+            try:
+
+                # In place, a byte refused half way would leave the file part encoded, so check them all first,
+                # a chunk at a time like the encoding itself
+                if in_place and non_alphabet == "error":
+                    for start in range(0, size, chunk_size):
+                        is_letter = encoder.indices[source[start:start + chunk_size]] >= 0
+                        if not is_letter.all(): raise ValueError(bytes([source[start + np.argmin(is_letter)]]))
+
+                # Output never runs ahead of input, so in place each chunk only overwrites bytes already read
+                for start in range(0, size, chunk_size):
+                    written += encoder.encode_chunk(source[start:start + chunk_size], destination[written:])
+            except ValueError as error:
+                refused = error.args[0]
+
+            # Views must go before the maps can close
+            del source, destination
+            if not in_place: output_map.close()
+
+        if refused is not None: raise ValueError(refused)
+
+        if written < size: output_file.truncate(written)
+
+    encoder.finish()
+    return written
+
+
+if __name__ == "__main__":
+
+    from enigma import create_enigma_machine
+
+    # ------------- Test 1 -----------
+
+    # The tables reproduce encode across turnovers, including a full cycle of the rotors
+    plugboard = ["HL", "MO", "AJ", "CX", "BZ", "SR", "NI", "YW", "DG", "PK"]
+    message = "THEQUICKBROWNFOXJUMPSOVERTHELAZYDOG" * 600
+    expected = create_enigma_machine("I II III", "B", "01 02 03", "A A Z", plugboard).encode(message)
+
+    enigma = create_enigma_machine("I II III", "B", "01 02 03", "A A Z", plugboard)
+    assert(stepping_period(enigma) == 26 ** 3)
+    assert(encode_bytes(enigma, message.encode("ascii")) == expected.encode("ascii"))
+
+    # The machine ends where encode leaves it
+    assert(enigma.encode("HELLO") == create_enigma_machine("I II III", "B", "01 02 03", "A A Z", plugboard).encode(message + "HELLO")[-5:])
+
+    # ------------- Test 2 -----------
+
+    # Bytes outside the alphabet are kept without stepping, dropped, or refused
+    enigma = create_enigma_machine("I Beta II", "C", "05 01 26", "Q E V", plugboard)
+    expected = create_enigma_machine("I Beta II", "C", "05 01 26", "Q E V", plugboard).encode("HELLOWORLD")
+    assert(stepping_period(enigma) == 26 ** 2)
+
+    kept = encode_bytes(enigma, b"hello, WORLD\n", uppercase=True)
+    assert(kept == (expected[:5] + ", " + expected[5:] + "\n").encode("ascii"))
+
+    enigma = create_enigma_machine("I Beta II", "C", "05 01 26", "Q E V", plugboard)
+    assert(encode_bytes(enigma, b"HELLO, WORLD\n", "drop") == expected.encode("ascii"))
+
+    try:
+        encode_bytes(enigma, b"HELLO, WORLD", "error")
+        assert(False)
+    except ValueError:
+        pass
+
+    # ------------- Test 3 -----------
+
+    # A file encoded in place, in chunks, under every policy
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "message.txt")
+        data = b"HELLO, WORLD\n" * 1000
+        expected = create_enigma_machine("I Beta II", "C", "05 01 26", "Q E V", plugboard).encode(data.decode("ascii").replace(", ", "").replace("\n", ""))
+
+        for non_alphabet in ["keep", "drop"]:
+            with open(path, "wb") as message_file: message_file.write(data)
+
+            enigma = create_enigma_machine("I Beta II", "C", "05 01 26", "Q E V", plugboard)
+            written = encode_mmap(enigma, path, path, non_alphabet, chunk_size=100)
+            with open(path, "rb") as message_file: encoded = message_file.read()
+
+            assert(written == len(encoded))
+            assert(encoded.replace(b", ", b"").replace(b"\n", b"") == expected.encode("ascii"))
+            assert(non_alphabet == "drop" or len(encoded) == len(data))
+
+        # Under "error" the file is left untouched
+        with open(path, "wb") as message_file: message_file.write(data)
+        try:
+            encode_mmap(create_enigma_machine("I Beta II", "C", "05 01 26", "Q E V", plugboard), path, path, "error", chunk_size=100)
+            assert(False)
+        except ValueError:
+            pass
+
+        with open(path, "rb") as message_file: assert(message_file.read() == data)
+
+        # Including by a byte several chunks in, which is the one reported
+        data = b"HELLOWORLD" * 100 + b"!" + b"HELLOWORLD" * 10
+        with open(path, "wb") as message_file: message_file.write(data)
+        try:
+            encode_mmap(create_enigma_machine("I Beta II", "C", "05 01 26", "Q E V", plugboard), path, path, "error", chunk_size=100)
+            assert(False)
+        except ValueError as error:
+            assert(error.args[0] == b"!")
+
+        with open(path, "rb") as message_file: assert(message_file.read() == data)
@@ -0,0 +1,804 @@
+import bisect, hashlib, heapq, itertools, json, math, os, pickle, time
+from collections import namedtuple
+from functools import lru_cache
+from multiprocessing import Pool
+
+from enigma import ALPHABET, ALPHABET_INDEX, MachineSpec, create_enigma_machine, machine_from_spec, parse_positions, parse_ring_settings, parse_rotor_names, possible_crib_offsets, reflector_rewirings, rotor_from_name, stepping_schedule
+
+# Generic key search: a keyspace describing the candidate settings, a ciphertext and an acceptance
+# predicate. The keyspace is split into chunks of key indices which are tried across a process pool.
+
+# One candidate setting of the machine, in the same string formats create_enigma_machine takes.
+# reflector_swaps optionally rewires the reflector: pairs of letters to connect, e.g. [("E", "R"), ...]
+SearchKey = namedtuple("SearchKey", ["rotors", "reflector", "ring_settings", "initial_positions", "plugboard_pairs", "reflector_swaps"])
+
+
+class KeySpace:
+    """
+    Every combination of the given options for each setting, in nested loop order (rotors outermost).
+    """
+    def __init__(self, rotors: list, reflector: list, ring_settings: list, initial_positions: list, plugboard_pairs: list = [[]], reflector_swaps: list = [None]) -> None:
+        self.options = [rotors, reflector, ring_settings, initial_positions, plugboard_pairs, reflector_swaps]
+
+    def __len__(self) -> int:
+        size = 1
+        for options in self.options: size *= len(options)
+        return size
+
+    def key(self, index: int) -> SearchKey:
+        """
+        Returns the key at a position in the keyspace, decoding the index one setting at a time.
+        """
+        # The last setting varies fastest, like the innermost of the nested loops
+        choices = []
+        for options in self.options[::-1]:
+            index, choice = divmod(index, len(options))
+            choices.append(options[choice])
+
+        return SearchKey(*choices[::-1])
+
+
+@lru_cache(maxsize=1 << 16)
+def step_pattern(rotor_names: tuple, initial_positions: tuple, length: int) -> bytes:
+    """
+    How many times (mod 26) each rotor has stepped at each character of a message, from the stepping schedule.
+    """
+    schedule = stepping_schedule(tuple(rotor_from_name(rotor_name).notch_index for rotor_name in rotor_names), initial_positions, length)
+    number_of_rotors = len(initial_positions)
+    return bytes((position - initial_positions[idx % number_of_rotors]) % 26 for idx, position in enumerate(schedule.positions))
+
+
+def keystream_signature(rotor_names: tuple, ring_settings: tuple, initial_positions: tuple, length: int) -> tuple:
+    """
+    Two keys with the same rotors and signature encode every message of the given length identically.
+
+    A rotor's wiring is shifted by position - ring setting, and its position only moves when it steps. So the
+    keystream is fixed by each rotor's starting shift together with when each rotor steps, which depends on
+    the start positions and notches alone.
+    """
+    shifts = bytes((position - ring_setting) % 26 for position, ring_setting in zip(initial_positions, ring_settings))
+    return shifts, step_pattern(rotor_names, initial_positions, length)
+
+
+class CanonicalKeySpace:
+    """
+    A KeySpace with equivalent (ring settings, initial positions) combinations collapsed to one representative
+    per keystream, for messages of a given length. Hits on a representative expand back to every equivalent key.
+    """
+    def __init__(self, keyspace: KeySpace, length: int) -> None:
+        rotors, reflectors, ring_settings, initial_positions, plugboard_pairs, reflector_swaps = keyspace.options
+        self.original_size = len(keyspace)
+        self.reflectors, self.plugboard_pairs, self.reflector_swaps = reflectors, plugboard_pairs, reflector_swaps
+
+        # Per rotor order: the classes of equivalent (ring settings, initial positions), representative first
+        self.blocks = []
+        for names_of_rotors in rotors:
+            rotor_names = parse_rotor_names(names_of_rotors)
+
+            classes = {}
+            for rings, positions in itertools.product(ring_settings, initial_positions):
+                signature = keystream_signature(rotor_names, parse_ring_settings(rings), parse_positions(positions), length)
+                classes.setdefault(signature, []).append((rings, positions))
+
+            self.blocks.append((names_of_rotors, list(classes.values())))
+
+        # Every key index below block_starts[i + 1] belongs to rotor order i
+        self.block_starts = [0]
+        for names_of_rotors, classes in self.blocks:
+            self.block_starts.append(self.block_starts[-1] + len(reflectors) * len(classes) * len(plugboard_pairs) * len(reflector_swaps))
+
+    def __len__(self) -> int:
+        return self.block_starts[-1]
+
+    def reduction(self) -> str:
+        return "%d keys -> %d canonical keys (%.1fx smaller)" % (self.original_size, len(self), self.original_size / max(1, len(self)))
+
+    def _decode(self, index: int) -> tuple:
+        if not 0 <= index < len(self): raise IndexError(index)
+
+        # Find the rotor order, then decode the rest like KeySpace with the classes in place of rings and positions
+        block = bisect.bisect_right(self.block_starts, index) - 1
+        names_of_rotors, classes = self.blocks[block]
+        index -= self.block_starts[block]
+
+        choices = []
+        for options in [self.reflector_swaps, self.plugboard_pairs, classes, self.reflectors]:
+            index, choice = divmod(index, len(options))
+            choices.append(options[choice])
+
+        reflector_swaps, plugboard_pairs, equivalent_keys, reflector = choices
+        return names_of_rotors, reflector, equivalent_keys, plugboard_pairs, reflector_swaps
+
+    def key(self, index: int) -> SearchKey:
+        names_of_rotors, reflector, equivalent_keys, plugboard_pairs, reflector_swaps = self._decode(index)
+        rings, positions = equivalent_keys[0]
+        return SearchKey(names_of_rotors, reflector, rings, positions, plugboard_pairs, reflector_swaps)
+
+    def expand(self, index: int) -> list:
+        """
+        Every original key equivalent to the canonical key at index.
+        """
+        names_of_rotors, reflector, equivalent_keys, plugboard_pairs, reflector_swaps = self._decode(index)
+        return [SearchKey(names_of_rotors, reflector, rings, positions, plugboard_pairs, reflector_swaps) for rings, positions in equivalent_keys]
+
+
+class CribPredicate:
+    """
+    Accepts a decrypt if any of the cribs appears in it.
+
+    If anchored, candidates are screened first by decrypting only the crib window at each offset the crib
+    could sit at, so most machines are rejected after a letter or two and only survivors are fully decrypted.
+    """
+    def __init__(self, cribs: list, anchored: bool = False) -> None:
+        self.cribs = cribs
+        self.anchored = anchored
+
+        # Possible offsets of each crib, worked out once per ciphertext
+        self.crib_offsets = {}
+
+    def __getstate__(self) -> dict:
+
+        # The offsets are a cache, left out so a predicate pickles (and fingerprints) the same before and after use
+        return {"cribs": self.cribs, "anchored": self.anchored}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["cribs"], state["anchored"])
+
+    def __call__(self, possible_message: str) -> bool:
+        return any(crib in possible_message for crib in self.cribs)
+
+    def screen(self, enigma: object, ciphertext: str) -> bool:
+        """
+        Returns False if the machine cannot decrypt any crib into the ciphertext, without a full decrypt.
+        """
+        if not self.anchored: return True
+
+        if ciphertext not in self.crib_offsets:
+            self.crib_offsets[ciphertext] = [possible_crib_offsets(ciphertext, crib) for crib in self.cribs]
+
+        return any(
+            enigma.find_crib(ciphertext, crib, offsets)
+            for crib, offsets in zip(self.cribs, self.crib_offsets[ciphertext])
+        )
+
+
+class CribScore:
+    """
+    Scores a decrypt by how many times the cribs appear in it, overlapping occurrences included.
+    """
+    def __init__(self, cribs: list) -> None:
+        self.cribs = cribs
+
+    def __call__(self, possible_message: str) -> float:
+        score = 0
+        for crib in self.cribs:
+            position = possible_message.find(crib)
+            while position != -1:
+                score += 1
+                position = possible_message.find(crib, position + 1)
+
+        return score
+
+
+# One collected decrypt: its score, keyspace index, key and message
+SearchResult = namedtuple("SearchResult", ["score", "index", "key", "message"])
+
+
+class ResultCollector:
+    """
+    Keeps the k best distinct decrypts seen, so memory stays flat however many candidates are accepted.
+
+    score is any picklable function of the decrypt, e.g. CribScore(cribs) or TRIGRAM_SCORER.score_text; without
+    one every decrypt scores 0. Ties go to the lowest keyspace index, so the result does not depend on the order
+    chunks finish in. Decrypts are told apart by a hash of their text: a repeat only replaces the kept copy if it
+    scores higher.
+    """
+    def __init__(self, k: int = 10, score: object = None) -> None:
+        if k < 1: raise ValueError(k)
+
+        self.k = k
+        self.score = score
+
+        # Min-heap of (score, -index, digest, result), so the root is the first to go
+        self.heap = []
+
+        # Digest -> score of every decrypt in the heap
+        self.scores = {}
+
+    @staticmethod
+    def digest(possible_message: str) -> bytes:
+        # A stable hash, unlike hash(), so collectors from different processes agree
+        return hashlib.blake2b(possible_message.encode("utf-8"), digest_size=8).digest()
+
+    def add(self, index: int, key: object, possible_message: str, score: float = None) -> bool:
+        """
+        Offers a decrypt, scoring it unless a score is given. Returns True if it was kept.
+        """
+        if score is None: score = 0 if self.score is None else self.score(possible_message)
+        return self._push(SearchResult(score, index, key, possible_message))
+
+    def _push(self, result: SearchResult) -> bool:
+        entry = (result.score, -result.index, self.digest(result.message), result)
+
+        # 1. A repeat of a kept decrypt either replaces it or is dropped
+        if entry[2] in self.scores:
+            kept = next(kept_entry for kept_entry in self.heap if kept_entry[2] == entry[2])
+            if entry[:2] <= kept[:2]: return False
+
+            self.heap.remove(kept)
+            heapq.heapify(self.heap)
+            del self.scores[entry[2]]
+
+        # 2. Once full, only a better decrypt gets in, pushing out the worst
+        if len(self.heap) == self.k:
+            if entry[:2] <= self.heap[0][:2]: return False
+            del self.scores[heapq.heappushpop(self.heap, entry)[2]]
+        else:
+            heapq.heappush(self.heap, entry)
+
+        self.scores[entry[2]] = result.score
+        return True
+
+    def merge(self, other: object) -> None:
+        """
+        Adds the results another collector kept, e.g. one per worker or shard. Scores are not recomputed.
+        """
+        for entry in other.heap: self._push(entry[3])
+
+    def results(self) -> list:
+        """
+        The kept SearchResults, best first.
+        """
+        return [entry[3] for entry in sorted(self.heap, key=lambda entry: entry[:2], reverse=True)]
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+
+def all_initial_positions(number_of_rotors: int) -> list:
+    """
+    Every start position for the given number of rotors: ['A A A', 'A A B', ...]
+    """
+    return [" ".join(positions) for positions in itertools.product(ALPHABET, repeat=number_of_rotors)]
+
+
+def machine_from_key(key: SearchKey, enigma: object = None) -> object:
+    """
+    Builds the enigma machine described by a search key, or re-keys the given machine in place.
+    """
+    spec = MachineSpec.parse(key.rotors, key.reflector, key.ring_settings, key.initial_positions, key.plugboard_pairs)
+
+    if enigma is None: enigma = machine_from_spec(spec)
+    else: enigma.reset(spec)
+
+    # Rewire the reflector if the key swaps any of its connections
+    if key.reflector_swaps:
+        rewired_reflector_mapping = list(enigma.reflector.mapping)
+
+        for char1, char2 in key.reflector_swaps:
+            rewired_reflector_mapping[ALPHABET.index(char1)] = char2
+            rewired_reflector_mapping[ALPHABET.index(char2)] = char1
+
+        enigma.reflector.mapping = "".join(rewired_reflector_mapping)
+
+    return enigma
+
+
+# The search each worker process runs, set once per process by _init_worker rather than sent with every chunk
+_worker_search = None
+
+
+def _init_worker(keyspace: object, ciphertext: str, accept: object, composite: bool) -> None:
+    global _worker_search
+    _worker_search = (keyspace, ciphertext, accept, composite)
+
+
+def _search_chunk(chunk: tuple) -> tuple:
+    """
+    Tries every key index in [start, stop) and returns the chunk, the (index, key, message) of each accepted
+    decrypt and how many keys the predicate's screen rejected.
+    """
+    keyspace, ciphertext, accept, composite = _worker_search
+    start, stop = chunk
+
+    # Predicates may reject a machine before it decrypts the whole ciphertext
+    screen = getattr(accept, "screen", None)
+
+    # One machine per chunk, re-keyed in place for every candidate
+    enigma = None
+
+    hits, screened_out = [], 0
+    for index in range(start, stop):
+        key = keyspace.key(index)
+        enigma = machine_from_key(key, enigma)
+
+        if screen is not None and not screen(enigma, ciphertext):
+            screened_out += 1
+            continue
+
+        # Composite tables only pay off when the same rotor states come up across keys
+        possible_message = enigma.encode_composite(ciphertext) if composite else enigma.encode(ciphertext)
+
+        if accept(possible_message):
+            hits.append((index, key, possible_message))
+
+    return chunk, hits, screened_out
+
+
+def keyspace_chunks(size: int, chunksize: int, start: int = 0) -> list:
+    """
+    Splits key indices start - size into [start, stop) chunks.
+    """
+    return [(chunk_start, min(chunk_start + chunksize, size)) for chunk_start in range(start, size, chunksize)]
+
+
+# Snapshot of a running search passed to progress callbacks. Keys are either screened out (rejected before a
+# full decrypt), rejected (decrypted but not accepted) or hits.
+SearchStatus = namedtuple("SearchStatus", ["keys_tested", "keys_total", "screened_out", "rejected", "hits", "elapsed_seconds", "keys_per_second", "eta_seconds"])
+
+
+class ProgressReporter:
+    """
+    Counts the keys a search has tried and calls callback with a SearchStatus every interval seconds and at the end.
+    keys_done is how many keys an earlier, checkpointed run already finished.
+    """
+    def __init__(self, callback: object, keys_total: int, interval: float = 5.0, keys_done: int = 0) -> None:
+        self.callback = callback
+        self.keys_total = keys_total
+        self.interval = interval
+        self.keys_done = keys_done
+
+        self.keys_tested = self.screened_out = self.rejected = self.hits = 0
+        self.started = self.last_reported = time.time()
+        self.reported_keys = None
+
+    def status(self) -> SearchStatus:
+        elapsed = time.time() - self.started
+        keys_per_second = self.keys_tested / elapsed if elapsed else 0.0
+
+        # Estimate from this run's rate only, as a resumed run may be on a different machine
+        keys_left = self.keys_total - self.keys_done - self.keys_tested
+        eta = keys_left / keys_per_second if keys_per_second else None
+
+        return SearchStatus(self.keys_done + self.keys_tested, self.keys_total, self.screened_out, self.rejected, self.hits, elapsed, keys_per_second, eta)
+
+    def update(self, keys_tested: int, screened_out: int, hits: int) -> None:
+        self.keys_tested += keys_tested
+        self.screened_out += screened_out
+        self.rejected += keys_tested - screened_out - hits
+        self.hits += hits
+
+        if time.time() - self.last_reported >= self.interval: self.report()
+
+    def report(self) -> None:
+        self.last_reported, self.reported_keys = time.time(), self.keys_tested
+        self.callback(self.status())
+
+    def finish(self) -> None:
+
+        # Skip the final report if the last one already covered every key
+        if self.reported_keys != self.keys_tested: self.report()
+
+
+class SearchProgress:
+    """
+    Progress of a long search, checkpointed to a small JSON file so a killed search can resume where it stopped.
+    Records the ranges of key indices finished, the hits so far and throughput.
+
+    search_id is any JSON value identifying the search, so a progress file is never resumed by a different one.
+    """
+    def __init__(self, path: str, ciphertext: str, search_id: object, interval: float = 60.0) -> None:
+        self.path = path
+        self.interval = interval
+        self.ciphertext = ciphertext
+
+        # Compare ids as they will come back from the file
+        self.search_id = json.loads(json.dumps(search_id))
+
+        # Sorted, merged [start, stop) ranges of finished key indices, and [index, message] hits
+        self.completed = []
+        self.hits = []
+
+        # Throughput over every run of the search
+        self.keys_tested = 0
+        self.previous_elapsed = 0.0
+        self.started = self.last_saved = time.time()
+
+        if os.path.exists(path): self.load()
+
+    def load(self) -> None:
+        with open(self.path) as progress_file:
+            state = json.load(progress_file)
+
+        # Raise error if the file belongs to another search
+        if state["ciphertext"] != self.ciphertext or state["search_id"] != self.search_id: raise ValueError(self.path)
+
+        self.completed = [tuple(key_range) for key_range in state["completed"]]
+        self.hits = [tuple(hit) for hit in state["hits"]]
+        self.keys_tested = state["keys_tested"]
+        self.previous_elapsed = state["elapsed_seconds"]
+
+    def elapsed(self) -> float:
+        return self.previous_elapsed + time.time() - self.started
+
+    def save(self) -> None:
+        """
+        Writes the progress file atomically, so a kill mid-write leaves the previous checkpoint intact.
+        """
+        elapsed = self.elapsed()
+        state = {
+            "ciphertext": self.ciphertext,
+            "search_id": self.search_id,
+            "completed": self.completed,
+            "hits": self.hits,
+            "keys_tested": self.keys_tested,
+            "elapsed_seconds": elapsed,
+            "keys_per_second": self.keys_tested / elapsed if elapsed else 0.0
+        }
+
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as progress_file:
+            json.dump(state, progress_file)
+        os.replace(temporary_path, self.path)
+
+        self.last_saved = time.time()
+
+    def remaining(self, size: int, chunksize: int) -> list:
+        """
+        Chunks of the key indices 0 - size not finished yet.
+        """
+        chunks, cursor = [], 0
+        for start, stop in self.completed + [(size, size)]:
+            chunks += keyspace_chunks(start, chunksize, cursor)
+            cursor = stop
+
+        return chunks
+
+    def record(self, chunk: tuple, hits: list) -> None:
+        """
+        Marks a chunk finished with its (index, message) hits, saving if the interval has passed.
+        """
+        start, stop = chunk
+
+        # Insert the range and merge it with any neighbours it touches
+        merged = []
+        for key_range in sorted(self.completed + [chunk]):
+            if merged and key_range[0] <= merged[-1][1]: merged[-1] = (merged[-1][0], max(merged[-1][1], key_range[1]))
+            else: merged.append(key_range)
+
+        self.completed = merged
+        self.hits += hits
+        self.keys_tested += stop - start
+
+        if time.time() - self.last_saved >= self.interval: self.save()
+
+
+def search_fingerprint(keyspace: object, accept: object) -> str:
+    """
+    Hash of every key option and the predicate (with its cribs), identifying a search in its checkpoint.
+    """
+    return hashlib.sha256(pickle.dumps((keyspace, accept), protocol=4)).hexdigest()
+
+
+def search(keyspace: object, ciphertext: str, accept: object, processes: int = None, chunksize: int = None, composite: bool = False, checkpoint: str = None, checkpoint_interval: float = 60.0, progress_callback: object = None, progress_interval: float = 5.0):
+    """
+    Tries every key in the keyspace across a process pool, yielding (index, key, message) hits as chunks finish.
+
+    accept must be picklable, e.g. a CribPredicate or a module level function.
+    With a checkpoint path, progress is saved there every checkpoint_interval seconds, and a search started
+    with an existing progress file yields its earlier hits and only tries the keys it had not finished.
+    progress_callback, if given, is called with a SearchStatus every progress_interval seconds and when the search ends.
+    """
+    if processes is None: processes = os.cpu_count() or 1
+
+    # Aim for several chunks per process so a slow chunk does not hold the others up
+    if chunksize is None: chunksize = max(1, min(4096, len(keyspace) // (processes * 8)))
+
+    progress = None
+    if checkpoint is None:
+        chunks = keyspace_chunks(len(keyspace), chunksize)
+    else:
+        # A checkpoint of any other keys, predicate or ciphertext is refused rather than resumed
+        progress = SearchProgress(checkpoint, ciphertext, [len(keyspace), search_fingerprint(keyspace, accept)], checkpoint_interval)
+        chunks = progress.remaining(len(keyspace), chunksize)
+
+        for index, possible_message in progress.hits:
+            yield index, keyspace.key(index), possible_message
+
+    reporter = None
+    if progress_callback is not None:
+        reporter = ProgressReporter(progress_callback, len(keyspace), progress_interval, len(keyspace) - sum(stop - start for start, stop in chunks))
+
+    def finished(chunk: tuple, hits: list, screened_out: int) -> list:
+        if progress is not None: progress.record(chunk, [(index, possible_message) for index, key, possible_message in hits])
+        if reporter is not None: reporter.update(chunk[1] - chunk[0], screened_out, len(hits))
+        return hits
+
+    # A single process (or a single chunk) is not worth the cost of starting a pool
+    if processes == 1 or len(chunks) <= 1:
+        _init_worker(keyspace, ciphertext, accept, composite)
+        for chunk in chunks:
+            yield from finished(*_search_chunk(chunk))
+    else:
+        with Pool(processes, initializer=_init_worker, initargs=(keyspace, ciphertext, accept, composite)) as pool:
+            for chunk, hits, screened_out in pool.imap_unordered(_search_chunk, chunks):
+                yield from finished(chunk, hits, screened_out)
+
+    if progress is not None: progress.save()
+    if reporter is not None: reporter.finish()
+
+
+def search_messages(keyspace: object, ciphertext: str, accept: object, **search_options) -> list:
+    """
+    Runs a search to completion and returns the accepted decrypts in keyspace order.
+    """
+    hits = sorted(search(keyspace, ciphertext, accept, **search_options), key=lambda hit: hit[0])
+    return [possible_message for index, key, possible_message in hits]
+
+
+def search_top(keyspace: object, ciphertext: str, accept: object, k: int = 10, score: object = None, **search_options) -> list:
+    """
+    Runs a search to completion, keeping only the k best distinct decrypts. Returns SearchResults, best first.
+    The score defaults to counting the cribs of a CribPredicate.
+    """
+    if score is None and isinstance(accept, CribPredicate): score = CribScore(accept.cribs)
+
+    collector = ResultCollector(k, score)
+    for index, key, possible_message in search(keyspace, ciphertext, accept, **search_options):
+        collector.add(index, key, possible_message)
+
+    return collector.results()
+
+
+class ReflectorSearch:
+    """
+    Searches rewirings of the reflector for one message, with the rotors, ring settings, positions and plugboard known.
+
+    The rotor stepping and the rotor passes either side of the reflector do not depend on the reflector, so the
+    "rotor-in" and "rotor-out" permutations at every position are worked out once. Trying a rewiring then only
+    swaps entries in a 26-entry reflector table.
+    """
+    def __init__(self, ciphertext: str, rotors: str, ring_settings: str, initial_positions: str, plugboard_pairs: list = []) -> None:
+        self.ciphertext = ciphertext
+
+        # Everything but the reflector, identifying the search in its checkpoints
+        self.settings = [rotors, ring_settings, initial_positions, list(plugboard_pairs)]
+
+        # The reflector is never used for the rotor passes, so any will do here
+        enigma = create_enigma_machine(rotors, "A", ring_settings, initial_positions, plugboard_pairs)
+        connections = enigma.plugboard.connections
+
+        # The same stepping schedule serves every reflector
+        schedule = enigma.stepping_schedule(len(ciphertext))
+
+        # rotor_in[p][letter] -> reflector input index, rotor_out[p][reflector output index] -> letter
+        self.rotor_in, self.rotor_out = [], []
+        for char_idx in range(len(ciphertext)):
+            enigma.set_positions(schedule.state(char_idx))
+
+            rotor_in = []
+            for letter in ALPHABET:
+
+                # plugboard -> rightmost to leftmost rotor
+                encrypted_idx = ALPHABET_INDEX[connections.get(letter, letter)]
+                for rotor in enigma.rotors[::-1]: encrypted_idx = rotor.encode_index_right_to_left(encrypted_idx)
+                rotor_in.append(encrypted_idx)
+
+            rotor_out = []
+            for encrypted_idx in range(26):
+
+                # leftmost to rightmost rotor -> plugboard
+                for rotor in enigma.rotors: encrypted_idx = rotor.encode_index_left_to_right(encrypted_idx)
+                letter = ALPHABET[encrypted_idx]
+                rotor_out.append(connections.get(letter, letter))
+
+            self.rotor_in.append(rotor_in)
+            self.rotor_out.append(rotor_out)
+
+        # The reflector input each ciphertext letter reaches never changes either
+        self.code_in = [rotor_in[ALPHABET_INDEX[char]] for rotor_in, char in zip(self.rotor_in, ciphertext)]
+
+    def decrypt(self, reflector_table: list) -> str:
+        """
+        Decrypts the message with a reflector given as a table of alphabet indices.
+        """
+        return "".join(rotor_out[reflector_table[code_in]] for rotor_out, code_in in zip(self.rotor_out, self.code_in))
+
+    def crib_requirements(self, cribs: list) -> list:
+        """
+        For every crib and offset it could sit at, the reflector connections [(input, output), ...] it needs.
+        """
+        requirements = []
+        for crib in cribs:
+            for offset in possible_crib_offsets(self.ciphertext, crib):
+                needed = {}
+                for i, crib_char in enumerate(crib):
+                    position = offset + i
+                    reflector_in = self.code_in[position]
+                    reflector_out = self.rotor_out[position].index(crib_char)
+
+                    # A reflector never connects a letter to itself, and is wired both ways
+                    if reflector_in == reflector_out or needed.get(reflector_in, reflector_out) != reflector_out: break
+                    if needed.get(reflector_out, reflector_in) != reflector_in: break
+                    needed[reflector_in], needed[reflector_out] = reflector_out, reflector_in
+                else:
+                    requirements.append(list(needed.items()))
+
+        return requirements
+
+    def search(self, reflector_name: str, cribs: list, number_of_pairs: int = 4, checkpoint: str = None, checkpoint_interval: float = 60.0, batch_size: int = 4096, progress_callback: object = None, progress_interval: float = 5.0):
+        """
+        Yields (rewiring, message) for every rewiring of the reflector whose decrypt contains one of the cribs.
+        With a checkpoint path, progress is recorded every batch_size rewirings and saved like search(), and
+        progress_callback gets a SearchStatus as often as every batch_size rewirings.
+        """
+        requirements = self.crib_requirements(cribs)
+
+        original_table = rotor_from_name(reflector_name).forward
+        reflector_table = list(original_table)
+
+        rewirings = enumerate(reflector_rewirings(reflector_name, number_of_pairs))
+
+        # Rewirings tried since progress was last recorded
+        batch_start, batch_hits = 0, []
+
+        progress = None
+        if checkpoint is not None:
+            progress = SearchProgress(checkpoint, self.ciphertext, [reflector_name, number_of_pairs, cribs] + self.settings, checkpoint_interval)
+
+            for index, possible_message, rewiring in progress.hits:
+                yield [tuple(pair) for pair in rewiring], possible_message
+
+            # Rewirings come in a fixed order, so the finished ones are always a prefix of it
+            if progress.completed: batch_start = progress.completed[0][1]
+            rewirings = itertools.islice(rewirings, batch_start, None)
+
+        tried = batch_start
+
+        reporter = None
+        if progress_callback is not None:
+
+            # C(13, n) choices of pairs, (n - 1)!! ways to group them and 2 ways to swap each group
+            rewirings_total = math.comb(13, number_of_pairs) * math.prod(range(number_of_pairs - 1, 0, -2)) * 2 ** (number_of_pairs // 2)
+            reporter = ProgressReporter(progress_callback, rewirings_total, progress_interval, batch_start)
+
+        for index, rewiring in rewirings:
+
+            # 1. Swap the entries of the rewired pairs
+            for char1, char2 in rewiring:
+                reflector_table[ALPHABET_INDEX[char1]], reflector_table[ALPHABET_INDEX[char2]] = ALPHABET_INDEX[char2], ALPHABET_INDEX[char1]
+
+            # 2. Check the cribs against the reflector connections they need, stopping at the first mismatch
+            if any(all(reflector_table[reflector_in] == reflector_out for reflector_in, reflector_out in needed) for needed in requirements):
+                possible_message = self.decrypt(reflector_table)
+                batch_hits.append((index, possible_message, rewiring))
+                yield rewiring, possible_message
+
+            # 3. Put the swapped entries back
+            for char1, char2 in rewiring:
+                reflector_table[ALPHABET_INDEX[char1]], reflector_table[ALPHABET_INDEX[char2]] = original_table[ALPHABET_INDEX[char1]], original_table[ALPHABET_INDEX[char2]]
+
+            if index + 1 - batch_start == batch_size:
+                self._record_batch(progress, reporter, batch_start, index + 1, batch_hits)
+                batch_start, batch_hits = index + 1, []
+
+            tried = index + 1
+
+        if tried > batch_start: self._record_batch(progress, reporter, batch_start, tried, batch_hits)
+        if progress is not None: progress.save()
+        if reporter is not None: reporter.finish()
+
+    @staticmethod
+    def _record_batch(progress: object, reporter: object, batch_start: int, batch_stop: int, batch_hits: list) -> None:
+
+        # Rewirings that fail the crib requirements never reach a full decrypt, so they count as screened out
+        if progress is not None: progress.record((batch_start, batch_stop), batch_hits)
+        if reporter is not None: reporter.update(batch_stop - batch_start, batch_stop - batch_start - len(batch_hits), len(batch_hits))
+
+
+if __name__ == "__main__":
+
+    import tempfile
+
+    from enigma import code_four_search
+
+    # ------------- Test 1 -----------
+
+    # An interrupted search resumes from its checkpoint with the same hits as an uninterrupted one
+    code = "CMFSUPKNCBMUYEQVVDYKLRQZTPUFHSWWAKTUGXMPAMYAFITXIJKMH"
+    plugboard = ["VH", "PT", "ZG", "BJ", "EY", "FS"]
+    keyspace = KeySpace(["Beta I III"], ["B"], ["23 02 10"], all_initial_positions(3), [plugboard])
+    accept = CribPredicate(["UNIVERSITY"], anchored=True)
+
+    expected = search_messages(keyspace, code, accept, processes=1, composite=True)
+    assert(len(expected) == 1)
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt_after_chunks(status: SearchStatus) -> None:
+        if status.keys_tested >= 12000: raise Interrupted()
+
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint = os.path.join(directory, "progress.json")
+
+        # Progress is saved as each chunk finishes, then the search is stopped part way
+        try:
+            list(search(keyspace, code, accept, processes=1, chunksize=1000, composite=True, checkpoint=checkpoint, checkpoint_interval=0, progress_callback=interrupt_after_chunks, progress_interval=0))
+            assert(False)
+        except Interrupted:
+            pass
+
+        progress = SearchProgress(checkpoint, code, [len(keyspace), search_fingerprint(keyspace, accept)])
+        assert(progress.completed == [(0, 12000)])
+
+        # Resuming only tries the rest
+        assert(search_messages(keyspace, code, accept, processes=1, composite=True, checkpoint=checkpoint) == expected)
+
+        # A different search of the same size refuses the checkpoint instead of returning its hits
+        for other_keyspace, other_accept in [
+            (KeySpace(["Beta I II"], ["C"], ["23 02 10"], all_initial_positions(3), [plugboard]), accept),
+            (keyspace, CribPredicate(["ZZZZ"], anchored=True))
+        ]:
+            assert(len(other_keyspace) == len(keyspace))
+            try:
+                search_messages(other_keyspace, code, other_accept, processes=1, checkpoint=checkpoint)
+                assert(False)
+            except ValueError:
+                pass
+
+    # ------------- Test 2 -----------
+
+    # Rings 01-03 and positions A, C, M on every rotor, where A/01 and C/03 give the same shift
+    ring_choices = [" ".join(rings) for rings in itertools.product(["01", "02", "03"], repeat=3)]
+    position_choices = [" ".join(positions) for positions in itertools.product("ACM", repeat=3)]
+    keyspace = KeySpace(["I II III", "Beta I III"], ["B"], ring_choices, position_choices, [plugboard])
+    canonical = CanonicalKeySpace(keyspace, len(code))
+    assert(len(keyspace) == 1458 and len(canonical) == 1152)
+
+    # The expanded classes cover the whole keyspace, each key once
+    expanded = [key for index in range(len(canonical)) for key in canonical.expand(index)]
+    assert(sorted(expanded) == sorted(keyspace.key(index) for index in range(len(keyspace))))
+
+    # Every key in a class encodes the same as its representative
+    for index in range(len(canonical)):
+        representative = machine_from_key(canonical.key(index)).encode(code)
+        assert(all(machine_from_key(key).encode(code) == representative for key in canonical.expand(index)))
+
+    # The signature is the starting shifts and the step pattern, which only the start positions and notches fix
+    assert(step_pattern(("I", "II", "III"), (0, 0, 0), 2) == bytes([0, 0, 1, 0, 0, 2]))
+    assert(step_pattern(("I", "II", "III"), (16, 4, 20), 2) == bytes([0, 0, 1, 1, 1, 2]))
+    assert(keystream_signature(("I", "II", "III"), (0, 0, 0), (0, 2, 12), 5) == keystream_signature(("I", "II", "III"), (2, 0, 0), (2, 2, 12), 5))
+    assert(keystream_signature(("I", "II", "III"), (0, 0, 0), (0, 2, 20), 5) != keystream_signature(("I", "II", "III"), (1, 0, 0), (1, 2, 21), 5))
+    assert(keystream_signature(("I", "II", "III"), (0, 0, 0), (0, 2, 12), 5) != keystream_signature(("I", "II", "III"), (0, 0, 1), (0, 2, 12), 5))
+
+    # ------------- Test 3 -----------
+
+    # A collector keeps the k best distinct decrypts, best first, ties to the lowest index whatever order they come in
+    offers = [(5, "CCC", 2), (1, "AAA", 1), (3, "BBB", 2), (4, "DDD", 0), (2, "EEE", 2), (0, "AAA", 1), (6, "FFF", 3)]
+    collector = ResultCollector(3)
+    for index, possible_message, score in offers:
+        collector.add(index, None, possible_message, score)
+        assert(len(collector) <= 3)
+
+    assert([(result.index, result.message) for result in collector.results()] == [(6, "FFF"), (2, "EEE"), (3, "BBB")])
+
+    # A repeat only replaces the kept copy if it ranks higher, and collectors merge to the same result in any split
+    assert(not collector.add(7, None, "EEE", 2) and collector.add(8, None, "EEE", 4))
+    assert([result.index for result in collector.results()] == [8, 6, 3])
+
+    merged = ResultCollector(3)
+    for part in (offers[::2], offers[1::2], [(7, "EEE", 2), (8, "EEE", 4)]):
+        part_collector = ResultCollector(3)
+        for index, possible_message, score in part[::-1]: part_collector.add(index, None, possible_message, score)
+        merged.merge(part_collector)
+    assert(merged.results() == collector.results())
+
+    # search_top scores by crib count and matches sorting every hit of a full search. The predicate is rebuilt from
+    # this module's CribPredicate, which search_top checks for when it runs as a script
+    keyspace, code, accept, composite = code_four_search()
+    accept = CribPredicate(accept.cribs, anchored=True)
+    everything = [SearchResult(CribScore(accept.cribs)(possible_message), index, key, possible_message) for index, key, possible_message in search(keyspace, code, accept, processes=1, composite=composite)]
+    best = sorted(everything, key=lambda result: (-result.score, result.index))
+    assert(search_top(keyspace, code, accept, k=3, processes=1, composite=composite) == best[:3])
+    assert(search_top(keyspace, code, accept, k=100, processes=1, composite=composite) == best)
@@ -0,0 +1,120 @@
+import argparse, os, sys
+
+from enigma import MachineSpec, machine_from_spec, NON_ALPHABET_POLICIES
+
+# Streaming encoding for messages too large to hold in memory, e.g. traffic archives or pipes.
+# Chunks are encoded as ASCII bytes into one preallocated buffer and the machine keeps its rotor positions
+# between chunks, so the output is the same as encoding the whole message at once.
+#
+#   python enigma_stream.py --rotors "I II III" --reflector B --rings "01 01 01" --positions "A A Z" --plugboard HL MO < in.txt > out.txt
+#
+# Enigma is its own inverse, so decrypting is running the ciphertext through a machine with the same key.
+
+DEFAULT_BUFFER_SIZE = 1 << 16
+
+
+def read_chunks(source: object, chunk_size: int = DEFAULT_BUFFER_SIZE):
+    """
+    Yields chunks of chunk_size from a file object until it is exhausted.
+    """
+    chunk = source.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = source.read(chunk_size)
+
+
+def encode_stream(enigma: object, chunks, buffer_size: int = DEFAULT_BUFFER_SIZE, non_alphabet: str = "keep"):
+    """
+    Encodes an iterable of str or bytes chunks (or a file object) and yields the encoded chunks, of the same type.
+    Text is handled as UTF-8, so characters outside the alphabet survive the "keep" policy.
+    """
+    if hasattr(chunks, "read"): chunks = read_chunks(chunks, buffer_size)
+
+    buffer = bytearray(buffer_size)
+    for chunk in chunks:
+        data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+        # Chunks larger than the buffer grow it once rather than being split, which could cut a UTF-8 character
+        if len(data) > len(buffer): buffer = bytearray(len(data))
+
+        end = enigma.encode_into(data, buffer, 0, non_alphabet)
+        yield buffer[:end].decode("utf-8") if isinstance(chunk, str) else bytes(buffer[:end])
+
+
+def encode_file(enigma: object, source: object, destination: object, buffer_size: int = DEFAULT_BUFFER_SIZE, non_alphabet: str = "keep", uppercase: bool = True) -> int:
+    """
+    Encodes a binary file object into another, writing straight from the buffer. Returns the number of bytes written.
+    With uppercase, lower case letters are encoded as capitals.
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+
+    written = 0
+    for chunk in read_chunks(source, buffer_size):
+        if uppercase: chunk = chunk.upper()
+
+        end = enigma.encode_into(chunk, buffer, 0, non_alphabet)
+        destination.write(view[:end])
+        written += end
+
+    return written
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description="Encrypt or decrypt a file or pipe with an enigma key.")
+    parser.add_argument("--rotors", required=True, help="rotor names, e.g. 'I II III'")
+    parser.add_argument("--reflector", required=True, help="reflector name, e.g. B")
+    parser.add_argument("--rings", required=True, help="ring settings, e.g. '01 01 01'")
+    parser.add_argument("--positions", required=True, help="start positions, e.g. 'A A Z'")
+    parser.add_argument("--plugboard", nargs="*", default=[], help="plug lead pairs, e.g. HL MO")
+    parser.add_argument("-i", "--input", help="file to read (default: stdin)")
+    parser.add_argument("-o", "--output", help="file to write (default: stdout)")
+    parser.add_argument("--non-alphabet", choices=NON_ALPHABET_POLICIES, default="keep", help="what to do with bytes that are not capital letters (default: %(default)s)")
+    parser.add_argument("--keep-case", action="store_true", help="do not encode lower case letters as capitals")
+    parser.add_argument("--buffer-size", type=int, default=DEFAULT_BUFFER_SIZE, help="bytes read and encoded at a time (default: %(default)s)")
+    parser.add_argument("--mmap", action="store_true", help="encode through memory maps and translation tables (needs numpy, --input and --output)")
+    args = parser.parse_args(argv)
+
+    if args.mmap and not (args.input and args.output): parser.error("--mmap needs --input and --output")
+
+    # Opening the output would truncate the input before it is read; only the memory mapped path works in place
+    if not args.mmap and args.input and args.output and os.path.exists(args.output) and os.path.samefile(args.input, args.output):
+        parser.error("--input and --output are the same file: use --mmap to encode it in place")
+
+    # Invalid keys raise here rather than producing a silently wrong machine
+    try:
+        spec = MachineSpec.parse(args.rotors, args.reflector, args.rings, args.positions, args.plugboard)
+    except (ValueError, TypeError, KeyError) as error:
+        parser.error("invalid key: %s" % error)
+
+    enigma = machine_from_spec(spec)
+
+    # Large files go through the memory mapped path, which needs numpy
+    if args.mmap:
+        from enigma_mmap import encode_mmap
+
+        try:
+            encode_mmap(enigma, args.input, args.output, args.non_alphabet, not args.keep_case)
+        except ValueError as error:
+            print("cannot encode byte %r" % error.args[0], file=sys.stderr)
+            return 1
+
+        return 0
+
+    source = open(args.input, "rb") if args.input else sys.stdin.buffer
+    destination = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        encode_file(enigma, source, destination, args.buffer_size, args.non_alphabet, not args.keep_case)
+    except ValueError as error:
+        print("cannot encode byte %r" % error.args[0], file=sys.stderr)
+        return 1
+    finally:
+        if args.input: source.close()
+        if args.output: destination.close()
+        else: destination.flush()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,360 @@
+import sys, threading, time
+from collections import Counter
+from contextlib import contextmanager
+
+import enigma
+import enigma_search
+
+# Optional instrumentation of the machine and the searches. Nothing here runs unless instrument() is entered:
+# it wraps the hot functions for the duration and puts the originals back afterwards, so code that is not
+# instrumented pays nothing.
+#
+#   telemetry = Telemetry(progress_callback=print_progress)
+#   with instrument(telemetry, profile=True):
+#       code_three()
+#   print(telemetry.counters(), telemetry.profile_report())
+#
+# Machine counters only see work done in this process, so run searches with processes=1 to count it all.
+# Candidate counts come back from the worker processes with each chunk and are always complete.
+
+# The qualified names of the functions each profiler stage covers
+PROFILE_STAGES = {
+    "PlugLead.encode": "plugboard",
+    "Plugboard.encode": "plugboard",
+
+    "Rotor.encode_index_right_to_left": "rotors",
+    "Rotor.encode_index_left_to_right": "rotors",
+    "Rotor.encode_right_to_left": "rotors",
+    "Rotor.encode_left_to_right": "rotors",
+    "Rotor.rotate": "rotors",
+    "EnigmaMachine.step": "rotors",
+    "EnigmaMachine.set_positions": "rotors",
+    "EnigmaMachine.encode_index_through_rotors": "rotors",
+    "SteppingSchedule.__init__": "rotors",
+
+    "EnigmaMachine.virtual_reflector": "reflector",
+    "EnigmaMachine.composite_table": "reflector",
+
+    "create_enigma_machine": "construction",
+    "machine_from_spec": "construction",
+    "machine_from_key": "construction",
+    "rotor_from_name": "construction",
+    "MachineSpec.parse": "construction",
+    "EnigmaMachine.__init__": "construction",
+    "EnigmaMachine.reset": "construction",
+
+    "EnigmaMachine.encode": "encode",
+    "EnigmaMachine.encode_composite": "encode",
+    "EnigmaMachine.encode_character": "encode",
+    "EnigmaMachine.find_crib": "encode",
+    "EnigmaMachine.encode_into": "encode",
+    "EnigmaMachine.encode_state_table": "encode",
+    "EnigmaMachine.encode_characters": "encode",
+    "EnigmaMachine.encode_indices": "encode",
+    "StateTable.build": "construction",
+}
+
+REFLECTOR_NAMES = ["A", "B", "C"]
+
+# EnigmaMachine methods instrument() replaces. encode, encode_characters, encode_into and find_crib are counted
+# through encode_indices, which they all encode with
+MACHINE_METHODS = ["__init__", "reset", "step", "encode_indices", "encode_composite", "encode_character", "encode_state_table"]
+
+
+def print_progress(status: object) -> None:
+    """
+    Progress callback printing one line per SearchStatus, e.g. '12.5% 1200/9600 keys, 340 keys/s, eta 25s, 1 hits'
+    """
+    eta = "?" if status.eta_seconds is None else "%.0fs" % status.eta_seconds
+    print("%.1f%% %d/%d keys, %.0f keys/s, eta %s, %d hits" % (
+        100 * status.keys_tested / status.keys_total if status.keys_total else 100.0,
+        status.keys_tested, status.keys_total, status.keys_per_second, eta, status.hits
+    ), file=sys.stderr)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread every interval seconds from a background thread, attributing each sample
+    to the PROFILE_STAGES stage of the innermost machine function running, or 'other'.
+    """
+    def __init__(self, interval: float = 0.001, thread_id: int = None) -> None:
+        self.interval = interval
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def stage(self, frame: object) -> str:
+        while frame is not None:
+            code = frame.f_code
+            stage = PROFILE_STAGES.get(getattr(code, "co_qualname", code.co_name))
+
+            if stage is not None:
+
+                # The reflector is a Rotor too, so rotor passes through it are told apart by name
+                if stage == "rotors" and getattr(frame.f_locals.get("self"), "name", None) in REFLECTOR_NAMES: return "reflector"
+                return stage
+
+            frame = frame.f_back
+
+        return "other"
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None: self.samples[self.stage(frame)] += 1
+
+    def start(self) -> None:
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def report(self) -> dict:
+        """
+        Fraction of samples in each stage.
+        """
+        total = sum(self.samples.values())
+        return {stage: count / total for stage, count in self.samples.most_common()} if total else {}
+
+
+class Telemetry:
+    """
+    Counters filled in while instrument() is active, plus optional search progress callbacks.
+    """
+    COUNTERS = [
+        "machines_constructed", "machines_rekeyed", "characters_encoded", "rotor_steps", "turnovers",
+        "candidates_tested", "candidates_screened_out", "candidates_rejected", "crib_hits"
+    ]
+
+    def __init__(self, progress_callback: object = None, progress_interval: float = 5.0) -> None:
+        self.progress_callback = progress_callback
+        self.progress_interval = progress_interval
+
+        for name in self.COUNTERS: setattr(self, name, 0)
+        self.construction_seconds = 0.0
+        self.profiler = None
+
+    def counters(self) -> dict:
+        counters = {name: getattr(self, name) for name in self.COUNTERS}
+        counters["construction_seconds"] = self.construction_seconds
+        return counters
+
+    def profile_report(self) -> dict:
+        return {} if self.profiler is None else self.profiler.report()
+
+    def record_search(self, previous: object, status: object) -> None:
+        """
+        Adds the keys a search tried between two of its SearchStatus reports (previous is None for the first).
+        """
+        for counter, field in [("candidates_tested", "keys_tested"), ("candidates_screened_out", "screened_out"), ("candidates_rejected", "rejected"), ("crib_hits", "hits")]:
+            setattr(self, counter, getattr(self, counter) + getattr(status, field) - (0 if previous is None else getattr(previous, field)))
+
+    def __repr__(self) -> str:
+        return "Telemetry(%s)" % ", ".join("%s=%s" % item for item in self.counters().items())
+
+
+def _wrap_machine(telemetry: Telemetry, original: dict) -> dict:
+    """
+    Returns the instrumented version of every wrapped function, keyed like original.
+    """
+    def constructor(function):
+        def instrumented(*args, **kwargs):
+            start = time.perf_counter()
+            try: return function(*args, **kwargs)
+            finally: telemetry.construction_seconds += time.perf_counter() - start
+        return instrumented
+
+    def init(self, *args, **kwargs):
+        telemetry.machines_constructed += 1
+        original["EnigmaMachine.__init__"](self, *args, **kwargs)
+
+    def reset(self, spec):
+        telemetry.machines_rekeyed += 1
+        start = time.perf_counter()
+        original["EnigmaMachine.reset"](self, spec)
+        telemetry.construction_seconds += time.perf_counter() - start
+
+    def step(self):
+        turnover = original["EnigmaMachine.step"](self)
+        telemetry.rotor_steps += 1
+        telemetry.turnovers += turnover
+        return turnover
+
+    def encode_indices(self, indices):
+
+        # Letters find_crib only steps past come through as None and are not counted
+        for encrypted_idx in original["EnigmaMachine.encode_indices"](self, indices):
+            if encrypted_idx is not None: telemetry.characters_encoded += 1
+            yield encrypted_idx
+
+    def encode_composite(self, plaintext):
+
+        # The composite engine reads rotor states from the stepping schedule instead of stepping
+        schedule = self.stepping_schedule(len(plaintext))
+        telemetry.characters_encoded += len(plaintext)
+        telemetry.rotor_steps += len(plaintext)
+        telemetry.turnovers += len(schedule.turnovers)
+        return original["EnigmaMachine.encode_composite"](self, plaintext)
+
+    def encode_character(self, char):
+        telemetry.characters_encoded += 1
+        return original["EnigmaMachine.encode_character"](self, char)
+
+    def encode_state_table(self, plaintext, state_table=None):
+        telemetry.characters_encoded += len(plaintext)
+        return original["EnigmaMachine.encode_state_table"](self, plaintext, state_table)
+
+    return {
+        "EnigmaMachine.__init__": init,
+        "EnigmaMachine.reset": reset,
+        "EnigmaMachine.step": step,
+        "EnigmaMachine.encode_indices": encode_indices,
+        "EnigmaMachine.encode_composite": encode_composite,
+        "EnigmaMachine.encode_character": encode_character,
+        "EnigmaMachine.encode_state_table": encode_state_table,
+        "create_enigma_machine": constructor(original["create_enigma_machine"]),
+        "machine_from_spec": constructor(original["machine_from_spec"]),
+    }
+
+
+def _wrap_search(telemetry: Telemetry, function: object) -> object:
+    """
+    Wraps a search generator so its progress reports reach the telemetry as well as any callback it was given.
+    """
+    def instrumented(*args, progress_callback=None, **options):
+        previous = None
+
+        def callback(status):
+            nonlocal previous
+            telemetry.record_search(previous, status)
+            previous = status
+
+            for user_callback in (progress_callback, telemetry.progress_callback):
+                if user_callback is not None: user_callback(status)
+
+        options.setdefault("progress_interval", telemetry.progress_interval)
+        return function(*args, progress_callback=callback, **options)
+
+    return instrumented
+
+
+@contextmanager
+def instrument(telemetry: Telemetry, profile: bool = False, profile_interval: float = 0.001):
+    """
+    Collects telemetry for everything run inside the with block, optionally sampling where this thread spends its time.
+    Results are unchanged: the wrappers only count and time the functions they call.
+    """
+    # 1. Originals of everything wrapped
+    original = {"create_enigma_machine": enigma.create_enigma_machine, "machine_from_spec": enigma.machine_from_spec}
+    for name in MACHINE_METHODS: original["EnigmaMachine." + name] = getattr(enigma.EnigmaMachine, name)
+
+    wrapped = _wrap_machine(telemetry, original)
+    original_reflector_search = enigma_search.ReflectorSearch.search
+
+    # 2. Module level functions are rebound in every module that imported them by name
+    module_functions = [
+        (original["create_enigma_machine"], wrapped["create_enigma_machine"]),
+        (original["machine_from_spec"], wrapped["machine_from_spec"]),
+        (enigma_search.search, _wrap_search(telemetry, enigma_search.search))
+    ]
+
+    patched = []
+    for module in list(sys.modules.values()):
+        if module is None: continue
+
+        for function, instrumented in module_functions:
+            if vars(module).get(function.__name__) is function:
+                setattr(module, function.__name__, instrumented)
+                patched.append((module, function.__name__, function))
+
+    for name in MACHINE_METHODS: setattr(enigma.EnigmaMachine, name, wrapped["EnigmaMachine." + name])
+    enigma_search.ReflectorSearch.search = _wrap_search(telemetry, original_reflector_search)
+
+    if profile:
+        telemetry.profiler = SamplingProfiler(profile_interval)
+        telemetry.profiler.start()
+
+    try:
+        yield telemetry
+    finally:
+
+        # 3. Put everything back
+        if profile: telemetry.profiler.stop()
+
+        for module, name, function in patched: setattr(module, name, function)
+        for name in MACHINE_METHODS: setattr(enigma.EnigmaMachine, name, original["EnigmaMachine." + name])
+        enigma_search.ReflectorSearch.search = original_reflector_search
+
+
+if __name__ == "__main__":
+
+    from enigma import create_enigma_machine, code_four, code_four_search, code_five, possible_crib_offsets
+    from enigma_search import machine_from_key
+
+    # ------------- Test 1 -----------
+
+    # Counting does not change results, and everything is put back afterwards
+    encode_indices = enigma.EnigmaMachine.encode_indices
+    plain = create_enigma_machine("I II III", "B", "01 01 01", "A A U").encode("HELLOWORLD")
+
+    telemetry = Telemetry()
+    with instrument(telemetry):
+        assert(enigma.create_enigma_machine("I II III", "B", "01 01 01", "A A U").encode("HELLOWORLD") == plain)
+
+    assert(enigma.EnigmaMachine.encode_indices is encode_indices)
+    assert(telemetry.machines_constructed == 1 and telemetry.characters_encoded == 10)
+    assert(telemetry.rotor_steps == 10 and telemetry.turnovers == 1)
+
+    # ------------- Test 2 -----------
+
+    # Searches report every candidate by stage, and the profiler sees the machine at work
+    expected = expected_four = code_four()
+    statuses = []
+    telemetry = Telemetry(progress_callback=statuses.append)
+    with instrument(telemetry, profile=True):
+        assert(code_four() == expected)
+
+    assert(telemetry.candidates_tested == 132 and telemetry.crib_hits == len(expected))
+    assert(telemetry.candidates_screened_out + telemetry.candidates_rejected + telemetry.crib_hits == 132)
+    assert(statuses[-1].keys_tested == statuses[-1].keys_total == 132 and statuses[-1].eta_seconds == 0)
+
+    # ------------- Test 3 -----------
+
+    # The reflector search reports progress too
+    expected = code_five()
+    telemetry = Telemetry()
+    with instrument(telemetry):
+        assert(code_five() == expected)
+
+    assert(telemetry.candidates_tested == 3 * 8580 and telemetry.crib_hits == len(expected))
+
+    # ------------- Test 4 -----------
+
+    # An anchored search counts the letters its crib screen decrypts as well as the full decrypts of survivors
+    keyspace, code, accept, composite = code_four_search()
+    crib = accept.cribs[0]
+
+    scanned = 0
+    for index in range(len(keyspace)):
+        plaintext = machine_from_key(keyspace.key(index)).encode(code)
+
+        # The screen decrypts each window up to its first mismatch, each letter once
+        windows = set()
+        for offset in possible_crib_offsets(code, crib):
+            for i, crib_char in enumerate(crib):
+                windows.add(offset + i)
+                if plaintext[offset + i] != crib_char: break
+
+        scanned += len(windows)
+        if crib in plaintext: scanned += len(code)
+
+    telemetry = Telemetry()
+    with instrument(telemetry):
+        hits = list(enigma_search.search(keyspace, code, accept, processes=1))
+
+    assert(len(hits) == telemetry.crib_hits == len(expected_four))
+    assert(telemetry.characters_encoded == scanned and scanned > len(hits) * len(code))